@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 ### author: Jingmei Yang: jmyang@bu.edu
 
-import requests
-from bs4 import BeautifulSoup
-import time
-import re
 import os
+import time
+import asyncio
 import argparse
-import csv
+import sys
+sys.path.insert(0, './model')
+from pubmed_pages import PARSERS
+from pubmed_scraper import HEADER, HostLimiter, FailureLog, AsyncScraper
+from pubmed_eutils import EUTILS_URL, EFETCH_SIZE, EutilsScraper
+from query_planner import RESULT_CAP, MIN_DATE, ENTRY_DATE, QueryPlanner, parse_date
+from crawl_state import CrawlState, read_pmids, append_rows
+from page_archive import PageArchive
+from datetime import date, timedelta
 
 def read_file(FILEPATH):
     with open(FILEPATH,'r') as f:
@@ -15,144 +21,12 @@ def read_file(FILEPATH):
       f.close()
     return file_text
 
-def get_html(url,header,params):
-    if params is None:
-        webpage = requests.get(url, headers=header)
-    else:
-        webpage = requests.get(url, params=params, headers=header)
-
-    html = webpage.text
-    soup = BeautifulSoup(html, "lxml")
-    return soup
-
-
-def get_result_pages(url, header, term):
-    search_params = {"term": term}
-    search_soup = get_html(url, header, search_params)
-
-
-    results = search_soup.select(
-        '#search-results > div.top-wrapper > div.results-amount-container > div.results-amount > span')
-    results = results[0].text
-    if len(results) != 0:
-        new_results = int(str(results).replace("\n", "").replace(",", ""))
-        if new_results % 10 == 0:
-            pages = new_results / 10
-        else:
-            pages = int(new_results / 10) + 1
-    else:
-        pages = 0
-    return pages
-
-
-def web_scrape(csv_file_name,
-               start_page_enter,
-               end_page,
-               url,
-               header,
-               term):
-    csv_file = open(csv_file_name, 'w')
-    csv_writer = csv.writer((csv_file))
-    csv_writer.writerow(['PMID','Title','Abstract','Keyword','Year','Link','DOI'])
-
-    for page in range(start_page_enter, end_page,1):
-        params = {"term": term, "page": str(page)}
-        result_soup = get_html(url, header, params)
-        time.sleep(2)
-        links = result_soup.select('#search-results > section > div.search-results-chunks > div > article > div.docsum-wrap > div.docsum-content > a')
-
-        for ix, link in enumerate(links):
-            try:
-                id_soup = link["data-article-id"]
-                if (id_soup is None):
-                    time.sleep(2)
-                    continue
-                elif len(id_soup)<1:
-                    time.sleep(2)
-                    continue
-                else:
-                    pmid = id_soup.strip()
-
-                link_soup = link["href"]
-                if link_soup is None:
-                    time.sleep(2)
-                    continue
-                elif len(link_soup) <1:
-                    time.sleep(2)
-                    continue
-                else:
-                    article_link = url + link_soup
-
-                article_soup = get_html(article_link, header, None)
-                time.sleep(1)
-
-                title_soup = article_soup.select('#full-view-heading > h1')
-                if title_soup is None:
-                    title = "Missing"
-                elif len(title_soup)<1:
-                    title = "Missing"
-                else:
-                    title = title_soup[0].text.strip()
-
-                abstracts = article_soup.select('#eng-abstract > p')
-                if (abstracts is None):
-                    time.sleep(2)
-                    continue
-
-                elif (len(abstracts) == 0):
-                    time.sleep(2)
-                    continue
-                elif len(abstracts) == 1:
-                    abstract = abstracts[0].text.strip()
-                else:
-                    abstract_ls = []
-                    for ab in abstracts:
-                        paragraph = re.sub("\s{2,}", " ", ab.text.strip())
-                        abstract_ls.append(paragraph)
-                    abstract = " ".join(abstract_ls)
-
-                key_paragraph= article_soup.find('div', class_= 'abstract').find('strong', class_ ='sub-title', string = re.compile('Keywords'))
-                if key_paragraph is None:
-                    keywords = 'Missing'
-                else:
-                    keywords = re.sub("\s{2,}", " ", key_paragraph.parent.text.strip())
-
-                year_soup = article_soup.select('#full-view-heading > div.article-citation > div.article-source > span.cit')
-                if (year_soup is None):
-                    year = 'Missing'
-                elif (len(year_soup)<1):
-                    year = 'Missing'
-                else:
-                    year_text = year_soup[0].text.strip()
-                    p = re.compile('\d{4}')
-                    m = re.match(p, year_text)
-                    if m:
-                        year = m.group().strip()
-                    else:
-                        year = 'Missing'
-
-                doi_soup = article_soup.find("span", class_='identifier doi')
-                if (doi_soup is None) :
-                    doi = "Missing"
-                elif (len(doi_soup)<1):
-                    doi = "Missing"
-                else:
-                    doi = doi_soup.find("a", class_='id-link').text.strip()
-
-                csv_writer.writerow([pmid, title, abstract,keywords,year,article_link,doi])
-
-                if ix % 3 == 0:
-                    time.sleep(3)
-                elif ix % 10 == 0:
-                    time.sleep(5)
-                else:
-                    time.sleep(1)
-
-            except Exception as e:
-                time.sleep(300)
-                pass
-    csv_file.close()
-
+def report_run(complete, scraper):
+    if scraper.failed:
+        print(f"{len(scraper.failed)} articles could not be fetched or parsed; the next --since_last_run 1 run retries them.")
+    if not complete:
+        print("Not every result was read (--start/--end, the result cap or a failed search page or batch), so "
+              "--since_last_run 1 will not search from this run.")
 
 
 def parse_args():
@@ -163,6 +37,38 @@ def parse_args():
     parser.add_argument("--end", type=int, default= 100)
     parser.add_argument("--output_folder", type=str, default='./data_preparation/input/datasets/Nipah')
     parser.add_argument("--file", type=str, default='Nipah.csv')
+    parser.add_argument("--backend", type=str, default='html', choices=['html', 'eutils'],
+                        help="html scrapes the PubMed pages; eutils reads the same fields from E-utilities XML")
+    parser.add_argument("--url", type=str, default="https://pubmed.ncbi.nlm.nih.gov")
+    parser.add_argument("--eutils_url", type=str, default=EUTILS_URL)
+    parser.add_argument("--batch_size", type=int, default=EFETCH_SIZE, help="PMIDs per efetch request")
+    parser.add_argument("--api_key", type=str, default=None, help="NCBI API key (raises the limit to 10 requests/s)")
+    parser.add_argument("--email", type=str, default=None)
+    parser.add_argument("--date_slices", type=int, default=0,
+                        help="split the term by publication date until every slice is under --result_cap and crawl all slices (ignores --start/--end)")
+    parser.add_argument("--result_cap", type=int, default=RESULT_CAP)
+    parser.add_argument("--min_date", type=parse_date, default=MIN_DATE, help="YYYY/MM/DD")
+    parser.add_argument("--max_date", type=parse_date, default=None, help="YYYY/MM/DD (default: no upper bound)")
+    parser.add_argument("--parser", type=str, default='lxml', choices=PARSERS,
+                        help="article page parser: compiled lxml XPath, or the original BeautifulSoup selectors")
+    parser.add_argument("--archive", type=int, default=1, help="keep every fetched page in a compressed archive")
+    parser.add_argument("--archive_dir", type=str, default=None, help="default: raw_pages in output_folder")
+    parser.add_argument("--conditional", type=int, default=1,
+                        help="request archived pages with If-None-Match / If-Modified-Since and reuse them on 304")
+    parser.add_argument("--since_last_run", "--since-last-run", type=int, default=0,
+                        help="only search papers entered since the last run of the term and append the new PMIDs to --file")
+    parser.add_argument("--state_path", type=str, default=None,
+                        help="SQLite crawl state (default: <file>_state.sqlite in output_folder)")
+    parser.add_argument("--delta_file", type=str, default=None,
+                        help="CSV of the papers added by a --since_last_run run (default: <file>_delta_<time>.csv in output_folder)")
+    parser.add_argument("--rpm", type=float, default=60)
+    parser.add_argument("--burst", type=float, default=1)
+    parser.add_argument("--limiter_path", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max_retries", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--failure_log", type=str, default=None,
+                        help="CSV of URLs that could not be fetched or parsed (default: <file>_failures.csv in output_folder)")
     args = parser.parse_args()
     return args
 
@@ -179,16 +85,72 @@ def main():
         os.makedirs(output_folder)
     csv_file_name = os.path.join(output_folder, args.file)
 
-    url = "https://pubmed.ncbi.nlm.nih.gov"
-
-    header = {
-        "user-agent":
-    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/536.3 (KHTML, like Gecko) Chrome/19.0.1063.0 Safari/536.3"
-    }
-
-    result_pages = get_result_pages(url, header, term)
-    end_page = min(result_pages, end_page_enter)
-    web_scrape(csv_file_name, start_page_enter, end_page, url, header, term)
+    file_stem = os.path.splitext(args.file)[0]
+    failure_log = FailureLog(args.failure_log or os.path.join(output_folder, f"{file_stem}_failures.csv"))
+    state = CrawlState(args.state_path or os.path.join(output_folder, f"{file_stem}_state.sqlite"))
+    limiter = HostLimiter(rpm=args.rpm, burst=args.burst, state_path=args.limiter_path)
+    archive = PageArchive(args.archive_dir or os.path.join(output_folder, 'raw_pages')) if args.archive else None
+    if args.backend == 'eutils':
+        scraper = EutilsScraper(args.eutils_url, link_url=args.url, api_key=args.api_key, email=args.email,
+                                batch_size=args.batch_size, header=HEADER, limiter=limiter, concurrency=args.concurrency,
+                                max_retries=args.max_retries, timeout=args.timeout, failure_log=failure_log,
+                                archive=archive, conditional=bool(args.conditional))
+    else:
+        scraper = AsyncScraper(args.url, HEADER, limiter, concurrency=args.concurrency,
+                               max_retries=args.max_retries, timeout=args.timeout, failure_log=failure_log,
+                               archive=archive, conditional=bool(args.conditional), article_parser=args.parser)
+
+    if args.since_last_run:
+        # Entry dates have day resolution, so the day before the last complete run is searched again; PMIDs
+        # already in the dataset are skipped, those that failed before are fetched again, and only new ones are
+        # appended.
+        state.sync_csv(csv_file_name)
+        scraper.known = state.get_pmids()
+        scraper.retry = state.get_failed() - scraper.known
+        last_run = state.get_last_run(term)
+        since = args.min_date if last_run is None else date.fromtimestamp(last_run) - timedelta(days=1)
+        run_id = state.start_run(term, since)
+        delta_file = args.delta_file or os.path.join(output_folder, f"{file_stem}_delta_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+        planner = QueryPlanner(scraper.get_result_count, cap=args.result_cap, min_date=since, max_date=args.max_date,
+                               field=ENTRY_DATE)
+        written = asyncio.run(planner.crawl(scraper, delta_file, term, date_range=True))
+        append_rows(delta_file, csv_file_name)
+        complete = scraper.partial == 0 and not planner.truncated
+        state.finish_run(run_id, read_pmids(delta_file), complete, scraper.failed, scraper.retry)
+        state.close()
+        failure_log.close()
+        if archive is not None:
+            archive.close()
+        print(f"Searched entries since {since:%Y/%m/%d} in {len(planner.slices)} slices; {len(scraper.known)} PMIDs were already known "
+              f"and {len(scraper.retry)} failed ones were retried.")
+        print(f"Appended {written} new articles to {csv_file_name} and wrote them to {delta_file}; "
+              f"{failure_log.count} failures logged to {failure_log.log_path}.")
+        report_run(complete, scraper)
+        return
+
+    run_id = state.start_run(term)
+    complete = True
+    if args.date_slices:
+        planner = QueryPlanner(scraper.get_result_count, cap=args.result_cap, min_date=args.min_date, max_date=args.max_date)
+        written = asyncio.run(planner.crawl(scraper, csv_file_name, term))
+        complete = not planner.truncated
+        print(f"Planned {len(planner.slices)} date slices with {planner.searches} searches.")
+        for date_term, count in planner.truncated:
+            print(f"Warning: {date_term} has {count} results, over the cap of {args.result_cap}; only the first {args.result_cap} were read.")
+    elif args.backend == 'eutils':
+        # --start and --end still count pages of 10 results, page 0 being the first.
+        written = asyncio.run(scraper.scrape(csv_file_name, term, start_page_enter * 10, end_page_enter * 10))
+    else:
+        written = asyncio.run(scraper.scrape(csv_file_name, term, start_page_enter, end_page_enter))
+    complete = complete and scraper.partial == 0
+    state.finish_run(run_id, read_pmids(csv_file_name), complete, scraper.failed)
+    state.close()
+    failure_log.close()
+    if archive is not None:
+        archive.close()
+        print(f"{scraper.not_modified} pages were unchanged (304) and read from {archive.archive_dir}.")
+    print(f"Wrote {written} articles to {csv_file_name}; {failure_log.count} failures logged to {failure_log.log_path}.")
+    report_run(complete, scraper)
 
 if __name__ == '__main__':
     main()
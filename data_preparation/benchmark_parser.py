@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import glob
+import time
+import argparse
+from pubmed_pages import PARSERS, parse_article_page
+from page_archive import PageArchive
+from pubmed_fixture_server import FIRST_PMID, get_article_html
+
+FIELDS = ['Title', 'Abstract', 'Keyword', 'Year', 'DOI']
+
+
+def load_pages(args):
+    # (name, html) of the saved article pages: a folder of .html files, the article pages of an archive, or
+    # generated fixture pages when neither is given.
+    if args.page_dir:
+        paths = sorted(glob.glob(os.path.join(args.page_dir, '*.html')))[:args.max_pages]
+        pages = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                pages.append((os.path.basename(path), f.read().decode('utf-8', errors='replace')))
+        return pages
+    if args.archive_dir:
+        archive = PageArchive(args.archive_dir)
+        pages = [(url, archive.read(key).decode(encoding or 'utf-8', errors='replace'))
+                 for url, key, _, encoding, _ in archive.iter_pages(['article'])[:args.max_pages]]
+        archive.close()
+        return pages
+    return [(str(FIRST_PMID + i), get_article_html(FIRST_PMID + i)) for i in range(args.max_pages)]
+
+
+def get_outcome(result):
+    if result is None:
+        return 'skipped'
+    return 'error' if isinstance(result, Exception) else 'parsed'
+
+
+def parse_all(pages, parser):
+    # Fields of every page (or the exception raised), and the seconds taken.
+    results = []
+    start = time.perf_counter()
+    for _, html in pages:
+        try:
+            results.append(parse_article_page(html, parser))
+        except Exception as e:
+            results.append(e)
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed and field-level agreement of the article page parsers",
+                                     prog="Parser Benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--page_dir", type=str, default=None, help="folder of saved PubMed article pages (*.html)")
+    parser.add_argument("--archive_dir", type=str, default=None, help="raw page archive to read article pages from")
+    parser.add_argument("--max_pages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many passes is reported")
+    parser.add_argument("--show", type=int, default=5, help="mismatching pages to print")
+    args = parser.parse_args()
+
+    pages = load_pages(args)
+    if not pages:
+        raise ValueError("No article pages found.")
+
+    results, speeds = {}, {}
+    for name in PARSERS:
+        for _ in range(args.repeat):
+            results[name], seconds = parse_all(pages, name)
+            speeds[name] = max(speeds.get(name, 0), len(pages) / seconds)
+
+    # A page agrees when both parsers skip it (no abstract), fail on it, or return the same value for a field.
+    reference, candidate = results['bs4'], results['lxml']
+    print(f"{len(pages)} pages")
+    print(f"{'parser':<8} {'pages/s':>9} {'speedup':>8}")
+    for name in PARSERS:
+        print(f"{name:<8} {speeds[name]:>9.1f} {speeds[name] / speeds['bs4']:>8.2f}")
+
+    same_outcome = [get_outcome(a) == get_outcome(b) for a, b in zip(reference, candidate)]
+    print(f"{'field':<10} {'equal':>7}")
+    print(f"{'outcome':<10} {sum(same_outcome):>7}/{len(pages)}")
+    mismatches = [not same for same in same_outcome]
+    for i, field in enumerate(FIELDS):
+        equal = 0
+        for j, (a, b) in enumerate(zip(reference, candidate)):
+            if get_outcome(a) == get_outcome(b) == 'parsed':
+                if a[i] == b[i]:
+                    equal += 1
+                else:
+                    mismatches[j] = True
+            elif same_outcome[j]:
+                equal += 1
+        print(f"{field:<10} {equal:>7}/{len(pages)}")
+
+    for j in [j for j, bad in enumerate(mismatches) if bad][:args.show]:
+        print(f"\n{pages[j][0]}\n  bs4:  {reference[j]!r}\n  lxml: {candidate[j]!r}")
+
+if __name__ == '__main__':
+    main()
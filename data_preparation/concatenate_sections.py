@@ -28,6 +28,9 @@ def main():
 
     data = pd.read_csv(args.input_path)
     columns_to_save = ['PMID','Review_Paper', 'Review']
+    # The publication year is kept when the labelled file has it, for year filters of model/retrieval_index.py.
+    if 'Year' in data.columns:
+        columns_to_save.append('Year')
     preprocessed_df = preprocess_input(data, columns_to_save)
     output_dir = os.path.dirname(args.save_path)
     if not os.path.exists(output_dir):
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import csv
+import time
+import sqlite3
+from pubmed_pages import COLUMNS
+
+
+def read_pmids(csv_file_name):
+    # PMIDs of a scraped CSV, in file order; empty if the file does not exist.
+    if not os.path.exists(csv_file_name):
+        return []
+    with open(csv_file_name, newline='') as csv_file:
+        return [row['PMID'] for row in csv.DictReader(csv_file) if row.get('PMID')]
+
+
+def append_rows(source_csv, target_csv):
+    # Appends the rows of source_csv to target_csv (writing the header if target_csv is new), fsynced before
+    # returning; returns the number of rows appended.
+    with open(source_csv, newline='') as source:
+        rows = list(csv.reader(source))[1:]
+    new_file = not os.path.exists(target_csv) or os.path.getsize(target_csv) == 0
+    with open(target_csv, 'a', newline='') as target:
+        writer = csv.writer(target)
+        if new_file:
+            writer.writerow(COLUMNS)
+        writer.writerows(rows)
+        target.flush()
+        os.fsync(target.fileno())
+    return len(rows)
+
+
+class CrawlState:
+    # What a dataset already holds, kept in SQLite next to it: every PMID written so far, with the run that
+    # added it, every crawl of a term with its start time and whether it read every result, and the PMIDs
+    # whose article could not be fetched or parsed. An incremental crawl searches only the entries added to
+    # PubMed since the last complete run of the same term, skips the PMIDs stored here and retries the failed
+    # ones.
+    def __init__(self, state_path: str) -> None:
+        self.state_path = state_path
+        state_dir = os.path.dirname(state_path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self.conn = sqlite3.connect(state_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs "
+                          "(id INTEGER PRIMARY KEY AUTOINCREMENT, term TEXT, since TEXT, started REAL, "
+                          "finished REAL, added INTEGER, complete INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pmids (pmid TEXT PRIMARY KEY, run_id INTEGER, added REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS failed (pmid TEXT PRIMARY KEY, run_id INTEGER, failed REAL)")
+        # State files written before runs recorded completeness; their runs are never used as a baseline.
+        if 'complete' not in [row[1] for row in self.conn.execute("PRAGMA table_info(runs)")]:
+            self.conn.execute("ALTER TABLE runs ADD COLUMN complete INTEGER")
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM pmids").fetchone()[0]
+
+    def get_pmids(self):
+        return {row[0] for row in self.conn.execute("SELECT pmid FROM pmids")}
+
+    def get_failed(self):
+        return {row[0] for row in self.conn.execute("SELECT pmid FROM failed")}
+
+    def add_pmids(self, pmids, run_id=None) -> int:
+        # Records pmids; returns how many were not known yet.
+        before = len(self)
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO pmids (pmid, run_id, added) VALUES (?, ?, ?)",
+                                  [(pmid, run_id, now) for pmid in pmids])
+        return len(self) - before
+
+    def sync_csv(self, csv_file_name) -> int:
+        # Adds the PMIDs of an existing dataset, so a first incremental run, or one after a crash between
+        # appending rows and recording them, does not write them twice.
+        return self.add_pmids(read_pmids(csv_file_name))
+
+    def get_last_run(self, term):
+        # Start time of the last complete crawl of term, or None. A run that stopped at --end, hit the result
+        # cap or lost a search page or efetch batch may have missed papers entered before it started.
+        row = self.conn.execute("SELECT MAX(started) FROM runs WHERE term = ? AND finished IS NOT NULL AND complete = 1",
+                                (term,)).fetchone()
+        return row[0]
+
+    def start_run(self, term, since=None) -> int:
+        with self.conn:
+            cursor = self.conn.execute("INSERT INTO runs (term, since, started) VALUES (?, ?, ?)",
+                                       (term, None if since is None else str(since), time.time()))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id, pmids, complete=False, failed=(), retried=()) -> int:
+        # Records the PMIDs a run wrote, replaces the failed PMIDs it retried by those that failed again, and
+        # marks it finished (and complete, if it read every result) in one transaction; returns how many PMIDs
+        # were new.
+        before = len(self)
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO pmids (pmid, run_id, added) VALUES (?, ?, ?)",
+                                  [(pmid, run_id, now) for pmid in pmids])
+            added = self.conn.execute("SELECT COUNT(*) FROM pmids").fetchone()[0] - before
+            self.conn.executemany("DELETE FROM failed WHERE pmid = ?", [(pmid,) for pmid in set(retried) | set(pmids)])
+            self.conn.executemany("INSERT OR REPLACE INTO failed (pmid, run_id, failed) VALUES (?, ?, ?)",
+                                  [(pmid, run_id, now) for pmid in set(failed) - set(pmids)])
+            self.conn.execute("UPDATE runs SET finished = ?, added = ?, complete = ? WHERE id = ?",
+                              (now, added, int(complete), run_id))
+        return added
+
+    def close(self):
+        self.conn.close()
@@ -5,16 +5,18 @@ import pandas as pd
 import numpy as np
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-import time
-import tiktoken
 import argparse
 import openai
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
 import sys
-sys.path.insert(0, './models')
-from funs import get_embedding, setup_logger
+sys.path.insert(0, './model')
+from funs import setup_logger, set_rate_limiter, set_embedding_cache, set_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import EmbeddingCache
 
 
 def main():
@@ -25,61 +27,46 @@ def main():
     parser.add_argument("--input_path", type=str, default='./data_preparation/output/datasets/Nipah/Nipah_pre_explanations.csv')
     parser.add_argument("--save_path", type=str, default='./data_preparation/output/datasets/Nipah/Nipah_pre_emb.npz')
     parser.add_argument("--log_path", type=str, default='./data_preparation/output/datasets/Nipah/get_embeddings.log')
+    parser.add_argument("--rpm", type=float, default=3000)
+    parser.add_argument("--tpm", type=float, default=1000000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--max_input_tokens", type=int, default=8000)
+    parser.add_argument("--max_batch_tokens", type=int, default=250000)
+    parser.add_argument("--max_batch_size", type=int, default=2048)
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_dir", type=str, default='./data_preparation/output/embedding_cache')
+    parser.add_argument("--dtype", type=str, default='float64', choices=['float64', 'float32', 'float16'])
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
 
     args = parser.parse_args()
     save_path = args.save_path
     logger = setup_logger(args.log_path)
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout, pool_size=args.pool_size))
+    if bool(args.use_cache):
+        set_embedding_cache(EmbeddingCache(args.cache_dir))
     data = pd.read_csv(args.input_path)
-    embeddings = []
-    ids = []
-    for ix, row in data.iterrows():
-        try:
-            embedding = get_embedding(context = row['Combined'],
-                                      model="text-embedding-ada-002",
-                                      encoding = "cl100k_base",
-                                      max_tokens = 8000)
 
-        except Exception as e:
-            logger.error(f"Exception embedding occurred with PMID: {row['PMID']}, error: {e}", exc_info=True)
-            embedding = np.array([-1] * 1536)
-            time.sleep(60)
-        embeddings.append(embedding)
-        ids.append(row["PMID"])
-        time.sleep(2 if ix % 5 == 0 and ix != 0 else 1)
-
-    embeddings = np.array(embeddings)
-    ids = np.array(ids)
+    batcher = EmbeddingBatcher(model="text-embedding-ada-002",
+                               max_input_tokens=args.max_input_tokens,
+                               max_batch_tokens=args.max_batch_tokens,
+                               max_batch_size=args.max_batch_size,
+                               logger=logger)
+    embeddings, failed = batcher.embed(data['Combined'].tolist())
+
+    # The embedding rows are matched to the cross-validation splits by position, so a partial file would
+    # silently misalign them; nothing is written until every PMID has a vector.
+    if failed:
+        failed_ids = data['PMID'].iloc[failed].tolist()
+        logger.error(f"Embedding failed for {len(failed_ids)} PMIDs: {failed_ids}")
+        raise RuntimeError(f"Embedding failed for {len(failed_ids)} PMIDs, see {args.log_path}.")
+
+    embeddings = np.array(embeddings, dtype=args.dtype)
+    ids = data['PMID'].values
     np.savez(save_path, embedding = embeddings, PMID=ids)
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
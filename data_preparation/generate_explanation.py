@@ -5,13 +5,15 @@ import pandas as pd
 import numpy as np
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-import time
 import argparse
 import openai
 from justification_generation import JustificationGenerator
 import sys
-sys.path.insert(0, './models')
-from funs import get_answer, read_file, setup_logger, clean_text
+sys.path.insert(0, './model')
+from funs import get_answer, read_file, setup_logger, clean_text, set_rate_limiter, set_response_cache, open_resumable_csv, set_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from response_cache import ResponseCache
 from zero_shot import ZeroShot
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
@@ -38,6 +40,18 @@ def parse_args():
     parser.add_argument("--sub", type=int, default=0)
     parser.add_argument("--cot", type=int, default=1)
     parser.add_argument("--log_path", type=str, default='./data_preparation/output/datasets/Nipah/generate_explanation.log')
+    parser.add_argument("--rpm", type=float, default=3500)
+    parser.add_argument("--tpm", type=float, default=90000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_path", type=str, default='./model/output/response_cache.sqlite')
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--resume", type=int, default=0)
+    parser.add_argument("--retry_passes", type=int, default=1)
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
 
     args = parser.parse_args()
     return args
@@ -46,6 +60,10 @@ def main():
     args = parse_args()
     cot = bool(args.cot)
     logger = setup_logger(args.log_path)
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout, pool_size=args.pool_size))
+    if bool(args.use_cache):
+        set_response_cache(ResponseCache(args.cache_path, max_bytes=args.cache_size_mb * 1024 ** 2))
 
     if cot:
         explanation_generator =   ZeroShot(model_type = args.gpt_model,
@@ -63,9 +81,16 @@ def main():
                                                        justification_prompt = read_file(args.justification_path))
 
     data = pd.read_csv(args.input_path)
-    generated_explanations = []
+    progress_path = f"{os.path.splitext(args.output_path)[0]}_{args.save_col}_progress.csv"
+    csv_writer, csv_file, completed = open_resumable_csv(progress_path, ['PMID', args.save_col], args.save_col,
+                                                         resume=bool(args.resume))
+    if completed:
+        logger.info(f"Resuming {progress_path}: {len(completed)} PMIDs already answered.")
 
+    pending = []
     for ix, row in data.iterrows():
+        if str(row['PMID']) in completed:
+            continue
         if cot:
             prompt = explanation_generator.get_prompt(context=row['Combined'])
         else:
@@ -76,17 +101,32 @@ def main():
         os.makedirs(prompt_dir, exist_ok=True)
         with open(os.path.join(prompt_dir, f"{row['PMID']}.txt"), 'w') as file:
             file.write(str(prompt))
-        try:
-            answer = clean_text(get_answer(model=args.gpt_model, prompt=prompt, TMP=args.temperature))
-
-        except Exception as e:
-            logger.error(f"Exception occurred with PMID: {row['PMID']}, error: {e}", exc_info=True)
-            answer = 'ERROR'
-            time.sleep(60)
-
-        generated_explanations.append(answer)
-
-    data[args.save_col] = generated_explanations
+        pending.append((row['PMID'], prompt))
+
+    for attempt in range(args.retry_passes + 1):
+        if attempt > 0 and pending:
+            logger.info(f"Retry pass {attempt}: {len(pending)} PMIDs.")
+        failed = []
+        for pmid, prompt in pending:
+            try:
+                answer = clean_text(get_answer(model=args.gpt_model, prompt=prompt, TMP=args.temperature))
+
+            except Exception as e:
+                logger.error(f"Exception occurred with PMID: {pmid}, error: {e}", exc_info=True)
+                failed.append((pmid, prompt))
+                continue
+
+            csv_writer.writerow([pmid, answer])
+        pending = failed
+
+    for pmid, prompt in pending:
+        csv_writer.writerow([pmid, 'ERROR'])
+    csv_writer.sync()
+    csv_file.close()
+
+    progress = pd.read_csv(progress_path, dtype=str, keep_default_na=False)
+    generated_explanations = dict(zip(progress['PMID'], progress[args.save_col]))
+    data[args.save_col] = data['PMID'].astype(str).map(generated_explanations)
     data.to_csv(args.output_path, index=False)
     logger.info(f"Explanation Generation for {args.save_col} Completed.")
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import csv
+import time
+import zlib
+import sqlite3
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pubmed_pages import COLUMNS, PARSERS, parse_article_page
+from pubmed_eutils import PUBMED_URL, iter_efetch
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ['zstd', 'zlib']
+SHARD_BYTES = 256 * 1024 ** 2
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("This archive holds zstd pages; install zstandard to read them.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class PageArchive:
+    # Every fetched page, kept so a parsing fix never needs a new crawl. Bodies are stored once per sha256,
+    # each compressed on its own (zstd if zstandard is installed, zlib otherwise) and appended to shard files of
+    # up to shard_bytes. An SQLite index maps each hash to its shard, offset and codec, each URL to its latest
+    # hash with the ETag and Last-Modified needed for conditional requests, and each PMID to the pages that
+    # hold it. One process writes at a time; any number can read.
+    def __init__(self, archive_dir: str, codec: str = None, shard_bytes: int = SHARD_BYTES) -> None:
+        codec = codec or ('zstd' if zstandard is not None else 'zlib')
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {CODECS}.")
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("codec 'zstd' needs the zstandard package.")
+
+        self.archive_dir = archive_dir
+        self.codec = codec
+        self.shard_bytes = shard_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(archive_dir, 'shards'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(archive_dir, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blobs "
+                          "(hash TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, length INTEGER, size INTEGER, codec TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pages "
+                          "(url TEXT PRIMARY KEY, hash TEXT, kind TEXT, encoding TEXT, etag TEXT, "
+                          "last_modified TEXT, fetched REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pmids (pmid TEXT, url TEXT, PRIMARY KEY (pmid, url))")
+        self.conn.commit()
+        self.shard = self.conn.execute("SELECT COALESCE(MAX(shard), 0) FROM blobs").fetchone()[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def get_shard_path(self, shard):
+        return os.path.join(self.archive_dir, 'shards', f'shard_{shard:05d}.bin')
+
+    def put(self, url, content: bytes, kind: str, encoding: str = 'utf-8', etag: str = None,
+            last_modified: str = None, pmids=()) -> str:
+        # Stores the body of url (once per distinct content) and returns its hash.
+        key = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (key,)).fetchone() is None:
+                data = compress(content, self.codec)
+                path = self.get_shard_path(self.shard)
+                if os.path.exists(path) and os.path.getsize(path) + len(data) > self.shard_bytes:
+                    self.shard += 1
+                    path = self.get_shard_path(self.shard)
+                with open(path, 'ab') as f:
+                    offset = f.tell()
+                    f.write(data)
+                self.conn.execute("INSERT INTO blobs (hash, shard, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (key, self.shard, offset, len(data), len(content), self.codec))
+            self.conn.execute("INSERT OR REPLACE INTO pages (url, hash, kind, encoding, etag, last_modified, fetched) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)", (url, key, kind, encoding, etag, last_modified, time.time()))
+            self.conn.executemany("INSERT OR IGNORE INTO pmids (pmid, url) VALUES (?, ?)", [(p, url) for p in pmids])
+            self.conn.commit()
+        return key
+
+    def add_pmids(self, url, pmids):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO pmids (pmid, url) VALUES (?, ?)", [(p, url) for p in pmids])
+            self.conn.commit()
+
+    def read(self, key) -> bytes:
+        row = self.conn.execute("SELECT shard, offset, length, codec FROM blobs WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        shard, offset, length, codec = row
+        with open(self.get_shard_path(shard), 'rb') as f:
+            f.seek(offset)
+            return decompress(f.read(length), codec)
+
+    def get_page(self, url):
+        # (content, encoding, etag, last_modified) of the latest copy of url, or None.
+        row = self.conn.execute("SELECT hash, encoding, etag, last_modified FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return (self.read(row[0]),) + tuple(row[1:])
+
+    def get_pmid_pages(self, pmid):
+        return [row[0] for row in self.conn.execute("SELECT url FROM pmids WHERE pmid = ?", (pmid,))]
+
+    def iter_pages(self, kinds=None):
+        # (url, hash, kind, encoding, PMID) of every archived page in the order it was stored; PMID is the first
+        # one indexed for the page (the article of an article page), or None.
+        query = ("SELECT p.url, p.hash, p.kind, p.encoding, MIN(m.pmid) FROM pages p "
+                 "LEFT JOIN pmids m ON m.url = p.url")
+        if kinds:
+            query += f" WHERE p.kind IN ({', '.join('?' * len(kinds))})"
+        return self.conn.execute(query + " GROUP BY p.url ORDER BY p.rowid", tuple(kinds or ())).fetchall()
+
+    def stats(self):
+        pages = dict(self.conn.execute("SELECT kind, COUNT(*) FROM pages GROUP BY kind").fetchall())
+        blobs, size, stored = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length), 0) "
+                                                "FROM blobs").fetchone()
+        pmids = self.conn.execute("SELECT COUNT(DISTINCT pmid) FROM pmids").fetchone()[0]
+        return {'pages': pages, 'blobs': blobs, 'pmids': pmids, 'bytes': size, 'stored_bytes': stored,
+                'shards': self.shard + 1}
+
+    def close(self):
+        self.conn.close()
+
+
+worker_archive = None
+
+
+def init_worker(archive_dir):
+    global worker_archive
+    worker_archive = PageArchive(archive_dir)
+
+
+def parse_pages(pages, link_url=PUBMED_URL, parser='lxml'):
+    # (rows, URLs that failed to parse) of a chunk of (url, hash, kind, encoding, pmid) archived pages; runs in
+    # a worker process.
+    rows, failed = [], []
+    for url, key, kind, encoding, pmid in pages:
+        try:
+            content = worker_archive.read(key)
+            if kind == 'article':
+                fields = parse_article_page(content.decode(encoding or 'utf-8', errors='replace'), parser)
+                if fields is not None:
+                    title, abstract, keywords, year, doi = fields
+                    rows.append([pmid, title, abstract, keywords, year, url, doi])
+            elif kind == 'efetch':
+                rows.extend(iter_efetch(content, link_url))
+        except Exception:
+            failed.append(url)
+    return rows, failed
+
+
+def reparse(archive_dir, csv_file_name, workers=None, chunk_size=256, link_url=PUBMED_URL, parser='lxml'):
+    # Rebuilds the scraper CSV from the archived article pages and efetch responses with the current parsers,
+    # in parallel worker processes; a PMID is written once, in the order its page was archived. Returns the
+    # number of rows written and the URLs that could not be parsed.
+    archive = PageArchive(archive_dir)
+    pages = archive.iter_pages(['article', 'efetch'])
+    archive.close()
+
+    chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+    written, seen, failed = 0, set(), []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(archive_dir,)) as executor, \
+            open(csv_file_name, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(COLUMNS)
+        for rows, chunk_failed in executor.map(parse_pages, chunks, [link_url] * len(chunks), [parser] * len(chunks)):
+            failed.extend(chunk_failed)
+            for row in rows:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    csv_writer.writerow(row)
+                    written += 1
+    return written, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or re-parse the raw PubMed page archive",
+                                     prog="PubMed Page Archive",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    reparse_parser = subparsers.add_parser("reparse", help="rebuild the CSV from the archived pages",
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    reparse_parser.add_argument("--archive_dir", type=str, default='./data_preparation/input/datasets/Nipah/raw_pages')
+    reparse_parser.add_argument("--output", type=str, default='./data_preparation/input/datasets/Nipah/Nipah_reparsed.csv')
+    reparse_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    reparse_parser.add_argument("--chunk_size", type=int, default=256)
+    reparse_parser.add_argument("--link_url", type=str, default=PUBMED_URL, help="base of the Link column for efetch pages")
+    reparse_parser.add_argument("--parser", type=str, default='lxml', choices=PARSERS, help="article page parser")
+    stats_parser = subparsers.add_parser("stats", help="print what the archive holds")
+    stats_parser.add_argument("--archive_dir", type=str, default='./data_preparation/input/datasets/Nipah/raw_pages')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        archive = PageArchive(args.archive_dir)
+        print(archive.stats())
+        archive.close()
+        return
+
+    start = time.perf_counter()
+    written, failed = reparse(args.archive_dir, args.output, args.workers, args.chunk_size, args.link_url, args.parser)
+    print(f"Wrote {written} articles to {args.output} in {time.perf_counter() - start:.1f} s.")
+    for url in failed:
+        print(f"Could not parse {url}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import io
+import re
+import asyncio
+import xml.etree.ElementTree as ET
+from pubmed_scraper import AsyncScraper, get_page_url
+from query_planner import RESULT_CAP
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+PUBMED_URL = "https://pubmed.ncbi.nlm.nih.gov"
+EFETCH_SIZE = 200
+
+
+def get_text(element):
+    if element is None:
+        return ''
+    return ''.join(element.itertext()).strip()
+
+
+def parse_esearch(xml):
+    # (Count, QueryKey, WebEnv) of an esearch response sent with usehistory=y.
+    root = ET.fromstring(xml)
+    error = root.find('ERROR')
+    if error is not None:
+        raise ValueError(f"esearch failed: {get_text(error)}")
+    return int(root.findtext('Count')), root.findtext('QueryKey'), root.findtext('WebEnv')
+
+
+def parse_pubmed_article(article, link_url=PUBMED_URL):
+    # The CSV row of a PubmedArticle element, with the values AsyncScraper reads from the article page, or None
+    # when it has no abstract. Labelled sections are written as "Label: text", as on the page.
+    citation = article.find('MedlineCitation')
+    pmid = citation.findtext('PMID').strip()
+    record = citation.find('Article')
+
+    title = get_text(record.find('ArticleTitle')) or get_text(record.find('VernacularTitle')) or 'Missing'
+
+    abstracts = []
+    for section in record.findall('Abstract/AbstractText'):
+        text = get_text(section)
+        label = section.get('Label')
+        abstracts.append(f"{label}: {text}" if label else text)
+    abstracts = [a for a in abstracts if a]
+    if len(abstracts) == 0:
+        return None
+    elif len(abstracts) == 1:
+        abstract = abstracts[0]
+    else:
+        abstract = " ".join(re.sub(r"\s{2,}", " ", a) for a in abstracts)
+
+    keywords = [get_text(k) for k in citation.findall('KeywordList/Keyword')]
+    keywords = [k for k in keywords if k]
+    keywords = f"Keywords: {'; '.join(keywords)}." if keywords else 'Missing'
+
+    pub_date = record.find('Journal/JournalIssue/PubDate')
+    year_text = '' if pub_date is None else (pub_date.findtext('Year') or pub_date.findtext('MedlineDate') or '')
+    m = re.match(r'\d{4}', year_text.strip())
+    year = m.group() if m else 'Missing'
+
+    doi = article.findtext("PubmedData/ArticleIdList/ArticleId[@IdType='doi']") or \
+        record.findtext("ELocationID[@EIdType='doi']")
+    doi = doi.strip() if doi else 'Missing'
+
+    return [pmid, title, abstract, keywords, year, f"{link_url}/{pmid}/", doi]
+
+
+def iter_efetch(xml, link_url=PUBMED_URL):
+    # Streams the rows of an efetch response; each PubmedArticle is cleared once read, so memory stays flat
+    # whatever the batch size.
+    for _, element in ET.iterparse(io.BytesIO(xml), events=('end',)):
+        if element.tag == 'PubmedArticle':
+            row = parse_pubmed_article(element, link_url)
+            element.clear()
+            if row is not None:
+                yield row
+        elif element.tag == 'PubmedBookArticle':
+            element.clear()
+
+
+class EutilsScraper(AsyncScraper):
+    # Bulk PubMed backend over the NCBI E-utilities. One esearch with usehistory=y stores the result set on the
+    # NCBI history server; efetch then reads it batch_size records at a time by WebEnv and query_key, so a
+    # request brings back up to 200 articles instead of one page. Batches are fetched concurrently under the
+    # same pooling, politeness limit, retries and failure log as AsyncScraper; NCBI allows 3 requests per
+    # second, 10 with an api_key.
+    def __init__(self, url: str = EUTILS_URL,
+                 link_url: str = PUBMED_URL,
+                 api_key: str = None,
+                 email: str = None,
+                 tool: str = 'LLM-drug-discovery',
+                 batch_size: int = EFETCH_SIZE,
+                 **kwargs) -> None:
+        super().__init__(url, **kwargs)
+        if not 0 < batch_size <= 10000:
+            raise ValueError("batch_size must be between 1 and 10000.")
+        self.link_url = link_url
+        self.batch_size = batch_size
+        self.common_params = {"db": "pubmed", "tool": tool}
+        if email:
+            self.common_params["email"] = email
+        if api_key:
+            self.common_params["api_key"] = api_key
+
+    async def esearch(self, term: str, **params):
+        # (Count, QueryKey, WebEnv) for term; extra params (e.g. mindate, maxdate) are passed to esearch.
+        # Never answered from the archive: a 304 would bring back a WebEnv the history server may have dropped.
+        query = {**self.common_params, "term": term, "usehistory": "y", "retmax": "0", **params}
+        xml = await self.fetch(f"{self.url}/esearch.fcgi", query, binary=True, kind='esearch', conditional=False)
+        if xml is None:
+            raise RuntimeError(f"esearch failed for {term!r}.")
+        return parse_esearch(xml)
+
+    async def get_efetch_rows(self, params, pmids=()):
+        # Rows of one efetch request, or None once it has been logged as failed (and pmids added to failed). A
+        # batch of a stored result set is keyed on the WebEnv of this run's esearch, so only a batch requested
+        # by PMID (the same URL in every run) is sent as a conditional request.
+        url = f"{self.url}/efetch.fcgi"
+        page_url = get_page_url(url, params)
+        xml = await self.fetch(url, params, binary=True, kind='efetch', pmids=pmids, conditional=bool(pmids))
+        if xml is None:
+            return None
+        rows = await self.parse(lambda data: list(iter_efetch(data, self.link_url)), xml, page_url, pmids=pmids)
+        if rows is not None and self.archive is not None:
+            await asyncio.to_thread(self.archive.add_pmids, page_url, [row[0] for row in rows])
+        return rows
+
+    async def efetch(self, query_key: str, web_env: str, retstart: int, retmax: int):
+        # Rows of records retstart .. retstart + retmax - 1 of a stored result set, or [] if the batch failed.
+        params = {**self.common_params, "query_key": query_key, "WebEnv": web_env,
+                  "retstart": str(retstart), "retmax": str(retmax), "retmode": "xml"}
+        rows = await self.get_efetch_rows(params)
+        if rows is None:
+            self.partial += 1
+            return []
+        return rows
+
+    async def efetch_pmids(self, pmids):
+        # Rows of the given PMIDs, or [] (and the PMIDs in failed) if the batch failed.
+        params = {**self.common_params, "id": ",".join(pmids), "retmode": "xml"}
+        return await self.get_efetch_rows(params, pmids) or []
+
+    async def get_result_count(self, term: str) -> int:
+        count, _, _ = await self.esearch(term)
+        return count
+
+    def fetch_batches(self, query_key: str, web_env: str, start: int, end: int):
+        return [asyncio.ensure_future(self.efetch(query_key, web_env, retstart, min(self.batch_size, end - retstart)))
+                for retstart in range(start, end, self.batch_size)]
+
+    async def scrape(self, csv_file_name: str, term: str, start: int = 0, end: int = None) -> int:
+        # Writes the CSV of AsyncScraper.scrape for records start .. min(Count, end) - 1 of the search, in search
+        # order; returns the number of articles written.
+        async with self.open_session():
+            count, query_key, web_env = await self.esearch(term)
+            end = count if end is None else min(count, end)
+            if start > 0 or end < count or count > RESULT_CAP:
+                self.partial += 1
+            return await self.write_rows(csv_file_name, self.fetch_batches(query_key, web_env, start, end))
+
+    async def scrape_terms(self, csv_file_name: str, terms, counts=None) -> int:
+        # One esearch per term, then all their efetch batches and those of the PMIDs in retry concurrently; a
+        # PMID found by more than one term is written once. counts, if given, limits the records read per term.
+        async with self.open_session():
+            searches = await asyncio.gather(*[self.esearch(term) for term in terms])
+            if counts is None:
+                counts = [count for count, _, _ in searches]
+            batches = [batch for (count, query_key, web_env), limit in zip(searches, counts)
+                       for batch in self.fetch_batches(query_key, web_env, 0, min(count, limit))]
+            retry = sorted(self.retry)
+            batches += [asyncio.ensure_future(self.efetch_pmids(retry[i:i + self.batch_size]))
+                        for i in range(0, len(retry), self.batch_size)]
+            return await self.write_rows(csv_file_name, batches)
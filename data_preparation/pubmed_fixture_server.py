@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import re
+import hashlib
+import time
+import random
+import argparse
+import threading
+from html import escape
+from datetime import date
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIRST_PMID = 30000000
+WORDS = ['nipah', 'virus', 'drug', 'target', 'inhibitor', 'protein', 'fusion', 'glycoprotein', 'antiviral',
+         'screening', 'compound', 'replication', 'binding', 'assay', 'henipavirus', 'ribavirin', 'antibody']
+LABELS = ['Background', 'Methods', 'Results']
+WEB_ENV = 'MCID_fixture'
+XML = "text/xml; charset=UTF-8"
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+DATE_RANGE = re.compile(r'"(\d{4})/(\d{2})/(\d{2})"\[([^\]]+)\]\s*:\s*"(\d{4})/(\d{2})/(\d{2})"\[[^\]]+\]')
+
+
+def get_publication_date(pmid):
+    return date(2000 + pmid % 24, 1 + pmid // 24 % 12, 1 + pmid // 288 % 28)
+
+
+def get_search_html(n_results, page, pmids):
+    articles = ''.join(f'<div class="search-results-chunk"><article class="full-docsum"><div class="docsum-wrap">'
+                       f'<div class="docsum-content"><a class="docsum-title" href="/{pmid}/" data-article-id="{pmid}">'
+                       f'Article {pmid}</a></div></div></article></div>' for pmid in pmids)
+    return (f'<html><body><main id="search-results" class="search-results">'
+            f'<div class="top-wrapper"><div class="results-amount-container"><div class="results-amount">'
+            f'<span class="value">\n  {n_results:,}\n</span> results</div></div></div>'
+            f'<section class="search-results-list"><div class="search-results-chunks">{articles}</div></section>'
+            f'</main></body></html>')
+
+
+def get_article(pmid):
+    # Deterministic in the PMID. Every 7th article has no abstract (the scraper skips it), every 5th no keywords
+    # and every 11th no DOI, so each branch of the parsers is exercised. Abstracts of more than one paragraph
+    # are structured, with a label per paragraph.
+    rng = random.Random(pmid)
+    paragraphs = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))) for _ in range(rng.randint(1, 3))]
+    if len(paragraphs) > 1:
+        paragraphs = [(label, p) for label, p in zip(LABELS, paragraphs)]
+    else:
+        paragraphs = [(None, p) for p in paragraphs]
+    return {'pmid': pmid,
+            'title': f'Drug targets study {pmid}',
+            'paragraphs': paragraphs if pmid % 7 else [],
+            'keywords': [] if pmid % 5 == 0 else rng.sample(WORDS, 3),
+            'doi': None if pmid % 11 == 0 else f'10.1000/{pmid}',
+            'date': get_publication_date(pmid),
+            'year': 2000 + pmid % 24}
+
+
+def get_article_html(pmid):
+    article = get_article(pmid)
+    abstract = ''.join(f'<p>\n    <strong class="sub-title">\n      {label}:\n    </strong>\n    {escape(p)}\n  </p>'
+                       if label else f'<p>\n    {escape(p)}\n  </p>' for label, p in article['paragraphs'])
+    keywords = '' if not article['keywords'] else \
+        f'<p><strong class="sub-title">\n  Keywords:\n</strong>\n  {"; ".join(article["keywords"])}.\n</p>'
+    doi = '' if article['doi'] is None else \
+        f'<span class="identifier doi"><a class="id-link" href="https://doi.org/{article["doi"]}">{article["doi"]}</a></span>'
+    return (f'<html><body><header id="full-view-heading" class="full-view-heading">'
+            f'<h1 class="heading-title">\n  {article["title"]}\n</h1>'
+            f'<div class="article-citation"><div class="article-source">'
+            f'<span class="cit">{article["year"]} {MONTHS[article["date"].month - 1]} {article["date"].day};'
+            f'{pmid % 40}(2):1-9.</span></div></div>'
+            f'<ul class="identifiers">{doi}</ul></header>'
+            f'<div id="abstract" class="abstract"><h2 class="title">Abstract</h2>'
+            f'<div class="abstract-content selected" id="eng-abstract">{abstract}</div>{keywords}</div>'
+            f'</body></html>')
+
+
+def get_article_xml(pmid):
+    # The same article as a PubmedArticle element of an efetch response.
+    article = get_article(pmid)
+    abstract = ''.join(f'<AbstractText Label="{label}" NlmCategory="{label.upper()}">{escape(p)}</AbstractText>'
+                       if label else f'<AbstractText>{escape(p)}</AbstractText>' for label, p in article['paragraphs'])
+    abstract = f'<Abstract>{abstract}</Abstract>' if abstract else ''
+    keywords = ''.join(f'<Keyword MajorTopicYN="N">{k}</Keyword>' for k in article['keywords'])
+    keywords = f'<KeywordList Owner="NOTNLM">{keywords}</KeywordList>' if keywords else ''
+    location = '' if article['doi'] is None else f'<ELocationID EIdType="doi" ValidYN="Y">{article["doi"]}</ELocationID>'
+    doi = '' if article['doi'] is None else f'<ArticleId IdType="doi">{article["doi"]}</ArticleId>'
+    return (f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>'
+            f'<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><Volume>{pmid % 40}</Volume>'
+            f'<Issue>2</Issue><PubDate><Year>{article["year"]}</Year>'
+            f'<Month>{MONTHS[article["date"].month - 1]}</Month><Day>{article["date"].day}</Day></PubDate></JournalIssue>'
+            f'<Title>Journal of Fixtures</Title></Journal><ArticleTitle>{article["title"]}</ArticleTitle>'
+            f'{location}{abstract}</Article>{keywords}</MedlineCitation>'
+            f'<PubmedData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId>{doi}</ArticleIdList>'
+            f'</PubmedData></PubmedArticle>')
+
+
+def get_esearch_xml(count, query_key, web_env):
+    return (f'<?xml version="1.0" encoding="UTF-8" ?>\n'
+            f'<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+            f'"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+            f'<eSearchResult><Count>{count}</Count><RetMax>0</RetMax><RetStart>0</RetStart>'
+            f'<QueryKey>{query_key}</QueryKey><WebEnv>{web_env}</WebEnv><IdList></IdList></eSearchResult>')
+
+
+def get_efetch_xml(pmids):
+    return (f'<?xml version="1.0" ?>\n'
+            f'<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" '
+            f'"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n'
+            f'<PubmedArticleSet>{"".join(get_article_xml(pmid) for pmid in pmids)}</PubmedArticleSet>')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="text/html; charset=utf-8", headers=None):
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        time.sleep(max(0.0, server.latency + server.jitter * server.random('gauss', 0, 1)))
+
+        draw = server.random('random')
+        if draw < server.error_429:
+            server.count('429')
+            return self.send_body(429, "Too Many Requests", headers={"Retry-After": "1"})
+        if draw < server.error_429 + server.error_5xx:
+            status = server.random('choice', [500, 502, 503])
+            server.count(str(status))
+            return self.send_body(status, "Server error (fixture).")
+
+        response = server.get_response(self.path)
+        if response is None:
+            server.count('404')
+            return self.send_body(404, f"Unknown path {self.path}.")
+        # Every response carries an ETag, so conditional requests for an unchanged page get an empty 304.
+        body, content_type = response
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            server.count('304')
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        server.count('200')
+        self.send_body(200, data, content_type, headers={"ETag": etag})
+
+
+class PubMedFixtureServer(ThreadingHTTPServer):
+    # Local stand-in for pubmed.ncbi.nlm.nih.gov and its E-utilities: search pages (10 results each), article
+    # pages, esearch and efetch, generated in PubMed's markup or read from fixture_dir when a saved file exists.
+    # A date range in the term restricts the results by publication or entry date (the last n_new articles were
+    # entered today). Counts are exact, but only the first result_cap results can be read. Failures and stats
+    # work as in model/mock_server.py.
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, n_results=57, fixture_dir=None,
+                 latency=0.05, jitter=0.01, error_429=0.0, error_5xx=0.0, seed=123, result_cap=10000, n_new=0):
+        super().__init__((host, port), FixtureHandler)
+        self.n_results = n_results
+        self.result_cap = result_cap
+        self.dates = [get_publication_date(FIRST_PMID + i) for i in range(n_results)]
+        self.entry_dates = self.dates[:n_results - n_new] + [date.today()] * min(n_new, n_results)
+        self.history = {}
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def random(self, method, *args):
+        with self.lock:
+            return getattr(self.rng, method)(*args)
+
+    def read_fixture(self, name):
+        if self.fixture_dir is None:
+            return None
+        path = os.path.join(self.fixture_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def search(self, term):
+        # PMIDs matching term, in PMID order.
+        m = DATE_RANGE.search(term or '')
+        if m is None:
+            return list(range(FIRST_PMID, FIRST_PMID + self.n_results))
+        groups = m.groups()
+        start = date(*map(int, groups[:3]))
+        end = date(*map(int, groups[4:]))
+        dates = self.entry_dates if groups[3].lower() in ('date - entry', 'edat') else self.dates
+        return [FIRST_PMID + i for i, d in enumerate(dates) if start <= d <= end]
+
+    def get_response(self, path):
+        # (body, content type) for a request path, or None.
+        parts = urlsplit(path)
+        segments = [s for s in parts.path.split('/') if s]
+        if segments[:2] == ['entrez', 'eutils'] and len(segments) == 3:
+            return self.get_eutils_response(segments[2], parse_qs(parts.query))
+        if not segments:
+            query = parse_qs(parts.query)
+            page = max(1, int(query.get('page', ['1'])[0]))
+            fixture = self.read_fixture(f'search_{page}.html')
+            if fixture is not None:
+                return fixture, "text/html; charset=utf-8"
+            pmids = self.search(query.get('term', [''])[0])
+            first = (page - 1) * 10
+            return get_search_html(len(pmids), page, pmids[first:min(first + 10, self.result_cap)]), "text/html; charset=utf-8"
+        if len(segments) == 1 and segments[0].isdigit():
+            fixture = self.read_fixture(f'{segments[0]}.html')
+            if fixture is not None:
+                return fixture, "text/html; charset=utf-8"
+            pmid = int(segments[0])
+            if not FIRST_PMID <= pmid < FIRST_PMID + self.n_results:
+                return None
+            return get_article_html(pmid), "text/html; charset=utf-8"
+        return None
+
+    def get_eutils_response(self, endpoint, query):
+        if endpoint == 'esearch.fcgi':
+            fixture = self.read_fixture('esearch.xml')
+            if fixture is not None:
+                return fixture, XML
+            pmids = self.search(query.get('term', [''])[0])
+            with self.lock:
+                query_key = str(len(self.history) + 1)
+                self.history[query_key] = pmids
+            return get_esearch_xml(len(pmids), query_key, WEB_ENV), XML
+        if endpoint == 'efetch.fcgi':
+            retstart = int(query.get('retstart', ['0'])[0])
+            fixture = self.read_fixture(f'efetch_{retstart}.xml')
+            if fixture is not None:
+                return fixture, XML
+            if 'id' in query:
+                pmids = [int(pmid) for pmid in query['id'][0].split(',') if pmid.strip().isdigit()]
+                return get_efetch_xml([p for p in pmids if FIRST_PMID <= p < FIRST_PMID + self.n_results]), XML
+            pmids = self.history.get(query.get('query_key', [None])[0])
+            if query.get('WebEnv', [None])[0] != WEB_ENV or pmids is None:
+                return None
+            retmax = int(query.get('retmax', ['20'])[0])
+            return get_efetch_xml(pmids[retstart:min(retstart + retmax, self.result_cap)]), XML
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local PubMed fixture server",
+                                     prog="PubMed Fixture Server",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--n_results", type=int, default=57)
+    parser.add_argument("--fixture_dir", type=str, default=None)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error_429", type=float, default=0.0)
+    parser.add_argument("--error_5xx", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--result_cap", type=int, default=10000)
+    parser.add_argument("--n_new", type=int, default=0)
+    args = parser.parse_args()
+
+    server = PubMedFixtureServer(args.host, args.port, n_results=args.n_results, fixture_dir=args.fixture_dir,
+                                 latency=args.latency, jitter=args.jitter, error_429=args.error_429,
+                                 error_5xx=args.error_5xx, seed=args.seed, result_cap=args.result_cap, n_new=args.n_new)
+    print(f"Serving PubMed fixtures at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import re
+from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
+
+COLUMNS = ['PMID', 'Title', 'Abstract', 'Keyword', 'Year', 'Link', 'DOI']
+PARSERS = ['lxml', 'bs4']
+
+
+def get_soup(html):
+    return BeautifulSoup(html, "lxml")
+
+
+def parse_result_count(search_soup):
+    results = search_soup.select(
+        '#search-results > div.top-wrapper > div.results-amount-container > div.results-amount > span')
+    results = results[0].text
+    if len(results) != 0:
+        return int(str(results).replace("\n", "").replace(",", ""))
+    return 0
+
+
+def get_page_count(n_results):
+    if n_results % 10 == 0:
+        return n_results / 10
+    return int(n_results / 10) + 1
+
+
+def parse_result_links(result_soup, url):
+    # (PMID, article link) of every result on a search page.
+    links = result_soup.select('#search-results > section > div.search-results-chunks > div > article > div.docsum-wrap > div.docsum-content > a')
+    articles = []
+    for link in links:
+        id_soup = link.get("data-article-id")
+        if (id_soup is None) or len(id_soup) < 1:
+            continue
+        link_soup = link.get("href")
+        if (link_soup is None) or len(link_soup) < 1:
+            continue
+        articles.append((id_soup.strip(), url + link_soup))
+    return articles
+
+
+def parse_article(article_soup):
+    # [Title, Abstract, Keyword, Year, DOI] of an article page, or None when it has no English abstract.
+    title_soup = article_soup.select('#full-view-heading > h1')
+    if title_soup is None:
+        title = "Missing"
+    elif len(title_soup)<1:
+        title = "Missing"
+    else:
+        title = title_soup[0].text.strip()
+
+    abstracts = article_soup.select('#eng-abstract > p')
+    if (abstracts is None):
+        return None
+    elif (len(abstracts) == 0):
+        return None
+    elif len(abstracts) == 1:
+        abstract = abstracts[0].text.strip()
+    else:
+        abstract_ls = []
+        for ab in abstracts:
+            paragraph = re.sub(r"\s{2,}", " ", ab.text.strip())
+            abstract_ls.append(paragraph)
+        abstract = " ".join(abstract_ls)
+
+    key_paragraph= article_soup.find('div', class_= 'abstract').find('strong', class_ ='sub-title', string = re.compile('Keywords'))
+    if key_paragraph is None:
+        keywords = 'Missing'
+    else:
+        keywords = re.sub(r"\s{2,}", " ", key_paragraph.parent.text.strip())
+
+    year_soup = article_soup.select('#full-view-heading > div.article-citation > div.article-source > span.cit')
+    if (year_soup is None):
+        year = 'Missing'
+    elif (len(year_soup)<1):
+        year = 'Missing'
+    else:
+        year_text = year_soup[0].text.strip()
+        p = re.compile(r'\d{4}')
+        m = re.match(p, year_text)
+        if m:
+            year = m.group().strip()
+        else:
+            year = 'Missing'
+
+    doi_soup = article_soup.find("span", class_='identifier doi')
+    if (doi_soup is None) :
+        doi = "Missing"
+    elif (len(doi_soup)<1):
+        doi = "Missing"
+    else:
+        doi = doi_soup.find("a", class_='id-link').text.strip()
+
+    return [title, abstract, keywords, year, doi]
+
+
+def has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# The selectors of parse_article as XPath, compiled once.
+TITLE_XPATH = etree.XPath('//*[@id="full-view-heading"]/h1')
+ABSTRACT_XPATH = etree.XPath('//*[@id="eng-abstract"]/p')
+ABSTRACT_DIV_XPATH = etree.XPath(f'(//div[{has_class("abstract")}])[1]')
+SUB_TITLE_XPATH = etree.XPath(f'.//strong[{has_class("sub-title")}]')
+CITATION_XPATH = etree.XPath(f'//*[@id="full-view-heading"]/div[{has_class("article-citation")}]'
+                             f'/div[{has_class("article-source")}]/span[{has_class("cit")}]')
+DOI_XPATH = etree.XPath('(//span[@class="identifier doi"])[1]')
+DOI_LINK_XPATH = etree.XPath(f'(.//a[{has_class("id-link")}])[1]')
+HTML_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+
+
+def get_tree(html):
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    return lxml_html.document_fromstring(html, parser=HTML_PARSER)
+
+
+def count_children(element):
+    # len() of the BeautifulSoup tag: child elements plus text nodes.
+    return (1 if element.text else 0) + sum(1 + (1 if child.tail else 0) for child in element)
+
+
+def get_string(element):
+    # The BeautifulSoup .string of element: its text if that is its only child, recursing into a single child
+    # element, otherwise None.
+    if len(element) == 0:
+        return element.text or None
+    if len(element) == 1 and not element.text and not element[0].tail:
+        return get_string(element[0])
+    return None
+
+
+def parse_article_lxml(html):
+    # parse_article with compiled lxml XPath expressions on one parse of the page; returns identical values
+    # about ten times faster.
+    tree = get_tree(html)
+    title_soup = TITLE_XPATH(tree)
+    if len(title_soup) < 1:
+        title = "Missing"
+    else:
+        title = title_soup[0].text_content().strip()
+
+    abstracts = ABSTRACT_XPATH(tree)
+    if len(abstracts) == 0:
+        return None
+    elif len(abstracts) == 1:
+        abstract = abstracts[0].text_content().strip()
+    else:
+        abstract = " ".join(re.sub(r"\s{2,}", " ", ab.text_content().strip()) for ab in abstracts)
+
+    abstract_div = ABSTRACT_DIV_XPATH(tree)
+    if len(abstract_div) == 0:
+        raise AttributeError("The page has an abstract but no div.abstract.")
+    key_paragraph = None
+    for strong in SUB_TITLE_XPATH(abstract_div[0]):
+        string = get_string(strong)
+        if string is not None and re.search('Keywords', string):
+            key_paragraph = strong
+            break
+    if key_paragraph is None:
+        keywords = 'Missing'
+    else:
+        keywords = re.sub(r"\s{2,}", " ", key_paragraph.getparent().text_content().strip())
+
+    year_soup = CITATION_XPATH(tree)
+    if len(year_soup) < 1:
+        year = 'Missing'
+    else:
+        m = re.match(r'\d{4}', year_soup[0].text_content().strip())
+        year = m.group().strip() if m else 'Missing'
+
+    doi_soup = DOI_XPATH(tree)
+    if len(doi_soup) == 0 or count_children(doi_soup[0]) < 1:
+        doi = "Missing"
+    else:
+        doi_link = DOI_LINK_XPATH(doi_soup[0])
+        if len(doi_link) == 0:
+            raise AttributeError("span.identifier.doi has no a.id-link.")
+        doi = doi_link[0].text_content().strip()
+
+    return [title, abstract, keywords, year, doi]
+
+
+def parse_article_page(html, parser='lxml'):
+    # parse_article of an article page's HTML, with the lxml XPath parser or BeautifulSoup.
+    if parser == 'lxml':
+        return parse_article_lxml(html)
+    if parser == 'bs4':
+        return parse_article(get_soup(html))
+    raise ValueError(f"parser must be one of {PARSERS}.")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import csv
+import time
+import random
+import asyncio
+import aiohttp
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlencode
+import sys
+sys.path.insert(0, './model')
+from rate_limiter import RateLimiter
+from pubmed_pages import COLUMNS, get_soup, parse_result_count, get_page_count, parse_result_links, parse_article_page
+
+HEADER = {
+    "user-agent":
+"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/536.3 (KHTML, like Gecko) Chrome/19.0.1063.0 Safari/536.3"
+}
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# Query parameters that identify the user (e.g. the NCBI api_key), left out of the URLs archived and logged.
+PRIVATE_PARAMS = {'api_key', 'email'}
+
+
+def get_page_url(url, params=None):
+    if params is None:
+        return url
+    return f"{url}?{urlencode({k: v for k, v in params.items() if k not in PRIVATE_PARAMS})}"
+
+
+class HostLimiter:
+    # One RateLimiter bucket per host, so requests to each site are spaced by 60 / rpm seconds (burst allows that
+    # many back to back) whatever the concurrency. With state_path the buckets are shared by every process.
+    def __init__(self, rpm: float, burst: float = 1, state_path: str = None) -> None:
+        self.rpm = rpm
+        self.burst = burst
+        self.state_path = state_path
+        self.limiters = {}
+
+    def get(self, url: str) -> RateLimiter:
+        host = urlsplit(url).netloc
+        if host not in self.limiters:
+            self.limiters[host] = RateLimiter(rpm=self.rpm, state_path=self.state_path, name=host, burst=self.burst)
+        return self.limiters[host]
+
+    async def acquire(self, url: str) -> None:
+        await self.get(url).acquire_async()
+
+
+class FailureLog:
+    # Append-only CSV of the URLs that could not be fetched or parsed, with the reason.
+    header = ['Time', 'URL', 'Stage', 'Status', 'Attempts', 'Error']
+
+    def __init__(self, log_path: str) -> None:
+        self.log_path = log_path
+        self.count = 0
+        log_dir = os.path.dirname(log_path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        new_file = not os.path.exists(log_path) or os.path.getsize(log_path) == 0
+        self.file = open(log_path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.header)
+            self.file.flush()
+
+    def log(self, url, stage, status=None, attempts=0, error=''):
+        self.count += 1
+        self.writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), url, stage, status, attempts, str(error)[:500]])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class AsyncScraper:
+    # Fetches search and article pages over one pooled aiohttp session, at most `concurrency` requests in flight
+    # and each host paced by `limiter`. A request that fails with a connection error, a timeout, 408, 429 or 5xx
+    # is retried with exponential backoff and jitter (Retry-After is honoured); once max_retries is used up, or
+    # on any other status, the URL goes to the failure log instead of being dropped silently.
+    def __init__(self, url: str,
+                 header: dict = None,
+                 limiter: HostLimiter = None,
+                 concurrency: int = 8,
+                 max_retries: int = 4,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 timeout: float = 30.0,
+                 failure_log: FailureLog = None,
+                 archive=None,
+                 conditional: bool = True,
+                 article_parser: str = 'lxml') -> None:
+        self.url = url
+        self.header = header or HEADER
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.failure_log = failure_log
+        # A PageArchive keeps the raw body of every page fetched with a kind; with conditional, a page already
+        # archived is requested with If-None-Match / If-Modified-Since and read back from the archive on 304.
+        self.archive = archive
+        self.conditional = conditional
+        self.not_modified = 0
+        self.article_parser = article_parser
+        self.session = None
+        self.semaphore = None
+        # PMIDs the dataset already has: never written, and with the HTML backend not even fetched.
+        self.known = set()
+        # PMIDs to fetch directly in scrape_terms, besides the search results (the failures of earlier runs).
+        self.retry = set()
+        # PMIDs whose article could not be fetched or parsed, and the number of times the results of a search
+        # were read only in part (a search page or efetch batch failed, or only a range of them was asked for).
+        self.failed = set()
+        self.partial = 0
+
+    def log_failure(self, url, stage, status=None, attempts=0, error=''):
+        if self.failure_log is not None:
+            self.failure_log.log(url, stage, status, attempts, error)
+
+    def get_delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff * 2 ** attempt * (1 + random.random()), self.max_backoff)
+
+    async def fetch(self, url: str, params: dict = None, binary: bool = False, kind: str = None, pmids=(),
+                    conditional: bool = True):
+        # Returns the page text (bytes if binary), or None once the URL has been logged as failed (and pmids
+        # added to failed). Pages with a kind ('search', 'article', 'esearch', 'efetch') are archived under their
+        # URL without PRIVATE_PARAMS, with pmids. conditional=False never sends a conditional request, for pages
+        # whose URL is not stable from one run to the next or whose old copy must not be reused.
+        page_url = get_page_url(url, params)
+        headers, cached = self.header, None
+        if self.archive is not None and kind is not None and self.conditional and conditional:
+            cached = await asyncio.to_thread(self.archive.get_page, page_url)
+            if cached is not None and (cached[2] or cached[3]):
+                headers = dict(self.header)
+                if cached[2]:
+                    headers['If-None-Match'] = cached[2]
+                if cached[3]:
+                    headers['If-Modified-Since'] = cached[3]
+
+        status, error = None, ''
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                if self.limiter is not None:
+                    await self.limiter.acquire(url)
+                try:
+                    async with self.session.get(url, params=params, headers=headers) as response:
+                        status = response.status
+                        if status == 200:
+                            body, encoding = await response.read(), response.charset or 'utf-8'
+                            if self.archive is not None and kind is not None:
+                                await asyncio.to_thread(self.archive.put, page_url, body, kind, encoding,
+                                                        response.headers.get('ETag'),
+                                                        response.headers.get('Last-Modified'), pmids)
+                            return body if binary else body.decode(encoding, errors='replace')
+                        if status == 304 and cached is not None:
+                            self.not_modified += 1
+                            body, encoding = cached[0], cached[1] or 'utf-8'
+                            return body if binary else body.decode(encoding, errors='replace')
+                        retry_after = response.headers.get('Retry-After')
+                        error = f"HTTP {status}"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status, error = None, repr(e)
+            if status is not None and status not in RETRY_STATUSES:
+                break
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.get_delay(attempt, retry_after))
+
+        self.log_failure(page_url, 'fetch', status, attempt + 1, error)
+        self.failed.update(pmids)
+        return None
+
+    async def parse(self, parser, html, url, *args, pmids=()):
+        # parser(html, *args) runs in a worker thread so responses keep arriving while a page is parsed. On an
+        # exception the URL is logged, pmids are added to failed and None is returned.
+        try:
+            return await asyncio.to_thread(parser, html, *args)
+        except Exception as e:
+            self.log_failure(url, 'parse', 200, 1, repr(e))
+            self.failed.update(pmids)
+            return None
+
+    @asynccontextmanager
+    async def open_session(self):
+        # One pooled session for everything fetched inside the block; nested blocks reuse it.
+        if self.session is not None:
+            yield self.session
+            return
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+                yield self.session
+        finally:
+            self.session = None
+
+    async def get_result_count(self, term: str) -> int:
+        html = await self.fetch(self.url, {"term": term}, kind='search')
+        if html is None:
+            raise RuntimeError(f"Could not read the number of results for {term!r}.")
+        return await self.parse(lambda page: parse_result_count(get_soup(page)), html, self.url) or 0
+
+    async def scrape_page(self, term: str, page: int):
+        html = await self.fetch(self.url, {"term": term, "page": str(page)}, kind='search')
+        links = None if html is None else await self.parse(lambda text: parse_result_links(get_soup(text), self.url),
+                                                           html, f"{self.url}/?page={page}")
+        if links is None:
+            self.partial += 1
+            return []
+        return links
+
+    async def scrape_article(self, pmid: str, article_link: str):
+        html = await self.fetch(article_link, kind='article', pmids=[pmid])
+        if html is None:
+            return None
+        fields = await self.parse(parse_article_page, html, article_link, self.article_parser, pmids=[pmid])
+        if fields is None:
+            return None
+        title, abstract, keywords, year, doi = fields
+        return [pmid, title, abstract, keywords, year, article_link, doi]
+
+    def scrape_articles(self, articles):
+        # Starts fetching (PMID, link) pairs, each new PMID once; returns one awaitable per article, in order,
+        # giving its rows for write_rows (none when it failed or has no abstract).
+        seen, tasks = set(self.known), []
+        for pmid, article_link in articles:
+            if pmid not in seen:
+                seen.add(pmid)
+                tasks.append(asyncio.ensure_future(self.scrape_article(pmid, article_link)))
+        return [self.get_rows(task) for task in tasks]
+
+    async def get_rows(self, task):
+        row = await task
+        return [] if row is None else [row]
+
+    async def write_rows(self, csv_file_name: str, batches) -> int:
+        # Awaits each batch of rows in order and writes the rows of PMIDs not written or known yet; returns their
+        # number.
+        written, seen = 0, set(self.known)
+        with open(csv_file_name, 'w', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(COLUMNS)
+            for batch in batches:
+                for row in await batch:
+                    if row[0] not in seen:
+                        seen.add(row[0])
+                        csv_writer.writerow(row)
+                        written += 1
+        return written
+
+    async def scrape(self, csv_file_name: str, term: str, start_page: int, end_page: int = None) -> int:
+        # Writes the CSV of the original sequential scraper for pages start_page .. min(result pages, end_page) - 1,
+        # rows in search-result order; returns the number of articles written. A PMID listed twice is fetched once.
+        async with self.open_session():
+            count = await self.get_result_count(term)
+            result_pages = get_page_count(count)
+            end_page = result_pages if end_page is None else min(result_pages, end_page)
+            pages = await asyncio.gather(*[self.scrape_page(term, page) for page in range(start_page, int(end_page))])
+            articles = [article for links in pages for article in links]
+            # Fewer links than results: pages outside start_page .. end_page, or past the result cap.
+            if len(articles) < count:
+                self.partial += 1
+            return await self.write_rows(csv_file_name, self.scrape_articles(articles))
+
+    async def scrape_terms(self, csv_file_name: str, terms, counts=None) -> int:
+        # Writes every result of every term (e.g. the date slices of a QueryPlanner), pages 1 .. last, terms
+        # searched concurrently, then the PMIDs in retry; a PMID found by more than one term is fetched and
+        # written once. counts, if known, saves one search per term.
+        async with self.open_session():
+            if counts is None:
+                counts = await asyncio.gather(*[self.get_result_count(term) for term in terms])
+            pages = await asyncio.gather(*[self.scrape_page(term, page) for term, count in zip(terms, counts)
+                                           for page in range(1, int(get_page_count(count)) + 1)])
+            articles = [article for links in pages for article in links]
+            articles += [(pmid, f"{self.url}/{pmid}/") for pmid in sorted(self.retry)]
+            return await self.write_rows(csv_file_name, self.scrape_articles(articles))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import asyncio
+from datetime import date, datetime, timedelta
+
+RESULT_CAP = 10000
+DATE_FORMAT = '%Y/%m/%d'
+MIN_DATE = date(1800, 1, 1)
+# Open upper bound, as PubMed's own searches use: papers dated ahead of today (e.g. an issue due next year)
+# still fall in the last slice.
+MAX_DATE = date(3000, 12, 31)
+PUBLICATION_DATE = 'Date - Publication'
+ENTRY_DATE = 'Date - Entry'
+
+
+def parse_date(text):
+    return datetime.strptime(text, DATE_FORMAT).date()
+
+
+def get_date_term(term, start, end, field=PUBLICATION_DATE):
+    return f'({term}) AND ("{start:%Y/%m/%d}"[{field}] : "{end:%Y/%m/%d}"[{field}])'
+
+
+class QueryPlanner:
+    # PubMed pages through, and efetch returns, only the first 10,000 results of a search, so a broad term is
+    # silently truncated. The planner splits the term by publication date: a date range with more results than
+    # the cap is halved, both halves counted concurrently, until every slice fits. The slice terms can then be
+    # crawled concurrently with scrape_terms, which writes each PMID once (a paper whose print and electronic
+    # dates differ can fall in two slices). A single day still over the cap cannot be split further; it is kept
+    # and listed in truncated. field can be ENTRY_DATE to split by the date papers were added to PubMed.
+    def __init__(self, count, cap: int = RESULT_CAP, min_date: date = MIN_DATE, max_date: date = MAX_DATE,
+                 field: str = PUBLICATION_DATE) -> None:
+        # count is a coroutine function giving the number of results of a term, e.g. a scraper's get_result_count.
+        self.count = count
+        self.cap = cap
+        self.min_date = min_date
+        self.max_date = max_date or MAX_DATE
+        self.field = field
+        self.truncated = []
+        self.slices = []
+        self.searches = 0
+
+    async def get_count(self, term):
+        self.searches += 1
+        return await self.count(term)
+
+    async def plan(self, term, date_range: bool = False):
+        # [(slice term, count)] in date order, empty slices left out. Unless date_range is set, a term already
+        # under the cap is returned as it is, without min_date and max_date.
+        if date_range:
+            return await self.split(term, self.min_date, self.max_date)
+        count = await self.get_count(term)
+        if count <= self.cap:
+            return [(term, count)] if count > 0 else []
+        return await self.split(term, self.min_date, self.max_date)
+
+    async def split(self, term, start, end):
+        date_term = get_date_term(term, start, end, self.field)
+        count = await self.get_count(date_term)
+        if count == 0:
+            return []
+        if count <= self.cap:
+            return [(date_term, count)]
+        if start >= end:
+            self.truncated.append((date_term, count))
+            return [(date_term, count)]
+        middle = start + timedelta(days=(end - start).days // 2)
+        halves = await asyncio.gather(self.split(term, start, middle), self.split(term, middle + timedelta(days=1), end))
+        return halves[0] + halves[1]
+
+    async def crawl(self, scraper, csv_file_name, term, date_range: bool = False):
+        # Plans term and writes every article of every slice with scraper (AsyncScraper or EutilsScraper), in
+        # one session; returns the number of articles written.
+        async with scraper.open_session():
+            self.slices = await self.plan(term, date_range)
+            return await scraper.scrape_terms(csv_file_name, [t for t, _ in self.slices],
+                                              [min(c, self.cap) for _, c in self.slices])
@@ -4,6 +4,9 @@ import os
 import argparse
 import numpy as np
 from cross_validation import CrossValidation
+import sys
+sys.path.insert(0, './model')
+from embedding_store import EmbeddingStore
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
 
@@ -16,6 +19,8 @@ def main():
     parser.add_argument("--num_fold", type=int, default=5)
     parser.add_argument("--embedded_path", type=str, default='./data_preparation/output/datasets/Nipah/Nipah_pre_emb.npz')
     parser.add_argument("--save_dir", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets')
+    parser.add_argument("--dtype", type=str, default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument("--fold_npz", type=int, default=0)
 
     args = parser.parse_args()
     NFOLD = args.num_fold
@@ -28,6 +33,14 @@ def main():
     cv = CrossValidation(n_splits=NFOLD, save_path=SAVE_CROSS_DIR)
     splits = cv.load_splits(save_split_file = 'cross_validation_splits.pkl')
 
+    # One store for all folds; the fold rows are looked up from cross_validation_splits.pkl when they are read.
+    EmbeddingStore.create(os.path.join(SAVE_CROSS_DIR, 'embedding_store'),
+                          embeddings = embedding_data["embedding"],
+                          pmids = embedding_data["PMID"],
+                          dtype = args.dtype)
+    if not bool(args.fold_npz):
+        return
+
     for i, (train_index, test_index) in enumerate(splits):
         np.savez(os.path.join(SAVE_CROSS_DIR, f"embed_train_{i}.npz"),
                  embedding =  embedding_data["embedding"][train_index],
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import time
+import argparse
+import numpy as np
+from funs import load_embedding_file, get_embedding_file_identity
+RANDOM_STATE = 123
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def exact_search(vectors: np.ndarray, ids: np.ndarray, queries: np.ndarray, k: int):
+    similarities = normalize(queries) @ normalize(vectors).T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    return ids[top], np.take_along_axis(similarities, top, axis=1)
+
+
+def recall_at_k(approx_ids: np.ndarray, exact_ids: np.ndarray) -> float:
+    return float(np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approx_ids, exact_ids)]))
+
+
+class IVFIndex:
+    # Inverted-file index for cosine search. Normalized vectors are assigned to the nearest of nlist spherical
+    # k-means centroids and stored grouped by list; a query is scored only against the vectors of its nprobe
+    # nearest lists. New vectors are assigned to the existing centroids, so the index grows without retraining.
+    # source is a free-form description of the data the vectors came from, saved with the index so a caller can
+    # tell when the index is stale.
+    def __init__(self, nlist: int = None, nprobe: int = 8, n_iter: int = 20, seed: int = RANDOM_STATE,
+                 source: str = '') -> None:
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.source = source
+        self.centroids = None
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.lists = np.empty(0, dtype=np.int64)
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def train(self, vectors: np.ndarray) -> None:
+        rng = np.random.default_rng(self.seed)
+        nlist = self.nlist or max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), 256 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(self.n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for ix in range(nlist):
+                members = sample[assignments == ix]
+                centroids[ix] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = normalize(centroids)
+        self.centroids = centroids
+        self.nlist = nlist
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        vectors, ids = normalize(vectors), np.asarray(ids, dtype=np.int64)
+        if self.centroids is None:
+            self.train(vectors)
+            self.vectors = np.empty((0, vectors.shape[1]), dtype=np.float32)
+        lists = np.argmax(vectors @ self.centroids.T, axis=1)
+
+        # Vectors are kept sorted by list so every list is one contiguous slice.
+        all_lists = np.concatenate([self.lists, lists])
+        order = np.argsort(all_lists, kind='stable')
+        self.vectors = np.concatenate([self.vectors, vectors])[order]
+        self.ids = np.concatenate([self.ids, ids])[order]
+        self.lists = all_lists[order]
+        self.offsets = np.searchsorted(self.lists, np.arange(self.nlist + 1))
+
+    def search(self, queries: np.ndarray, k: int):
+        # Returns (ids, scores) of shape (n_queries, k), best first; rows are padded with -1 / -inf when the
+        # probed lists hold fewer than k vectors.
+        queries = normalize(queries)
+        nprobe = min(self.nprobe, self.nlist)
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for qi, query in enumerate(queries):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probes[qi]])
+            similarities = self.vectors[rows] @ query
+            n = min(k, len(rows))
+            if n == 0:
+                continue
+            top = np.argpartition(-similarities, n - 1)[:n]
+            top = top[np.argsort(-similarities[top], kind='stable')]
+            ids[qi, :n] = self.ids[rows[top]]
+            scores[qi, :n] = similarities[top]
+        return ids, scores
+
+    def save(self, index_path: str) -> None:
+        with open(f"{index_path}.tmp", 'wb') as f:
+            np.savez(f, centroids=self.centroids, vectors=self.vectors, ids=self.ids, lists=self.lists,
+                     params=np.array([self.nlist, self.nprobe, self.n_iter, self.seed]), source=np.array(self.source))
+        os.replace(f"{index_path}.tmp", index_path)
+
+    @classmethod
+    def load(cls, index_path: str, nprobe: int = None):
+        data = np.load(index_path)
+        nlist, saved_nprobe, n_iter, seed = [int(p) for p in data['params']]
+        source = str(data['source']) if 'source' in data.files else ''
+        index = cls(nlist=nlist, nprobe=nprobe or saved_nprobe, n_iter=n_iter, seed=seed, source=source)
+        index.centroids = data['centroids']
+        index.vectors, index.ids, index.lists = data['vectors'], data['ids'], data['lists']
+        index.offsets = np.searchsorted(index.lists, np.arange(nlist + 1))
+        return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an IVF index and report recall@k",
+                                     prog="ANN Index",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--train_path", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets/general/embed_train_0.npz')
+    parser.add_argument("--test_path", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets/general/embed_test_0.npz')
+    parser.add_argument("--index_path", type=str, default=None)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=str, default='1,4,8,16')
+    parser.add_argument("--k", type=int, default=2)
+    args = parser.parse_args()
+
+    # embed_{train,test}_<fold>.npz paths are read from the embedding store when there is one.
+    (train_embeddings, train_ids), (test_embeddings, _) = load_embedding_file(args.train_path), load_embedding_file(args.test_path)
+    source = repr((get_embedding_file_identity(args.train_path), 'float32'))
+    start = time.perf_counter()
+    index = IVFIndex.load(args.index_path) if args.index_path and os.path.exists(args.index_path) else None
+    if index is not None and index.source == source:
+        missing = ~np.isin(train_ids, index.ids)
+        index.add(train_embeddings[missing], train_ids[missing])
+        print(f"Loaded {args.index_path}, added {missing.sum()} vectors.")
+    else:
+        index = IVFIndex(nlist=args.nlist or None, source=source)
+        index.add(train_embeddings, train_ids)
+    print(f"Index: {len(index)} vectors, {index.nlist} lists, {time.perf_counter() - start:.2f}s")
+    if args.index_path:
+        index.save(args.index_path)
+
+    start = time.perf_counter()
+    exact_ids, _ = exact_search(train_embeddings, train_ids, test_embeddings, args.k)
+    print(f"exact      {time.perf_counter() - start:8.3f}s")
+    for nprobe in [int(n) for n in args.nprobe.split(',')]:
+        index.nprobe = nprobe
+        start = time.perf_counter()
+        ids, _ = index.search(test_embeddings, args.k)
+        print(f"nprobe {nprobe:<3} {time.perf_counter() - start:8.3f}s  recall@{args.k} {recall_at_k(ids, exact_ids):.3f}")
+
+if __name__ == '__main__':
+    main()
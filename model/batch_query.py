@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os, time, json
+import requests
+import openai
+from funs import clean_text, MAX_TOKENS, TOP_P
+
+FINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+# The completion window is 24 h, after which the API expires the batch; polling stops an hour later.
+MAX_WAIT = 25 * 3600
+
+
+def get_custom_id(answer_col, fold, pmid):
+    return f"{answer_col}-{fold}-{pmid}"
+
+
+def get_request_line(custom_id, model, prompt, temperature):
+    if model == 'text-davinci-003':
+        url = "/v1/completions"
+        body = {"model": model, "prompt": prompt, "temperature": temperature,
+                "max_tokens": MAX_TOKENS, "top_p": TOP_P, "logprobs": 1}
+    else:
+        url = "/v1/chat/completions"
+        body = {"model": model, "messages": prompt, "temperature": temperature,
+                "max_tokens": MAX_TOKENS, "top_p": TOP_P}
+    return {"custom_id": custom_id, "method": "POST", "url": url, "body": body}
+
+
+def write_batch_requests(requests_path, request_lines):
+    os.makedirs(os.path.dirname(requests_path) or '.', exist_ok=True)
+    with open(requests_path, 'w') as f:
+        for line in request_lines:
+            f.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+
+def read_batch_results(results_path):
+    answers = {}
+    with open(results_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                answers[result['custom_id']] = None
+                continue
+            choice = response['body']['choices'][0]
+            text = choice['message']['content'] if 'message' in choice else choice['text']
+            answers[result['custom_id']] = clean_text(text.strip())
+    return answers
+
+
+class BatchClient:
+    def __init__(self, api_key=None, api_base=None, poll_interval=60, timeout=600, max_wait=MAX_WAIT):
+        self.api_key = api_key or openai.api_key
+        self.api_base = (api_base or openai.api_base).rstrip('/')
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {self.api_key}"})
+
+    def submit(self, requests_path, endpoint="/v1/chat/completions"):
+        with open(requests_path, 'rb') as f:
+            upload = self.session.post(f"{self.api_base}/files", data={"purpose": "batch"},
+                                       files={"file": (os.path.basename(requests_path), f)}, timeout=self.timeout)
+        upload.raise_for_status()
+        batch = self.session.post(f"{self.api_base}/batches",
+                                  json={"input_file_id": upload.json()['id'],
+                                        "endpoint": endpoint,
+                                        "completion_window": "24h"},
+                                  timeout=self.timeout)
+        batch.raise_for_status()
+        return batch.json()['id']
+
+    def retrieve(self, batch_id):
+        response = self.session.get(f"{self.api_base}/batches/{batch_id}", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def wait(self, batch_id, logger=None):
+        # Polls until the batch reaches a final status; after max_wait seconds it raises TimeoutError instead,
+        # and the batch can be reattached to with --resume 1.
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            batch = self.retrieve(batch_id)
+            if batch['status'] in FINAL_STATUSES:
+                return batch
+            if time.monotonic() + self.poll_interval > deadline:
+                raise TimeoutError(f"Batch {batch_id} is still {batch['status']} after {self.max_wait} s.")
+            if logger is not None:
+                logger.info(f"Batch {batch_id}: {batch['status']} {batch.get('request_counts')}")
+            time.sleep(self.poll_interval)
+
+    def download(self, batch, results_path):
+        with open(results_path, 'wb') as f:
+            for file_id in [batch.get('output_file_id'), batch.get('error_file_id')]:
+                if not file_id:
+                    continue
+                response = self.session.get(f"{self.api_base}/files/{file_id}/content", timeout=self.timeout)
+                response.raise_for_status()
+                f.write(response.content)
+                if not response.content.endswith(b'\n'):
+                    f.write(b'\n')
+        return results_path
+
+
+class LocalBatchClient:
+    # Offline stand-in for BatchClient: consumes the request JSONL at submit time and produces a result
+    # file in the Batch API output format, answering every request with `responder(body)`.
+    def __init__(self, responder=None, work_dir=None):
+        self.responder = responder or (lambda body: "No.")
+        self.work_dir = work_dir
+        self.outputs = {}
+
+    def submit(self, requests_path, endpoint="/v1/chat/completions"):
+        batch_id = f"batch_local_{int(time.time() * 1000)}"
+        output_path = os.path.join(self.work_dir or os.path.dirname(requests_path) or '.', f"{batch_id}_output.jsonl")
+        with open(requests_path, 'r') as f_in, open(output_path, 'w') as f_out:
+            for ix, line in enumerate(f_in):
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request['body'])
+                    if request['url'] == "/v1/completions":
+                        choice = {"index": 0, "text": content, "finish_reason": "stop"}
+                    else:
+                        choice = {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    result = {"id": f"{batch_id}_req_{ix}", "custom_id": request['custom_id'],
+                              "response": {"status_code": 200, "request_id": f"req_{ix}",
+                                           "body": {"object": "chat.completion", "model": request['body']['model'],
+                                                    "choices": [choice]}},
+                              "error": None}
+                except Exception as e:
+                    result = {"id": f"{batch_id}_req_{ix}", "custom_id": request['custom_id'], "response": None,
+                              "error": {"code": "local_error", "message": str(e)}}
+                f_out.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self.outputs[batch_id] = output_path
+        return batch_id
+
+    def wait(self, batch_id, logger=None):
+        if batch_id not in self.outputs:
+            return {"id": batch_id, "status": "expired"}
+        return {"id": batch_id, "status": "completed", "output_file_id": self.outputs[batch_id]}
+
+    def download(self, batch, results_path):
+        if os.path.abspath(batch['output_file_id']) != os.path.abspath(results_path):
+            os.replace(batch['output_file_id'], results_path)
+        return results_path
+
+
+def run_batch(jobs, client, output_folder, answer_col, logger, resume=False):
+    # jobs: (fold, gpt_model, test_df) per fold. All folds go into one request file and one batch; the answers
+    # are written back to the {answer_col}_{fold}.csv files that mapping_response.py reads. A batch that ends
+    # expired or cancelled still has the answers of the requests it finished; only the others are written as
+    # ERROR. The batch state file is kept until the answers are written, so --resume can reattach until then.
+    batch_dir = os.path.join(output_folder, answer_col)
+    requests_path = os.path.join(batch_dir, f"{answer_col}_batch_requests.jsonl")
+    results_path = os.path.join(batch_dir, f"{answer_col}_batch_results.jsonl")
+    state_path = os.path.join(batch_dir, f"{answer_col}_batch.json")
+
+    outputs = {}
+    request_lines = []
+    for fold, gpt_model, test_df in jobs:
+        csv_writer, csv_file = gpt_model.setup_output_directory(output_folder, answer_col, fold, resume=resume)
+        pending = gpt_model.get_pending_prompts(test_df, output_folder, answer_col, fold)
+        outputs[fold] = (gpt_model, csv_writer, csv_file, pending)
+        request_lines += [get_request_line(get_custom_id(answer_col, fold, row['PMID']), compiled.model_type,
+                                           compiled.prompt, gpt_model.temperature) for row, compiled in pending]
+
+    if request_lines:
+        batch_id = None
+        if resume and os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                batch_id = json.load(f)['batch_id']
+            logger.info(f"Reattaching to batch {batch_id}.")
+        if batch_id is None:
+            write_batch_requests(requests_path, request_lines)
+            batch_id = client.submit(requests_path, endpoint=request_lines[0]['url'])
+            with open(state_path, 'w') as f:
+                json.dump({"batch_id": batch_id, "requests_path": requests_path}, f)
+            logger.info(f"Submitted batch {batch_id} with {len(request_lines)} requests.")
+
+        batch = client.wait(batch_id, logger)
+        logger.info(f"Batch {batch_id} finished with status {batch['status']}.")
+        answers = {}
+        if batch.get('output_file_id') or batch.get('error_file_id'):
+            answers = read_batch_results(client.download(batch, results_path))
+        if batch['status'] != 'completed':
+            logger.warning(f"Batch {batch_id} is {batch['status']}: {sum(a is not None for a in answers.values())} of "
+                           f"{len(request_lines)} requests were answered.")
+    else:
+        answers = {}
+
+    for fold, (gpt_model, csv_writer, csv_file, pending) in outputs.items():
+        for row, compiled in pending:
+            answer = answers.get(get_custom_id(answer_col, fold, row['PMID']))
+            gpt_model.write_answer(csv_writer, row, compiled, 'ERROR' if answer is None else answer)
+        csv_writer.sync()
+        csv_file.close()
+    if os.path.exists(state_path):
+        os.remove(state_path)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import time
+import asyncio
+import argparse
+from funs import request_answer, arequest_answer, set_backend
+from llm_backend import make_backend
+from mock_server import MockServer
+
+
+def get_prompts(n):
+    return [[{"role": "user", "content": f"Paper {ix}: does the drug inhibit the virus?"}] for ix in range(n)]
+
+
+def run_sync(prompts, model):
+    failed = 0
+    for prompt in prompts:
+        try:
+            request_answer(model, prompt)
+        except Exception:
+            failed += 1
+    return failed
+
+
+async def run_async(backend, prompts, model, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(prompt):
+        async with semaphore:
+            try:
+                await arequest_answer(model, prompt)
+                return 0
+            except Exception:
+                return 1
+
+    async with backend.async_session(concurrency):
+        return sum(await asyncio.gather(*[query(prompt) for prompt in prompts]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLM backends",
+                                     prog="Backend Benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--backends", type=str, default='openai,http')
+    parser.add_argument("--concurrency", type=str, default='1,8,32')
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--gpt_model", type=str, default="gpt-3.5-turbo")
+    parser.add_argument("--api_base", type=str, default=None, help="Leave empty to start a local mock server.")
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error_429", type=float, default=0.0)
+    parser.add_argument("--error_5xx", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = None
+    api_base = args.api_base
+    if api_base is None:
+        server = MockServer(latency=args.latency, jitter=args.jitter,
+                            error_429=args.error_429, error_5xx=args.error_5xx).start()
+        api_base = server.url
+
+    prompts = get_prompts(args.requests)
+    print(f"{'backend':<8} {'concurrency':>11} {'seconds':>8} {'req/s':>8} {'failed':>6} {'connections':>11}")
+    for name in args.backends.split(','):
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            backend = make_backend(name, api_base=api_base, timeout=args.request_timeout,
+                                   pool_size=max(args.pool_size, concurrency))
+            set_backend(backend)
+            connections = server.stats.get('connections', 0) if server is not None else 0
+            start = time.perf_counter()
+            if concurrency > 1:
+                failed = asyncio.run(run_async(backend, prompts, args.gpt_model, concurrency))
+            else:
+                failed = run_sync(prompts, args.gpt_model)
+            seconds = time.perf_counter() - start
+            connections = server.stats.get('connections', 0) - connections if server is not None else '-'
+            print(f"{name:<8} {concurrency:>11} {seconds:>8.2f} {len(prompts) / seconds:>8.1f} {failed:>6} "
+                  f"{connections:>11}")
+
+    if server is not None:
+        server.stop()
+        print(server.stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import time
+import argparse
+import numpy as np
+from quantization import QuantizedMatrix
+RANDOM_STATE = 123
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def top_k(similarities, k):
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Top-k agreement of quantized embeddings with float64",
+                                     prog="Quantization Benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--embedded_paths", type=str,
+                        default='./data_preparation/output/datasets/Nipah/Nipah_pre_emb.npz,'
+                                './data_preparation/output/datasets/COVID/COVID_pre_emb.npz')
+    parser.add_argument("--dtypes", type=str, default='float32,float16,int8')
+    parser.add_argument("--k", type=str, default='1,2,5')
+    parser.add_argument("--n_queries", type=int, default=200)
+    args = parser.parse_args()
+
+    ks = [int(k) for k in args.k.split(',')]
+    print(f"{'dataset':<12} {'dtype':<8} {'bytes/vec':>9} {'seconds':>8} " + ' '.join(f"{f'top{k}':>7}" for k in ks))
+    for path in args.embedded_paths.split(','):
+        embeddings = normalize(np.load(path)["embedding"].astype(np.float64))
+
+        # Held-out papers are queried against the rest, as a test fold is queried against its training fold.
+        rng = np.random.default_rng(RANDOM_STATE)
+        query_rows = rng.choice(len(embeddings), min(args.n_queries, len(embeddings) // 2), replace=False)
+        corpus_rows = np.setdiff1d(np.arange(len(embeddings)), query_rows)
+        queries, corpus = embeddings[query_rows], embeddings[corpus_rows]
+        exact = top_k(queries @ corpus.T, max(ks))
+
+        name = path.split('/')[-1].split('_')[0]
+        for dtype in args.dtypes.split(','):
+            matrix = QuantizedMatrix(corpus, dtype)
+            start = time.perf_counter()
+            similarities = matrix.dot(queries)
+            seconds = time.perf_counter() - start
+            approx = top_k(similarities, max(ks))
+            agreement = [np.mean([len(set(a[:k]) & set(e[:k])) / k for a, e in zip(approx, exact)]) for k in ks]
+            print(f"{name:<12} {dtype:<8} {matrix.nbytes / len(matrix):>9.0f} {seconds:>8.3f} "
+                  + ' '.join(f"{a:>7.3f}" for a in agreement))
+
+if __name__ == '__main__':
+    main()
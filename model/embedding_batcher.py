@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import numpy as np
+from funs import get_embeddings, get_encoding, get_embedding_cache
+
+
+class EmbeddingBatcher:
+    # Packs texts into embedding requests that respect the per-input and per-request token limits. Texts are
+    # grouped by token length so each request carries abstracts of similar size.
+    def __init__(self,
+                 model: str = "text-embedding-ada-002",
+                 max_input_tokens: int = 8000,
+                 max_batch_tokens: int = 250000,
+                 max_batch_size: int = 2048,
+                 logger=None) -> None:
+
+        if max_input_tokens > max_batch_tokens:
+            raise ValueError("max_input_tokens must not exceed max_batch_tokens.")
+
+        self.model = model
+        self.max_input_tokens = max_input_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.logger = logger
+
+    def prepare_texts(self, texts):
+        encoding = get_encoding(self.model)
+        prepared, lengths = [], []
+        for text in texts:
+            tokens = encoding.encode(str(text))
+            if len(tokens) > self.max_input_tokens:
+                tokens = tokens[:self.max_input_tokens]
+                text = encoding.decode(tokens)
+            prepared.append(str(text))
+            lengths.append(len(tokens))
+        return prepared, np.array(lengths)
+
+    def make_batches(self, lengths):
+        batches, batch, batch_tokens = [], [], 0
+        for ix in np.argsort(lengths, kind='stable'):
+            if batch and (batch_tokens + lengths[ix] > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(int(ix))
+            batch_tokens += int(lengths[ix])
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed_batch(self, texts, batch, results, failed):
+        # Only the failing request is retried; if it still fails it is split in half until the offending input
+        # is isolated, so one bad abstract does not cost the rest of the batch.
+        try:
+            embeddings = get_embeddings([texts[i] for i in batch], model=self.model)
+        except Exception as e:
+            if len(batch) == 1:
+                if self.logger is not None:
+                    self.logger.error(f"Exception embedding occurred with row: {batch[0]}, error: {e}", exc_info=True)
+                failed.append(batch[0])
+                return
+            if self.logger is not None:
+                self.logger.warning(f"Embedding batch of {len(batch)} failed, splitting: {e}")
+            middle = len(batch) // 2
+            self.embed_batch(texts, batch[:middle], results, failed)
+            self.embed_batch(texts, batch[middle:], results, failed)
+            return
+
+        cache = get_embedding_cache()
+        if cache is not None:
+            embeddings = cache.put_many([texts[i] for i in batch], self.model, embeddings)
+        for ix, embedding in zip(batch, embeddings):
+            results[ix] = embedding
+
+    def embed(self, texts):
+        texts, lengths = self.prepare_texts(texts)
+        results, failed = {}, []
+
+        # Texts already in the embedding cache are served from it; only the rest are packed into requests.
+        cache = get_embedding_cache()
+        if cache is not None:
+            for ix, embedding in enumerate(cache.get_many(texts, self.model)):
+                if embedding is not None:
+                    results[ix] = embedding
+            if self.logger is not None:
+                self.logger.info(f"Embedding cache: {len(results)}/{len(texts)} texts found.")
+
+        missing = np.array([ix for ix in range(len(texts)) if ix not in results], dtype=int)
+        batches = [[int(missing[i]) for i in batch] for batch in self.make_batches(lengths[missing])]
+        for batch_ix, batch in enumerate(batches):
+            self.embed_batch(texts, batch, results, failed)
+            if self.logger is not None:
+                self.logger.info(f"Embedded batch {batch_ix + 1}/{len(batches)} ({len(batch)} texts).")
+        return [results.get(ix) for ix in range(len(texts))], sorted(failed)
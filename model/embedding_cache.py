@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os, re
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', str(text)).strip()
+
+
+def get_text_key(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    # Vectors are appended as float32 rows to one flat file that is read through np.memmap; a SQLite table maps
+    # (model, sha256 of the normalized text) to the row offset. Appends run inside BEGIN IMMEDIATE so several
+    # processes can share a cache directory.
+    def __init__(self, cache_dir: str, dim: int = 1536) -> None:
+        if not isinstance(cache_dir, str):
+            raise TypeError("cache_dir must be string.")
+
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.vector_path = os.path.join(cache_dir, f"vectors_{dim}.f32")
+        self.lock = threading.Lock()
+        self.vectors = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, f"index_{dim}.sqlite"), timeout=60,
+                                    isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                          "(model TEXT, text_hash TEXT, row INTEGER, PRIMARY KEY (model, text_hash))")
+        if not os.path.exists(self.vector_path):
+            open(self.vector_path, 'ab').close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_vectors(self, max_row):
+        if self.vectors is None or len(self.vectors) <= max_row:
+            rows = os.path.getsize(self.vector_path) // (4 * self.dim)
+            self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        return self.vectors
+
+    def get_many(self, texts, model):
+        keys = [get_text_key(text) for text in texts]
+        rows = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                query = (f"SELECT text_hash, row FROM embeddings WHERE model = ? "
+                         f"AND text_hash IN ({','.join('?' * len(chunk))})")
+                rows.update(self.conn.execute(query, [model] + chunk).fetchall())
+            if not rows:
+                return [None] * len(keys)
+            vectors = self.get_vectors(max(rows.values()))
+            return [np.array(vectors[rows[key]]) if key in rows else None for key in keys]
+
+    def get(self, text, model):
+        return self.get_many([text], model)[0]
+
+    def put_many(self, texts, model, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        keys = [get_text_key(text) for text in texts]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                with open(self.vector_path, 'ab') as f:
+                    # Rows are counted from the file size so a partial write left by a crash is never reused.
+                    offset = -(-f.tell() // (4 * self.dim))
+                    f.truncate(offset * 4 * self.dim)
+                    f.write(vectors.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.conn.executemany("INSERT OR REPLACE INTO embeddings (model, text_hash, row) VALUES (?, ?, ?)",
+                                      [(model, key, offset + ix) for ix, key in enumerate(keys)])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return list(vectors)
+
+    def put(self, text, model, embedding):
+        return self.put_many([text], model, [embedding])[0]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import pickle
+import numpy as np
+from quantization import QuantizedMatrix, quantize_int8, dequantize_int8
+
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def load_splits(split_file):
+    with open(split_file, 'rb') as f:
+        return pickle.load(f)
+
+
+class EmbeddingStore:
+    # One embedding matrix for the whole dataset instead of a copy per fold. embeddings.npy (float32, float16, or
+    # int8 offsets from mean.npy with one scale per row in scales.npy, as in quantization.QuantizedMatrix) is
+    # opened with mmap, so reading a fold touches only its rows and the pages come from the shared page cache;
+    # the rows of a fold are then copied into the reading process. pmids.npy holds the PMID of each row. Rows
+    # follow the dataset order, which is the order the indices in cross_validation_splits.pkl refer to.
+    def __init__(self, store_dir: str) -> None:
+        if not isinstance(store_dir, str):
+            raise TypeError("store_dir must be string.")
+
+        self.store_dir = store_dir
+        self.embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r')
+        self.pmids = np.load(os.path.join(store_dir, 'pmids.npy'))
+        self.scales, self.mean = None, None
+        if self.embeddings.dtype == np.int8:
+            self.scales = np.load(os.path.join(store_dir, 'scales.npy'))
+            self.mean = np.load(os.path.join(store_dir, 'mean.npy'))
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def get(self, rows) -> np.ndarray:
+        # A float32 copy of the requested rows, whatever the stored precision; only they are read from disk.
+        rows = np.asarray(rows)
+        if self.scales is not None:
+            return dequantize_int8(self.embeddings[rows], self.scales[rows]) + self.mean
+        return np.asarray(self.embeddings[rows], dtype=np.float32)
+
+    def get_quantized(self, rows) -> QuantizedMatrix:
+        # The requested rows of an int8 store in their stored form: codes, scales and the store's mean.
+        rows = np.asarray(rows)
+        return QuantizedMatrix.from_int8(self.embeddings[rows], self.scales[rows], self.mean)
+
+    def get_fold(self, split_file: str, fold: int, part: str, compact: bool = False):
+        # With compact, an int8 store returns a QuantizedMatrix instead of a float32 array.
+        train_index, test_index = load_splits(split_file)[fold]
+        rows = train_index if part == 'train' else test_index
+        if compact and self.scales is not None:
+            return self.get_quantized(rows), self.pmids[rows]
+        return self.get(rows), self.pmids[rows]
+
+    @staticmethod
+    def create(store_dir: str, embeddings, pmids, dtype: str = 'float32', chunk_rows: int = 10000):
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}.")
+
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = os.path.join(store_dir, 'embeddings.tmp.npy')
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=embeddings.shape)
+        scales = np.empty(len(embeddings), dtype=np.float32)
+        mean = np.asarray(embeddings, dtype=np.float32).mean(axis=0) if dtype == 'int8' else None
+        for start in range(0, len(embeddings), chunk_rows):
+            if dtype == 'int8':
+                matrix[start:start + chunk_rows], scales[start:start + chunk_rows] = \
+                    quantize_int8(embeddings[start:start + chunk_rows] - mean)
+            else:
+                matrix[start:start + chunk_rows] = embeddings[start:start + chunk_rows]
+        matrix.flush()
+        del matrix
+        if dtype == 'int8':
+            np.save(os.path.join(store_dir, 'scales.npy'), scales)
+            np.save(os.path.join(store_dir, 'mean.npy'), mean)
+        np.save(os.path.join(store_dir, 'pmids.npy'), np.asarray(pmids))
+        os.replace(tmp_path, os.path.join(store_dir, 'embeddings.npy'))
+        return EmbeddingStore(store_dir)
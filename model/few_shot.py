@@ -1,6 +1,7 @@
 # #!/usr/bin/env python
 # ### author: Jingmei Yang: jmyang@bu.edu
 
+import hashlib
 import pandas as pd
 import numpy as np
 import warnings
@@ -10,7 +11,8 @@ openai.api_key = "Your Key"
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
 from typing import Tuple
-from funs import clean_text
+from funs import clean_text, get_example_content
+from token_budget import TokenBudget, CompiledPrompt, compile_prompt
 
 class FewShot:
 
@@ -26,7 +28,11 @@ class FewShot:
                  explanation_column = 'Generated_justification',
                  positive_first  = True,
                  COT: bool = False,
-                 SUB: bool = False) -> None:
+                 SUB: bool = False,
+                 token_budget: TokenBudget = None,
+                 sampling: str = 'pmid',
+                 seed: int = RANDOM_STATE,
+                 fold: int = 0) -> None:
 
         if not all(isinstance(i, str) for i in [system, definition, question, cot_prompt, noncot_prompt, subquestion_prompt,explanation_column]):
             raise TypeError("system, definition, question,explanation_column, cot_prompt, noncot_prompt, and subquestion_prompt  must be string.")
@@ -36,6 +42,8 @@ class FewShot:
             raise TypeError("SUB must be bool.")
         if not isinstance(positive_first, bool):
             raise TypeError("positive_first must be bool.")
+        if sampling not in ['pmid', 'global']:
+            raise ValueError("sampling must be 'pmid' or 'global'.")
         self.train_df = train_df
         self.model_type = model_type
         self.system = system
@@ -44,6 +52,10 @@ class FewShot:
         self.sub = SUB
         self.positive_first = positive_first
         self.explanation_column = explanation_column
+        self.token_budget = token_budget
+        self.sampling = sampling
+        self.seed = seed
+        self.fold = fold
 
         if  self.sub:
             self.question_prompt = f"Primary question: {question}\n{subquestion_prompt}"
@@ -52,8 +64,22 @@ class FewShot:
         else:
             self.question_prompt = f"Question: {question}\n{noncot_prompt}"
 
+        # Parts of the prompt that do not depend on the test paper are formatted once.
+        self.definition_prefix = f"{self.definition}\n\n"
+        self.question_suffix = f"\n\n{self.question_prompt}"
+        self.examples = {}
+        self.example_contents = {}
+
         self.pos_set, self.neg_set = self.apply_train_set_filter()
 
+        # The pools are row numbers of train_df and the example columns are plain arrays, so a draw is two array
+        # lookups and each training example is formatted at most once.
+        self.pos_rows = np.flatnonzero(self.train_df.index.isin(self.pos_set.index))
+        self.neg_rows = np.flatnonzero(self.train_df.index.isin(self.neg_set.index))
+        self.papers = self.train_df['Combined'].values
+        self.explanations = self.train_df[self.explanation_column].values
+        self.reviews = self.train_df['Review'].values
+
     def apply_train_set_filter(self):
         self.train_df['Label'] =self.train_df['Review'].apply(lambda x: 1 if 'YES' in x.upper() else 0)
 
@@ -75,6 +101,9 @@ class FewShot:
             raise ValueError("DataFrame is empty.")
 
         paper, explanation, review = df.iloc[0][['Combined', self.explanation_column, 'Review']]
+        return self.format_example(paper, explanation, review)
+
+    def format_example(self, paper: str, explanation: str, review: str) -> Tuple[str, str]:
         explanation = clean_text(explanation)
 
         if self.sub:
@@ -84,29 +113,64 @@ class FewShot:
         else:
             return (paper, f"{review}.")
 
-    def get_sample_and_format(self, set_df: pd.DataFrame) -> Tuple[str, str]:
-
-        df_sample = set_df.sample(n=1).reset_index(drop=True)
-
-        return self.format_answer(df_sample)
-
-    def get_prompt(self, context: str):
-        pos_paper, pos_a = self.get_sample_and_format(self.pos_set)
-        neg_paper, neg_a = self.get_sample_and_format(self.neg_set)
+    def sample_rows_global(self) -> Tuple[int, int]:
+        # Same draws from the NumPy RNG as DataFrame.sample(n=1) on the positive and then the negative set.
+        if len(self.pos_rows) == 0 or len(self.neg_rows) == 0:
+            raise ValueError("DataFrame is empty.")
+        pos_draw = np.random.choice(len(self.pos_rows), size=1, replace=False)[0]
+        neg_draw = np.random.choice(len(self.neg_rows), size=1, replace=False)[0]
+        return self.pos_rows[pos_draw], self.neg_rows[neg_draw]
+
+    def sample_rows(self, pmid) -> Tuple[int, int]:
+        # The examples of a test paper depend only on (seed, fold, PMID), not on which papers were prompted
+        # before it, so concurrent, sharded and resumed runs build the same prompts.
+        if len(self.pos_rows) == 0 or len(self.neg_rows) == 0:
+            raise ValueError("DataFrame is empty.")
+        digest = hashlib.blake2b(f"{self.seed}:{self.fold}:{pmid}".encode(), digest_size=16).digest()
+        pos_draw, neg_draw = np.frombuffer(digest, dtype='<u8')
+        return self.pos_rows[pos_draw % len(self.pos_rows)], self.neg_rows[neg_draw % len(self.neg_rows)]
+
+    def format_row(self, row: int) -> Tuple[str, str]:
+        if row not in self.examples:
+            self.examples[row] = self.format_example(self.papers[row], self.explanations[row], self.reviews[row])
+        return self.examples[row]
+
+    def build(self, examples, context: str):
+        prompts = []
+        for ix, (paper, answer) in enumerate(examples):
+            prefix = self.definition_prefix if ix == 0 else ''
+            prompts.append({"role": "user", "content": get_example_content(self.example_contents, paper, prefix, self.question_suffix)})
+            prompts.append({"role": "assistant", "content": answer})
+
+        if examples:
+            prompts.append({"role": "user", "content": context + self.question_suffix})
+        else:
+            prompts.append({"role": "user", "content": self.definition_prefix + context + self.question_suffix})
 
-        samples = {'positive': (pos_paper, pos_a), 'negative': (neg_paper, neg_a)}
-        first_p, first_a = samples['positive' if self.positive_first else 'negative']
-        second_p, second_a = samples['negative' if self.positive_first else 'positive']
-
-        prompts = [
-            {"role": "user", "content": f"{self.definition}\n\n{first_p}\n\n{self.question_prompt}"},
-            {"role": "assistant", "content": f"{first_a}"},
-            {"role": "user", "content": f"{second_p}\n\n{self.question_prompt}"},
-            {"role": "assistant", "content": f"{second_a}"},
-            {"role": "user", "content": f"{context}\n\n{self.question_prompt}"}
-        ]
         if self.model_type == 'text-davinci-003':
             return '\n'.join(p['content'] for p in prompts)
         if self.model_type in ['gpt-3.5-turbo','gpt-3.5-turbo-16k','gpt-3.5-turbo-0301', 'gpt-4']:
             return [{"role": "system", "content": f"{self.system}"}] + prompts
 
+    def compile_prompt(self, context: str, pmid=None) -> CompiledPrompt:
+        # sampling='global' draws from the NumPy RNG seeded at import, as the original runs did; the draws then
+        # depend on the order in which papers are prompted.
+        if self.sampling == 'global' or pmid is None:
+            pos_row, neg_row = self.sample_rows_global()
+        else:
+            pos_row, neg_row = self.sample_rows(pmid)
+        (pos_paper, pos_a), (neg_paper, neg_a) = self.format_row(pos_row), self.format_row(neg_row)
+
+        samples = {'positive': (pos_paper, pos_a), 'negative': (neg_paper, neg_a)}
+        examples = [samples['positive' if self.positive_first else 'negative'],
+                    samples['negative' if self.positive_first else 'positive']]
+        return compile_prompt(self.token_budget, self.build, examples, context, self.model_type)
+
+    def get_prompt(self, context: str, pmid=None):
+        return self.compile_prompt(context, pmid).prompt
+
+    def get_prompts(self, test_df: pd.DataFrame):
+        # Yields (PMID, CompiledPrompt) for every paper of a fold, in row order.
+        for pmid, context in zip(test_df['PMID'].values, test_df['Combined'].values):
+            yield pmid, self.compile_prompt(context, pmid)
+
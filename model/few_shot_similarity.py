@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 ### author: Jingmei Yang: jmyang@bu.edu
+import os
+import glob
+import hashlib
 import pandas as pd
 import numpy as np
 import warnings
@@ -9,7 +12,12 @@ from typing import Tuple
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
-from funs import clean_text
+from funs import clean_text, get_example_content, load_embedding_file, match_pmids, get_file_identity, get_embedding_file_identity
+from token_budget import TokenBudget, CompiledPrompt, compile_prompt
+from ann_index import IVFIndex
+from quantization import QuantizedMatrix
+from retrieval_index import RetrievalIndex
+from sparse_retriever import SparseRetriever
 
 
 class SimilarShot:
@@ -25,8 +33,22 @@ class SimilarShot:
                  explanation_column='Generated_justification',
                  top_n_similar=1,
                  COT: bool = False,
-                 SUB: bool = False) -> None:
+                 SUB: bool = False,
+                 token_budget: TokenBudget = None,
+                 ann_index_path: str = None,
+                 ann_nprobe: int = 8,
+                 embedding_dtype: str = 'float32',
+                 retrieval_index: RetrievalIndex = None,
+                 retrieval_filter: dict = None,
+                 retriever: str = 'dense',
+                 train_file: str = None) -> None:
 
+        # With a retrieval_index, examples come from its papers that pass retrieval_filter (see
+        # RetrievalIndex.get_mask) and train_df and embedd_train_file are not used. retriever 'bm25' or 'tfidf'
+        # finds neighbours by the Combined text (see sparse_retriever.py) instead of embeddings. train_file, the CSV
+        # train_df was read from, identifies the training texts in the key of a neighbour table (see search_table).
+        if retrieval_index is not None or retriever != 'dense':
+            embedd_train_file = ''
         if not all(isinstance(i, str) for i in
                    [system, definition, question, cot_prompt, noncot_prompt, subquestion_prompt, explanation_column, embedd_train_file]):
             raise TypeError(
@@ -37,6 +59,8 @@ class SimilarShot:
             raise TypeError("SUB must be bool.")
         if not isinstance(top_n_similar, int):
             raise TypeError("top_n_similar must be int.")
+        if retriever != 'dense' and ann_index_path:
+            raise ValueError("ann_index_path needs the dense retriever.")
 
         self.cot_prompt = cot_prompt
         self.cot = COT
@@ -46,11 +70,25 @@ class SimilarShot:
         self.model_type = model_type
         self.explanation_column = explanation_column
         self.top_n_similar = top_n_similar
-        self.apply_train_set_filter(train_df, embedd_train_file)
+        self.token_budget = token_budget
+        self.embedding_dtype = embedding_dtype
+        self.retrieval_index = retrieval_index
+        self.retriever = retriever
+        self.sparse_retriever = None
+        self.mask = None
+        self.embedding_file = embedd_train_file
+        self.train_file = train_file
+        self.filter = None
+        self.train_key = None
+        if retrieval_index is not None:
+            self.apply_retrieval_filter(retrieval_filter or {})
+        else:
+            self.apply_train_set_filter(train_df, embedd_train_file)
+        self.ann_index = self.load_ann_index(ann_index_path, ann_nprobe) if ann_index_path else None
 
-        if top_n_similar > len(self.train_df):
+        if top_n_similar > len(self.positions):
             raise ValueError(
-                f"top_n_similar ({top_n_similar}) is greater than the number of training examples ({len(self.train_df)})")
+                f"top_n_similar ({top_n_similar}) is greater than the number of training examples ({len(self.positions)})")
         if  self.sub:
             self.question_prompt = f"Primary question: {question}\n{subquestion_prompt}"
         elif self.cot:
@@ -58,33 +96,220 @@ class SimilarShot:
         else:
             self.question_prompt = f"Question: {question}\n{noncot_prompt}"
 
-    def apply_train_set_filter(self, train_df: pd.DataFrame, embedd_train_file: str) -> None:
+        # Parts of the prompt that do not depend on the test paper are formatted once, and so is every training
+        # example the first time it is retrieved.
+        self.definition_prefix = f"{self.definition}\n\n"
+        self.question_suffix = f"\n\n{self.question_prompt}"
+        self.examples = {}
+        self.example_contents = {}
 
-        data = np.load(embedd_train_file)
+    def apply_train_set_filter(self, train_df: pd.DataFrame, embedd_train_file: str) -> None:
 
         if  (self.sub) or (self.cot):
             train_df['Label'] = train_df['Review'].apply(lambda x: 1 if  'YES' in x.upper() else 0)
             mask = (train_df[f'{self.explanation_column}_TF'] == train_df['Label'])
             self.train_df = train_df[mask]
-            self.embeddings = data["embedding"][mask]
-            self.ids = data["PMID"][mask]
+            self.filter = ('correct', self.explanation_column)
+            rows = np.flatnonzero(np.asarray(mask))
 
         else:
             self.train_df = train_df
-            self.embeddings = data["embedding"]
-            self.ids = data["PMID"]
+            rows = None
+
+        if self.retriever != 'dense':
+            self.positions = np.arange(len(self.train_df))
+            self.ids = self.train_df['PMID'].values
+            self.matrix = None
+            self.sparse_retriever = SparseRetriever(self.retriever).fit(self.train_df['Combined'].values)
+            return
+
+        embeddings, ids = load_embedding_file(embedd_train_file, compact=self.embedding_dtype == 'int8')
+        if rows is None:
+            rows = np.arange(len(ids))
+        self.ids = ids[rows]
+
+        # Rows of the training matrix are normalized once, kept in embedding_dtype (see quantization.py) and mapped
+        # to their position in train_df, so a search is a matrix product followed by argpartition. Embeddings
+        # without a train_df row are never returned; a PMID repeated in train_df gets a matrix row per copy.
+        matched, self.positions = match_pmids(self.ids, self.train_df['PMID'].values)
+        if isinstance(embeddings, QuantizedMatrix):
+            # An int8 store is searched in its stored form; rows are scaled to unit length by per-row weights.
+            self.matrix = embeddings.take(rows[matched]).normalize_rows()
+        else:
+            self.matrix = QuantizedMatrix(self.normalize(np.asarray(embeddings[rows[matched]])), self.embedding_dtype)
+
+    def apply_retrieval_filter(self, retrieval_filter: dict) -> None:
+        # The index matrix is shared, not copied: train_df is the whole index frame, positions are the rows that
+        # pass the filter, and search_exact masks the others out.
+        retrieval_filter = dict(retrieval_filter)
+        if (self.sub) or (self.cot):
+            retrieval_filter['correct'] = self.explanation_column
+        self.filter = tuple(sorted(retrieval_filter.items()))
+        self.mask = self.retrieval_index.get_mask(**retrieval_filter)
+        self.train_df = self.retrieval_index.frame
+        self.positions = np.flatnonzero(self.mask)
+        self.ids = self.train_df['PMID'].values[self.positions]
+        self.matrix = self.retrieval_index.matrix
+        if self.retriever != 'dense':
+            self.sparse_retriever = self.retrieval_index.get_sparse_retriever(self.retriever)
+
+    def load_ann_index(self, ann_index_path: str, ann_nprobe: int) -> IVFIndex:
+        # The index file is shared by every configuration of the fold; training papers it does not hold yet
+        # (newly labelled, or let through by a different filter) are added and the file is saved again. It records
+        # the identity of the embedding file and the precision of its vectors, and is rebuilt when either changes,
+        # so a re-embedded paper never keeps its old vector.
+        if self.retrieval_index is not None:
+            return self.retrieval_index.get_ann_index(ann_nprobe)
+        source = repr((get_embedding_file_identity(self.embedding_file), self.embedding_dtype))
+        ann_index = None
+        if os.path.exists(ann_index_path):
+            ann_index = IVFIndex.load(ann_index_path, nprobe=ann_nprobe)
+        if ann_index is None or ann_index.source != source:
+            ann_index = IVFIndex(nprobe=ann_nprobe, source=source)
+        pmids = self.train_df['PMID'].values[self.positions]
+        missing = ~np.isin(pmids, ann_index.ids)
+        if missing.any():
+            ann_index.add(self.matrix[missing], pmids[missing])
+            ann_index.save(ann_index_path)
+        return ann_index
+
+    def normalize(self, embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms)
+
+    def search(self, test_embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the train_df positions of the top_n_similar neighbours of every test embedding, most similar
+        # first, and their cosine similarities. With a sparse retriever test_embeddings are the Combined texts
+        # of the test papers and the scores are BM25 or TF-IDF similarities.
+        if self.sparse_retriever is not None:
+            return self.sparse_retriever.search(test_embeddings, min(self.top_n_similar, len(self.positions)), self.mask)
+        test_embeddings = np.atleast_2d(test_embeddings)
+        if self.ann_index is not None:
+            return self.search_ann(test_embeddings)
+        return self.search_exact(test_embeddings)
+
+    def search_ann(self, test_embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # The index can hold papers this configuration filters out, so extra neighbours are fetched and only
+        # candidates are kept; a test paper left with fewer than k of them falls back to the exact search. A PMID
+        # repeated in train_df is returned as its first candidate row.
+        k = min(self.top_n_similar, len(self.positions))
+        ids, ann_scores = self.ann_index.search(test_embeddings, min(len(self.ann_index), 4 * k + 16))
+        if self.retrieval_index is not None:
+            # ids are frame positions.
+            found = np.where((ids >= 0) & self.mask[np.maximum(ids, 0)], ids, -1)
+        else:
+            pmids = pd.Index(self.train_df['PMID'].values[self.positions])
+            first = ~pmids.duplicated()
+            candidates = pmids[first].get_indexer(ids.ravel()).reshape(ids.shape)
+            found = np.where(candidates >= 0, self.positions[first][candidates], -1)
+
+        positions = np.empty((len(test_embeddings), k), dtype=int)
+        scores = np.empty((len(test_embeddings), k), dtype=ann_scores.dtype)
+        short = []
+        for row in range(len(test_embeddings)):
+            valid = np.flatnonzero(found[row] >= 0)[:k]
+            if len(valid) < k:
+                short.append(row)
+                continue
+            positions[row] = found[row, valid]
+            scores[row] = ann_scores[row, valid]
+        if short:
+            positions[short], scores[short] = self.search_exact(test_embeddings[short])
+        return positions, scores
+
+    def search_exact(self, test_embeddings: np.ndarray, chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        # Test rows are scored chunk_size at a time to bound memory.
+        k = min(self.top_n_similar, len(self.positions))
+        if self.retrieval_index is not None:
+            return self.retrieval_index.search(test_embeddings, k, self.mask, chunk_size)
+        test_embeddings = self.normalize(test_embeddings)
+        positions = np.empty((len(test_embeddings), k), dtype=int)
+        scores = np.empty((len(test_embeddings), k))
+        for start in range(0, len(test_embeddings) if k > 0 else 0, chunk_size):
+            similarities = self.matrix.dot(test_embeddings[start:start + chunk_size])
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            positions[start:start + chunk_size] = self.positions[np.take_along_axis(top, order, axis=1)]
+            scores[start:start + chunk_size] = np.take_along_axis(top_scores, order, axis=1)
+        return positions, scores
+
+    def get_train_key(self):
+        # (where, version) of the training side of a neighbour table, worked out once per instance: the files the
+        # candidates were read from, or a hash of their content when there are none, and the candidate rows.
+        if self.train_key is None:
+            version = hashlib.blake2b(digest_size=16)
+            if self.retrieval_index is not None and self.retrieval_index.sources is not None:
+                where = self.retrieval_index.source_paths
+                version.update(repr(self.retrieval_index.sources).encode())
+            elif self.sparse_retriever is not None and self.train_file is not None:
+                where = self.train_file
+                version.update(repr(get_file_identity(self.train_file)).encode())
+            elif self.sparse_retriever is not None:
+                where = None
+                version.update('\x00'.join(self.train_df['Combined'].values[self.positions]).encode())
+            elif self.retrieval_index is None:
+                where = self.embedding_file
+                version.update(repr(get_embedding_file_identity(self.embedding_file)).encode())
+            else:
+                where = None
+                version.update(self.matrix.tobytes())
+            for array in [self.train_df['PMID'].values[self.positions], self.positions]:
+                version.update(pd.util.hash_array(np.asarray(array)).tobytes())
+            self.train_key = (where, version.hexdigest())
+        return self.train_key
 
-    def calculate_cosine_similarities(self, embeddings: np.ndarray, test_embedding: np.ndarray) -> np.ndarray:
+    def get_neighbour_key(self, queries, query_ids, query_file: str = None) -> Tuple[str, str]:
+        # (configuration, version) of a neighbour table. The configuration names what is searched and how; the
+        # version changes whenever the files or rows behind it do. queries are hashed only without a query_file.
+        train_where, train_version = self.get_train_key()
+        params = self.sparse_retriever.params if self.sparse_retriever is not None else None
+        ann = None if self.ann_index is None else ('ivf', self.ann_index.nlist, self.ann_index.nprobe)
+        config = repr((self.retriever, params, self.embedding_dtype, self.filter, ann, train_where,
+                       None if query_file is None else os.path.abspath(query_file)))
 
-        return np.dot(embeddings, test_embedding) / (
-                    np.linalg.norm(embeddings, axis=1) * np.linalg.norm(test_embedding))
+        version = hashlib.blake2b(train_version.encode(), digest_size=16)
+        if query_file is None:
+            if self.sparse_retriever is not None:
+                version.update('\x00'.join(queries).encode())
+            else:
+                version.update(np.ascontiguousarray(queries).tobytes())
+        elif self.sparse_retriever is not None:
+            version.update(repr(get_file_identity(query_file)).encode())
+        else:
+            version.update(repr(get_embedding_file_identity(query_file)).encode())
+        version.update(pd.util.hash_array(np.asarray(query_ids)).tobytes())
+        if self.ann_index is not None:
+            version.update(repr(len(self.ann_index)).encode())
+        return hashlib.blake2b(config.encode(), digest_size=8).hexdigest(), version.hexdigest()
+
+    def search_table(self, queries, table_prefix: str, query_ids, query_file: str = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Same result as search(queries), kept in {table_prefix}_{configuration}_{version}.npz. query_ids are the
+        # PMIDs of the queries and query_file the embedding file (or, with a sparse retriever, the CSV) they were
+        # read from; the texts are hashed only without one. Every configuration with the same filter reuses the
+        # table; when a file or the filtered training set changes a new table is written and the ones it
+        # supersedes are deleted.
+        config, version = self.get_neighbour_key(queries, query_ids, query_file)
+        table_path = f"{table_prefix}_{config}_{version}.npz"
+        k = min(self.top_n_similar, len(self.positions))
+        if os.path.exists(table_path):
+            table = np.load(table_path)
+            if table['PMID'].shape[1] >= k:
+                return table['position'][:, :k], table['score'][:, :k]
+
+        positions, scores = self.search(queries)
+        with open(f"{table_path}.tmp", 'wb') as f:
+            np.savez(f, PMID=self.train_df['PMID'].values[positions], position=positions, score=scores.astype(np.float32))
+        os.replace(f"{table_path}.tmp", table_path)
+        for old_path in glob.glob(f"{glob.escape(table_prefix)}_{config}_*.npz"):
+            if old_path != table_path:
+                os.remove(old_path)
+        return positions, scores
 
     def find_similar_examples(self, test_embedding: np.ndarray) -> pd.DataFrame:
-        cosine_similarities = self.calculate_cosine_similarities(self.embeddings, test_embedding)
-        cosine_df = pd.DataFrame({'PMID': self.ids, 'cosine_similarity': cosine_similarities})
-        merged_df = pd.merge(self.train_df, cosine_df, on='PMID')
-        sorted_df = merged_df.sort_values('cosine_similarity', ascending=False).reset_index(drop=True)
-        similar_examples = sorted_df.head(self.top_n_similar)
+        positions, scores = self.search(test_embedding)
+        similar_examples = self.train_df.iloc[positions[0]].reset_index(drop=True)
+        similar_examples['cosine_similarity'] = scores[0]
         return similar_examples
 
     def format_answer(self, df: pd.DataFrame, ix: int) -> Tuple[str, str]:
@@ -100,23 +325,63 @@ class SimilarShot:
         else:
             return (paper, f"{review}.")
 
-    def get_prompt(self, context: str, test_embedding: np.ndarray):
-        similar_top2 = self.find_similar_examples(test_embedding)
-        if similar_top2.empty:
-            raise ValueError("No similar examples found.")
+    def format_position(self, ix: int) -> Tuple[str, str]:
+        # format_answer(self.train_df, ix), formatted once per training example.
+        if ix not in self.examples:
+            self.examples[ix] = self.format_answer(self.train_df, ix)
+        return self.examples[ix]
 
+    def build(self, examples, context: str):
         prompts = []
-        for ix in range(self.top_n_similar):
-            similar_paper, similar_a = self.format_answer(similar_top2, ix)
-            if ix == 0:
-                prompts.append({"role": "user", "content": f"{self.definition}\n\n{similar_paper}\n\n{self.question_prompt}"})
-            else:
-                prompts.append({"role": "user", "content": f"{similar_paper}\n\n{self.question_prompt}"})
+        for ix, (similar_paper, similar_a) in enumerate(examples):
+            prefix = self.definition_prefix if ix == 0 else ''
+            prompts.append({"role": "user", "content": get_example_content(self.example_contents, similar_paper, prefix, self.question_suffix)})
+            prompts.append({"role": "assistant", "content": similar_a})
 
-            prompts.append({"role": "assistant", "content": f"{similar_a}"})
-
-        prompts.append({"role": "user", "content": f"{context}\n\n{self.question_prompt}"})
+        if examples:
+            prompts.append({"role": "user", "content": context + self.question_suffix})
+        else:
+            prompts.append({"role": "user", "content": self.definition_prefix + context + self.question_suffix})
         if self.model_type == 'text-davinci-003':
             return '\n'.join([p['content'] for p in prompts])
         if self.model_type in ['gpt-3.5-turbo','gpt-3.5-turbo-16k','gpt-3.5-turbo-0301', 'gpt-4']:
-            return [{"role": "system", "content": f"{self.system}"}] + prompts
\ No newline at end of file
+            return [{"role": "system", "content": f"{self.system}"}] + prompts
+
+    def compile_prompt(self, context: str, test_embedding: np.ndarray = None, positions: np.ndarray = None) -> CompiledPrompt:
+        # positions: a row of search() for this paper, when the neighbours of the whole fold were found at once.
+        if positions is None:
+            positions = self.search([context] if self.sparse_retriever is not None else test_embedding)[0][0]
+        if len(positions) == 0:
+            raise ValueError("No similar examples found.")
+
+        examples = [self.format_position(ix) for ix in positions]
+        return compile_prompt(self.token_budget, self.build, examples, context, self.model_type)
+
+    def get_prompt(self, context: str, test_embedding: np.ndarray):
+        return self.compile_prompt(context, test_embedding).prompt
+
+    def get_prompts(self, test_df: pd.DataFrame, queries=None, query_ids=None, table_prefix: str = None,
+                    query_file: str = None):
+        # Yields (PMID, CompiledPrompt) for every paper of a fold, in row order, after one search for the whole
+        # fold. queries are the test embeddings (with a sparse retriever the Combined texts, by default those of
+        # test_df) and query_ids their PMIDs (by default those of test_df); they can cover more papers than
+        # test_df, e.g. the whole fold when test_df holds the papers still to answer. With table_prefix the
+        # neighbours are read from or saved to a neighbour table (see search_table).
+        if queries is None:
+            if self.sparse_retriever is None:
+                raise ValueError("The dense retriever needs the test embeddings as queries.")
+            queries = test_df['Combined'].values
+        if query_ids is None:
+            query_ids = test_df['PMID'].values
+        if table_prefix is not None:
+            neighbours, _ = self.search_table(queries, table_prefix, query_ids, query_file)
+        else:
+            neighbours, _ = self.search(queries)
+
+        query_ids = pd.Index(query_ids)
+        first = np.flatnonzero(~query_ids.duplicated())
+        rows = query_ids[first].get_indexer(test_df['PMID'].values)
+        if (rows < 0).any():
+            raise ValueError("Every PMID of test_df needs a query.")
+        for pmid, context, row in zip(test_df['PMID'].values, test_df['Combined'].values, first[rows]):
+            yield pmid, self.compile_prompt(context, positions=neighbours[row])
@@ -1,12 +1,28 @@
 import os
+import io
 import numpy as np
+import pandas as pd
 import random, time
+import asyncio
+import csv
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
 import openai
 openai.api_key = "Your Key"
 import logging
 import re
+import tiktoken
+from functools import lru_cache
+from llm_backend import OpenAIBackend
+from embedding_store import EmbeddingStore
+from quantization import QuantizedMatrix
+
+MAX_TOKENS = 1000
+TOP_P = 1
+_rate_limiter = None
+_response_cache = None
+_embedding_cache = None
+_backend = OpenAIBackend()
 
 
 def clean_text(text: str) -> str:
@@ -45,6 +61,198 @@ def get_output_file(output_folder, output_file):
     return os.path.join(output_folder,output_file)
 
 
+class DurableCSVWriter:
+    def __init__(self, csv_file, fsync_every=10):
+        self.csv_file = csv_file
+        self.csv_writer = csv.writer(csv_file)
+        self.fsync_every = fsync_every
+        self.rows = 0
+
+    def writerow(self, row):
+        self.csv_writer.writerow(row)
+        self.rows += 1
+        if self.rows % self.fsync_every == 0:
+            self.sync()
+
+    def sync(self):
+        self.csv_file.flush()
+        os.fsync(self.csv_file.fileno())
+
+
+def open_resumable_csv(csv_path, header, answer_col, resume=False, fsync_every=10):
+    # Rows already answered are kept and their PMIDs returned so the caller can skip them. ERROR rows and a
+    # row cut short by a crash are dropped, which queues those PMIDs for another attempt. csv.writer ends every
+    # record with a newline, so a file that does not, or that ends inside a quoted field, lost its last record.
+    # GPTModel writes a fold in test_df order, so the kept rows are a prefix of it and the new answers follow
+    # in order; only PMIDs that had an ERROR row come after the rest of the fold.
+    completed = set()
+    if os.path.dirname(csv_path):
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    if resume and os.path.exists(csv_path):
+        with open(csv_path, 'r', newline='') as f:
+            text = f.read()
+        reader = csv.reader(io.StringIO(text, newline=''), strict=True)
+        old_header = next(reader, None)
+        rows = []
+        try:
+            for row in reader:
+                rows.append(row)
+        except csv.Error:
+            pass
+        else:
+            if rows and not text.endswith('\n'):
+                rows.pop()
+        answer_ix = old_header.index(answer_col) if old_header and answer_col in old_header else None
+        rows = [row for row in rows
+                if answer_ix is not None and len(row) == len(old_header) and row[answer_ix] != 'ERROR']
+
+        tmp_path = f"{csv_path}.tmp"
+        with open(tmp_path, 'w', newline='') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(header)
+            for row in rows:
+                if len(row) < len(header):
+                    row = row + [''] * (len(header) - len(row))
+                csv_writer.writerow(row)
+                completed.add(row[0])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, csv_path)
+        csv_file = open(csv_path, 'a', newline='')
+    else:
+        csv_file = open(csv_path, 'w', newline='')
+        csv.writer(csv_file).writerow(header)
+
+    return DurableCSVWriter(csv_file, fsync_every), csv_file, completed
+
+
+@lru_cache(maxsize=None)
+def get_embedding_store(store_dir):
+    return EmbeddingStore(store_dir)
+
+
+def get_store_fold(embedding_file):
+    # (store directory, split file, fold, part) when embed_{train,test}_{fold}.npz is read from the embedding_store
+    # directory and cross_validation_splits.pkl next to it, or None when it is a per-fold file.
+    folder = os.path.dirname(embedding_file)
+    match = re.fullmatch(r'embed_(train|test)_(\d+)\.npz', os.path.basename(embedding_file))
+    if match and os.path.isdir(os.path.join(folder, 'embedding_store')):
+        return (os.path.join(folder, 'embedding_store'), os.path.join(folder, 'cross_validation_splits.pkl'),
+                int(match.group(2)), match.group(1))
+    return None
+
+
+def get_file_identity(path):
+    # (path, mtime, size): changes whenever the file is rewritten, without reading it.
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_embedding_file_identity(embedding_file):
+    # File identities of everything load_embedding_file(embedding_file) reads.
+    store_fold = get_store_fold(embedding_file)
+    if store_fold is None:
+        return (get_file_identity(embedding_file),)
+    store_dir, split_file, fold, part = store_fold
+    names = sorted(name for name in os.listdir(store_dir) if name.endswith('.npy'))
+    return tuple(get_file_identity(os.path.join(store_dir, name)) for name in names) + \
+        (get_file_identity(split_file), (fold, part))
+
+
+@lru_cache(maxsize=None)
+def load_embedding_file(embedding_file, compact=False):
+    # Shared by every prompt builder that reads the same file in one process; the arrays are read-only.
+    # embed_{train,test}_{fold}.npz is taken from the embedding store when there is one (see get_store_fold),
+    # and read as a per-fold file otherwise. With compact, the rows of an int8 store come back as a
+    # QuantizedMatrix in their stored form rather than as float32.
+    store_fold = get_store_fold(embedding_file)
+    if store_fold is not None:
+        store_dir, split_file, fold, part = store_fold
+        embedding, ids = get_embedding_store(store_dir).get_fold(split_file, fold, part, compact)
+    else:
+        data = np.load(embedding_file)
+        embedding, ids = data["embedding"], data["PMID"]
+    (embedding.codes if isinstance(embedding, QuantizedMatrix) else embedding).setflags(write=False)
+    ids.setflags(write=False)
+    return embedding, ids
+
+
+def match_pmids(left, right):
+    # (i, j) index pairs with left[i] == right[j], in the order of left. A PMID repeated on either side gets every
+    # pairing, as pd.merge on PMID would give it.
+    pairs = pd.merge(pd.DataFrame({'PMID': np.asarray(left), 'i': np.arange(len(left))}),
+                     pd.DataFrame({'PMID': np.asarray(right), 'j': np.arange(len(right))}), on='PMID')
+    return pairs['i'].values, pairs['j'].values
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text, model):
+    # Example papers, answers and system prompts recur in every prompt of a fold, so they are encoded once.
+    return len(get_encoding(model).encode(text))
+
+
+def get_example_content(contents: dict, paper: str, prefix: str, suffix: str) -> str:
+    # The user message of a prompt example, built once per (paper, prefix) and kept in contents. Reusing the same
+    # string object for an example also lets count_tokens find it in its cache.
+    key = (paper, prefix)
+    if key not in contents:
+        contents[key] = prefix + paper + suffix
+    return contents[key]
+
+
+def count_tokens(prompt, model):
+    if isinstance(prompt, str):
+        return count_text_tokens(prompt, model)
+    if all(isinstance(p, str) for p in prompt):
+        return sum(count_text_tokens(p, model) for p in prompt)
+    # Chat format: each message carries a few tokens of role/separator overhead, plus the reply priming.
+    return sum(4 + count_text_tokens(m['content'], model) for m in prompt) + 3
+
+
+def set_rate_limiter(limiter):
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+def get_rate_limiter():
+    return _rate_limiter
+
+
+def set_response_cache(cache):
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache():
+    return _response_cache
+
+
+def set_embedding_cache(cache):
+    global _embedding_cache
+    _embedding_cache = cache
+
+
+def get_embedding_cache():
+    return _embedding_cache
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
 def retry_with_exponential_backoff(
         func,
         initial_delay: float = 1,
@@ -80,37 +288,97 @@ def retry_with_exponential_backoff(
     return wrapper
 
 
+def async_retry_with_exponential_backoff(
+        func,
+        initial_delay: float = 1,
+        exponential_base: float = 2,
+        jitter: bool = True,
+        max_retries: int = 10,
+        errors: tuple = (openai.error.RateLimitError, openai.error.Timeout, openai.error.ServiceUnavailableError, ),
+):
+
+    async def wrapper(*args, **kwargs):
+        num_retries = 0
+        delay = initial_delay
+
+        while True:
+            try:
+                return await func(*args, **kwargs)
+
+            except errors as e:
+                num_retries += 1
+
+                if num_retries > max_retries:
+                    raise Exception(
+                        f"Maximum number of retries ({max_retries}) exceeded."
+                    )
+
+                delay *= exponential_base * (1 + jitter * random.random())
+
+                await asyncio.sleep(delay)
+
+            except Exception as e:
+                raise e
+
+    return wrapper
+
+
 @retry_with_exponential_backoff
+def request_answer(model, prompt, TMP = 0):
+    if _rate_limiter is not None:
+        _rate_limiter.acquire(count_tokens(prompt, model) + MAX_TOKENS)
+
+    return _backend.complete(model, prompt, TMP, MAX_TOKENS, TOP_P)
+
+
+@async_retry_with_exponential_backoff
+async def arequest_answer(model, prompt, TMP = 0):
+    if _rate_limiter is not None:
+        await _rate_limiter.acquire_async(count_tokens(prompt, model) + MAX_TOKENS)
+
+    return await _backend.acomplete(model, prompt, TMP, MAX_TOKENS, TOP_P)
+
+
 def get_answer(model, prompt, TMP = 0):
-    if model  == 'text-davinci-003':
-        response = openai.Completion.create(
-            model= model,
-            prompt = prompt,
-            temperature = TMP,
-            max_tokens = 1000,
-            top_p =1,
-            logprobs = 1)
-        answer = response['choices'][0]['text'].strip()
-        return answer
+    if _response_cache is None or not _response_cache.accepts(TMP):
+        return request_answer(model, prompt, TMP)
 
-    else:
-        response = openai.ChatCompletion.create(
-            model= model,
-            messages=prompt,
-            temperature=TMP,
-            max_tokens=1000,
-            top_p=1)
-        answer = response['choices'][0]['message']['content'].strip()
-        return answer
+    key = _response_cache.make_key(model, prompt, TMP, MAX_TOKENS, TOP_P)
+    return _response_cache.get_or_compute(key, lambda: request_answer(model, prompt, TMP))
+
+
+async def aget_answer(model, prompt, TMP = 0):
+    if _response_cache is None or not _response_cache.accepts(TMP):
+        return await arequest_answer(model, prompt, TMP)
+
+    key = _response_cache.make_key(model, prompt, TMP, MAX_TOKENS, TOP_P)
+    return await _response_cache.aget_or_compute(key, lambda: arequest_answer(model, prompt, TMP))
 
 
-@retry_with_exponential_backoff
 def get_embedding(context, model="text-embedding-ada-002", encoding = "cl100k_base", max_tokens = 8000):
-    response = openai.Embedding.create(input = context,
-                                        model = model,
-                                        encoding = encoding,
-                                        max_tokens = max_tokens)
-    return response["data"][0]["embedding"]
+    if _embedding_cache is None:
+        return request_embedding(context, model, encoding, max_tokens)
+
+    embedding = _embedding_cache.get(context, model)
+    if embedding is None:
+        embedding = _embedding_cache.put(context, model, request_embedding(context, model, encoding, max_tokens))
+    return embedding
+
+
+@retry_with_exponential_backoff
+def request_embedding(context, model="text-embedding-ada-002", encoding = "cl100k_base", max_tokens = 8000):
+    if _rate_limiter is not None:
+        _rate_limiter.acquire(count_tokens(context, model))
+
+    return _backend.embed(context, model, encoding = encoding, max_tokens = max_tokens)[0]
+
+
+@retry_with_exponential_backoff
+def get_embeddings(contexts, model="text-embedding-ada-002"):
+    if _rate_limiter is not None:
+        _rate_limiter.acquire(count_tokens(contexts, model))
+
+    return _backend.embed(contexts, model)
 
 
 
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import asyncio
+import contextlib
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+import openai
+
+
+def get_request_body(model, prompt, temperature, max_tokens, top_p):
+    if model == 'text-davinci-003':
+        return "/completions", {"model": model, "prompt": prompt, "temperature": temperature,
+                                "max_tokens": max_tokens, "top_p": top_p, "logprobs": 1}
+    return "/chat/completions", {"model": model, "messages": prompt, "temperature": temperature,
+                                 "max_tokens": max_tokens, "top_p": top_p}
+
+
+def get_response_text(response):
+    choice = response['choices'][0]
+    text = choice['message']['content'] if 'message' in choice else choice['text']
+    return text.strip()
+
+
+def get_error(status, message, headers=None):
+    # Same exception types as the openai package, so retry_with_exponential_backoff treats both backends alike.
+    if status == 429:
+        return openai.error.RateLimitError(message, http_status=status, headers=headers)
+    if status >= 500:
+        return openai.error.ServiceUnavailableError(message, http_status=status, headers=headers)
+    if status == 408:
+        return openai.error.Timeout(message, http_status=status, headers=headers)
+    if status == 401:
+        return openai.error.AuthenticationError(message, http_status=status, headers=headers)
+    if status in [400, 404]:
+        return openai.error.InvalidRequestError(message, None, http_status=status, headers=headers)
+    return openai.error.APIError(message, http_status=status, headers=headers)
+
+
+class LLMBackend:
+    def complete(self, model, prompt, temperature, max_tokens, top_p):
+        raise NotImplementedError
+
+    async def acomplete(self, model, prompt, temperature, max_tokens, top_p):
+        raise NotImplementedError
+
+    def embed(self, contexts, model, **kwargs):
+        raise NotImplementedError
+
+    @contextlib.asynccontextmanager
+    async def async_session(self, concurrency=8):
+        yield self
+
+
+class OpenAIBackend(LLMBackend):
+    # The openai package with its module-level key and base URL, as the scripts have always used it.
+    def __init__(self, api_base=None, api_key=None, timeout=None) -> None:
+        self.options = {}
+        if api_base:
+            self.options['api_base'] = api_base
+        if api_key:
+            self.options['api_key'] = api_key
+        if timeout:
+            self.options['request_timeout'] = timeout
+
+    def complete(self, model, prompt, temperature, max_tokens, top_p):
+        if model == 'text-davinci-003':
+            response = openai.Completion.create(model=model, prompt=prompt, temperature=temperature,
+                                                max_tokens=max_tokens, top_p=top_p, logprobs=1, **self.options)
+        else:
+            response = openai.ChatCompletion.create(model=model, messages=prompt, temperature=temperature,
+                                                    max_tokens=max_tokens, top_p=top_p, **self.options)
+        return get_response_text(response)
+
+    async def acomplete(self, model, prompt, temperature, max_tokens, top_p):
+        if model == 'text-davinci-003':
+            response = await openai.Completion.acreate(model=model, prompt=prompt, temperature=temperature,
+                                                       max_tokens=max_tokens, top_p=top_p, logprobs=1, **self.options)
+        else:
+            response = await openai.ChatCompletion.acreate(model=model, messages=prompt, temperature=temperature,
+                                                           max_tokens=max_tokens, top_p=top_p, **self.options)
+        return get_response_text(response)
+
+    def embed(self, contexts, model, **kwargs):
+        response = openai.Embedding.create(input=contexts, model=model, **kwargs, **self.options)
+        data = sorted(response["data"], key=lambda d: d["index"])
+        return [d["embedding"] for d in data]
+
+    @contextlib.asynccontextmanager
+    async def async_session(self, concurrency=8):
+        async with aiohttp.ClientSession() as session:
+            openai.aiosession.set(session)
+            try:
+                yield self
+            finally:
+                openai.aiosession.set(None)
+
+
+class HTTPBackend(LLMBackend):
+    # Talks to any OpenAI-compatible endpoint directly. Connections are kept alive in a pooled requests.Session
+    # (sync) or an aiohttp connector (async), so the TLS handshake is paid once per connection instead of once
+    # per request. Every request carries its own timeout.
+    def __init__(self, api_base=None, api_key=None, timeout=60, pool_size=16) -> None:
+        self.api_base = (api_base or openai.api_base).rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.aiosession = None
+
+    def get_headers(self):
+        return {"Authorization": f"Bearer {self.api_key or openai.api_key}", "Content-Type": "application/json"}
+
+    def post(self, path, body):
+        try:
+            response = self.session.post(f"{self.api_base}{path}", json=body, headers=self.get_headers(),
+                                         timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise openai.error.Timeout(f"Request timed out: {e}")
+        except requests.exceptions.ConnectionError as e:
+            raise openai.error.APIConnectionError(f"Error communicating with {self.api_base}: {e}")
+        if response.status_code != 200:
+            raise get_error(response.status_code, response.text, dict(response.headers))
+        return response.json()
+
+    async def apost(self, path, body):
+        if self.aiosession is None:
+            async with self.async_session():
+                return await self.apost(path, body)
+        try:
+            async with self.aiosession.post(f"{self.api_base}{path}", json=body, headers=self.get_headers(),
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                text = await response.text()
+                if response.status != 200:
+                    raise get_error(response.status, text, dict(response.headers))
+                return await response.json(content_type=None)
+        except asyncio.TimeoutError as e:
+            raise openai.error.Timeout(f"Request timed out: {e}")
+        except aiohttp.ClientError as e:
+            raise openai.error.APIConnectionError(f"Error communicating with {self.api_base}: {e}")
+
+    def complete(self, model, prompt, temperature, max_tokens, top_p):
+        path, body = get_request_body(model, prompt, temperature, max_tokens, top_p)
+        return get_response_text(self.post(path, body))
+
+    async def acomplete(self, model, prompt, temperature, max_tokens, top_p):
+        path, body = get_request_body(model, prompt, temperature, max_tokens, top_p)
+        return get_response_text(await self.apost(path, body))
+
+    def embed(self, contexts, model, **kwargs):
+        response = self.post("/embeddings", {"input": contexts, "model": model, **kwargs})
+        data = sorted(response["data"], key=lambda d: d["index"])
+        return [d["embedding"] for d in data]
+
+    @contextlib.asynccontextmanager
+    async def async_session(self, concurrency=8):
+        connector = aiohttp.TCPConnector(limit=max(self.pool_size, concurrency), keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.aiosession = session
+            try:
+                yield self
+            finally:
+                self.aiosession = None
+
+    def close(self):
+        self.session.close()
+
+
+def make_backend(name='openai', api_base=None, api_key=None, timeout=60, pool_size=16):
+    if name == 'openai':
+        return OpenAIBackend(api_base=api_base, api_key=api_key, timeout=timeout)
+    if name == 'http':
+        return HTTPBackend(api_base=api_base, api_key=api_key, timeout=timeout, pool_size=pool_size)
+    raise ValueError(f"Unknown backend: {name}")
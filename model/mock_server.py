@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def get_mock_answer(body):
+    # Deterministic in the prompt, so cached and uncached runs against the mock give the same answers.
+    prompt = json.dumps(body.get('messages', body.get('prompt')), sort_keys=True)
+    return "Yes." if int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16) % 2 else "No."
+
+
+def get_mock_embedding(text, dim=1536):
+    seed = int(hashlib.sha256(str(text).encode('utf-8')).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        server.count('requests')
+        time.sleep(max(0.0, server.latency + server.jitter * server.random('gauss', 0, 1)))
+
+        draw = server.random('random')
+        if draw < server.error_429:
+            server.count('429')
+            return self.send_json(429, {"error": {"message": "Rate limit reached (mock).", "type": "requests"}},
+                                  headers={"Retry-After": "1"})
+        if draw < server.error_429 + server.error_5xx:
+            status = server.random('choice', [500, 502, 503])
+            server.count(str(status))
+            return self.send_json(status, {"error": {"message": "Server error (mock).", "type": "server_error"}})
+
+        model = body.get('model', 'mock')
+        if self.path.endswith('/chat/completions'):
+            content = get_mock_answer(body)
+            choices = [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            payload = {"object": "chat.completion", "model": model, "choices": choices}
+        elif self.path.endswith('/completions'):
+            choices = [{"index": 0, "text": get_mock_answer(body), "finish_reason": "stop"}]
+            payload = {"object": "text_completion", "model": model, "choices": choices}
+        elif self.path.endswith('/embeddings'):
+            inputs = body.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            data = [{"object": "embedding", "index": ix, "embedding": get_mock_embedding(text)}
+                    for ix, text in enumerate(inputs)]
+            payload = {"object": "list", "model": model, "data": data}
+        else:
+            server.count('404')
+            return self.send_json(404, {"error": {"message": f"Unknown path {self.path}."}})
+        server.count('200')
+        self.send_json(200, payload)
+
+
+class MockServer(ThreadingHTTPServer):
+    # OpenAI-compatible stand-in for benchmarking without network access. Every request waits `latency`
+    # (+- `jitter`) seconds, then fails with 429 with probability error_429 or with a 5xx with probability
+    # error_5xx. stats counts connections, requests and responses by status.
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, jitter=0.05, error_429=0.0, error_5xx=0.0, seed=123):
+        super().__init__((host, port), MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def random(self, method, *args):
+        with self.lock:
+            return getattr(self.rng, method)(*args)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI server",
+                                     prog="Mock Server",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error_429", type=float, default=0.0)
+    parser.add_argument("--error_5xx", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=123)
+    args = parser.parse_args()
+
+    server = MockServer(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                        error_429=args.error_429, error_5xx=args.error_5xx, seed=args.seed)
+    print(f"Serving mock API at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats)
+
+if __name__ == '__main__':
+    main()
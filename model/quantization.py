@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import numpy as np
+
+DTYPES = ['float64', 'float32', 'float16', 'int8']
+
+
+def quantize_int8(vectors: np.ndarray):
+    # Symmetric scalar quantization with one scale per vector: x ~ codes * scale, codes in [-127, 127].
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+class QuantizedMatrix:
+    # Row vectors kept as float64, float32, float16 or int8 with a per-row scale. dot() works on the compact
+    # form: rows are widened to float32 a chunk at a time and multiplied with BLAS, and the int8 scales are
+    # applied to the products rather than to the matrix, so the full-precision matrix is never materialized.
+    # Embeddings share a large common component, so int8 codes store the offset from the mean vector, which
+    # leaves the 255 levels for the part that tells papers apart; the mean is added back as queries @ mean.
+    # weights, when set by normalize_rows, are per-row factors applied last, to products and rows alike.
+    def __init__(self, vectors: np.ndarray, dtype: str = 'float32') -> None:
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}.")
+
+        self.dtype = dtype
+        self.scales = None
+        self.mean = None
+        self.weights = None
+        if vectors is None:
+            return
+        if dtype == 'int8':
+            vectors = np.asarray(vectors, dtype=np.float32)
+            self.mean = vectors.mean(axis=0) if len(vectors) else np.zeros(vectors.shape[1], dtype=np.float32)
+            self.codes, self.scales = quantize_int8(vectors - self.mean)
+        else:
+            self.codes = np.asarray(vectors, dtype=dtype)
+
+    @classmethod
+    def from_int8(cls, codes: np.ndarray, scales: np.ndarray, mean: np.ndarray):
+        # Wraps codes already quantized as above (e.g. the rows of an int8 EmbeddingStore) without requantizing.
+        matrix = cls(None, 'int8')
+        matrix.codes = np.asarray(codes, dtype=np.int8)
+        matrix.scales = np.asarray(scales, dtype=np.float32)
+        matrix.mean = np.asarray(mean, dtype=np.float32)
+        return matrix
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.codes, self.scales, self.mean, self.weights] if a is not None)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        if self.scales is not None:
+            vectors = dequantize_int8(self.codes[rows], self.scales[rows]) + self.mean
+        else:
+            vectors = np.asarray(self.codes[rows], dtype=np.float32)
+        if self.weights is not None:
+            vectors = vectors * self.weights[rows][..., None]
+        return vectors
+
+    def take(self, rows) -> 'QuantizedMatrix':
+        # The given rows as a new matrix in the same compact form.
+        matrix = QuantizedMatrix(None, self.dtype)
+        matrix.codes = self.codes[rows]
+        matrix.scales = None if self.scales is None else self.scales[rows]
+        matrix.mean = self.mean
+        matrix.weights = None if self.weights is None else self.weights[rows]
+        return matrix
+
+    def normalize_rows(self, chunk_rows: int = 16384) -> 'QuantizedMatrix':
+        # Scales every row to unit length through weights, so the codes stay as they are; returns self.
+        norms = np.concatenate([np.linalg.norm(self[start:start + chunk_rows], axis=1)
+                                for start in range(0, len(self), chunk_rows)] or [np.empty(0, dtype=np.float32)])
+        weights = 1 / np.where(norms == 0, 1, norms).astype(np.float32)
+        self.weights = weights if self.weights is None else self.weights * weights
+        return self
+
+    def tobytes(self) -> bytes:
+        return b''.join(a.tobytes() for a in [self.codes, self.scales, self.mean, self.weights] if a is not None)
+
+    def dot(self, queries: np.ndarray, chunk_rows: int = 16384) -> np.ndarray:
+        # Returns queries @ matrix.T with shape (n_queries, n_rows).
+        if self.dtype == 'float64':
+            products = np.asarray(queries, dtype=np.float64) @ self.codes.T
+            return products if self.weights is None else products * self.weights
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.dtype == 'float32':
+            products = queries @ self.codes.T
+            return products if self.weights is None else products * self.weights
+
+        products = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk_rows):
+            products[:, start:start + chunk_rows] = queries @ self.codes[start:start + chunk_rows].astype(np.float32).T
+        if self.scales is not None:
+            products *= self.scales
+            products += (queries @ self.mean)[:, None]
+        if self.weights is not None:
+            products *= self.weights
+        return products
@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 ### author: Jingmei Yang: jmyang@bu.edu
 
-import os, time, csv
+import os
+import asyncio
 import numpy as np
 import pandas as pd
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
 import openai
 openai.api_key = "Your Key"
-from funs import get_output_file,clean_text, get_answer
+from funs import get_output_file,clean_text, get_answer, aget_answer, open_resumable_csv, get_backend, load_embedding_file
 from few_shot_similarity import SimilarShot
 
 def load_train_test_data(file_path, fold):
@@ -17,46 +18,135 @@ def load_train_test_data(file_path, fold):
     return train_df, test_df
 
 class GPTModel:
-    def __init__(self, model, model_type, temperature, logger, file_path):
+    def __init__(self, model, model_type, temperature, logger, file_path, retry_passes=1, neighbour_cache=False):
         self.model = model
         self.model_type = model_type
         self.temperature = temperature
         self.logger = logger
         self.file_path = file_path
+        self.retry_passes = retry_passes
+        self.neighbour_cache = neighbour_cache
+        self.completed_pmids = set()
 
-    def setup_output_directory(self, output_folder, answer_col, fold):
-        csv_file = open(get_output_file(os.path.join(output_folder, answer_col), f"{answer_col}_{fold}.csv"), 'w')
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['PMID', 'Review_Paper', 'Review', f"{answer_col}_{fold}", 'Combined'])
+    def setup_output_directory(self, output_folder, answer_col, fold, resume=False, fsync_every=10):
+        csv_path = get_output_file(os.path.join(output_folder, answer_col), f"{answer_col}_{fold}.csv")
+        header = ['PMID', 'Review_Paper', 'Review', f"{answer_col}_{fold}", 'Combined', 'Model', 'Prompt_tokens']
+        csv_writer, csv_file, self.completed_pmids = open_resumable_csv(csv_path, header, f"{answer_col}_{fold}",
+                                                                        resume=resume, fsync_every=fsync_every)
+        if self.completed_pmids:
+            self.logger.info(f"Resuming {csv_path}: {len(self.completed_pmids)} PMIDs already answered.")
         return csv_writer, csv_file
 
-    def load_test_embeddings(self, fold):
-        test_embeddings = np.load(os.path.join(self.file_path, f'embed_test_{fold}.npz'))["embedding"]
-        return test_embeddings
+    def save_prompt(self, prompt, pmid, output_folder, answer_col, fold):
+        prompt_dir = os.path.join(output_folder, answer_col, f"{answer_col}_{fold}")
+        os.makedirs(prompt_dir, exist_ok=True)
 
-    def get_test_output(self, test_df, csv_writer, output_folder, answer_col, fold):
-        if isinstance(self.model, SimilarShot):
-            test_embeddings = self.load_test_embeddings(fold)
+        with open(os.path.join(prompt_dir, f"{pmid}.txt"), 'w') as file:
+            file.write(str(prompt))
 
-        for ix, row in test_df.iterrows():
-            if isinstance(self.model, SimilarShot):
-                prompt = self.model.get_prompt(context=row['Combined'], test_embedding=test_embeddings[ix])
+    def get_pending_prompts(self, test_df, output_folder, answer_col, fold):
+        # (row, CompiledPrompt) of the papers not answered yet, in test_df order. SimilarShot searches the whole
+        # fold, so its neighbour table is the same whichever papers a resumed run still has to answer.
+        todo = test_df[~test_df['PMID'].astype(str).isin(self.completed_pmids)]
+        if isinstance(self.model, SimilarShot):
+            if self.model.sparse_retriever is not None:
+                queries, query_ids = test_df['Combined'].values, test_df['PMID'].values
+                query_file = os.path.join(self.file_path, f'test_{fold}.csv')
+                query_file = query_file if os.path.exists(query_file) else None
             else:
-                prompt = self.model.get_prompt(context=row['Combined'])
+                query_file = os.path.join(self.file_path, f'embed_test_{fold}.npz')
+                queries, query_ids = load_embedding_file(query_file)
+            table_prefix = os.path.join(self.file_path, f'neighbours_test_{fold}') if self.neighbour_cache else None
+            prompts = self.model.get_prompts(todo, queries, query_ids, table_prefix, query_file)
+        else:
+            prompts = self.model.get_prompts(todo)
+
+        pending = []
+        for (_, row), (pmid, compiled) in zip(todo.iterrows(), prompts):
+            self.save_prompt(compiled.prompt, pmid, output_folder, answer_col, fold)
+            pending.append((row, compiled))
+        return pending
+
+    def write_answer(self, csv_writer, row, compiled, answer):
+        csv_writer.writerow([row['PMID'], row['Review_Paper'], row['Review'], answer, row['Combined'],
+                             compiled.model_type, compiled.n_tokens])
+
+    def write_answers(self, csv_writer, pending, answers, written):
+        # Writes the answers that follow the first `written` rows of pending without a gap and returns the new
+        # count. A row waits for every row before it, failed ones included, so the file keeps test_df order
+        # whichever pass answers a PMID, and everything written is final if the run is stopped.
+        while written < len(pending) and answers[written] is not None:
+            row, compiled = pending[written]
+            self.write_answer(csv_writer, row, compiled, answers[written])
+            written += 1
+        return written
+
+    def write_errors(self, csv_writer, pending, answers, written):
+        # After the last pass, PMIDs still without an answer are written as ERROR, in place.
+        answers = ['ERROR' if answer is None else answer for answer in answers]
+        self.write_answers(csv_writer, pending, answers, written)
+        csv_writer.sync()
 
-            prompt_dir = os.path.join(output_folder, answer_col, f"{answer_col}_{fold}")
-            os.makedirs(prompt_dir, exist_ok=True)
+    def query_answer_sync(self, pmid, compiled):
+        try:
+            return clean_text(get_answer(model=compiled.model_type, prompt=compiled.prompt, TMP=self.temperature))
 
-            with open(os.path.join(prompt_dir, f"{row['PMID']}.txt"), 'w') as file:
-                file.write(str(prompt))
+        except Exception as e:
+            self.logger.error(f"Exception occurred with PMID: {pmid}, error: {e}", exc_info=True)
+            return None
 
+    def get_test_output(self, test_df, csv_writer, output_folder, answer_col, fold):
+        pending = self.get_pending_prompts(test_df, output_folder, answer_col, fold)
+
+        # A failed request is retried after the rest of the fold instead of being written as the final answer.
+        answers, written = [None] * len(pending), 0
+        for attempt in range(self.retry_passes + 1):
+            todo = [ix for ix, answer in enumerate(answers) if answer is None]
+            if attempt > 0 and todo:
+                self.logger.info(f"Retry pass {attempt}: {len(todo)} PMIDs.")
+            for ix in todo:
+                row, compiled = pending[ix]
+                answers[ix] = self.query_answer_sync(row['PMID'], compiled)
+                written = self.write_answers(csv_writer, pending, answers, written)
+        self.write_errors(csv_writer, pending, answers, written)
+
+    async def query_answer(self, semaphore, pmid, compiled):
+        async with semaphore:
             try:
-                answer = clean_text(get_answer(model=self.model_type, prompt=prompt, TMP=self.temperature))
+                return clean_text(await aget_answer(model=compiled.model_type, prompt=compiled.prompt, TMP=self.temperature))
 
             except Exception as e:
-                self.logger.error(f"Exception occurred with PMID: {row['PMID']}, error: {e}", exc_info=True)
-                answer = 'ERROR'
-                time.sleep(60)
+                self.logger.error(f"Exception occurred with PMID: {pmid}, error: {e}", exc_info=True)
+                return None
+
+    async def query_pending(self, semaphore, pending, answers, csv_writer, written):
+        # Queries every row of pending without an answer, all at once, and writes the answers as they become
+        # writable (see write_answers); returns the new number of rows written.
+        tasks = [(ix, asyncio.ensure_future(self.query_answer(semaphore, pending[ix][0]['PMID'], pending[ix][1])))
+                 for ix, answer in enumerate(answers) if answer is None]
+        for ix, task in tasks:
+            answers[ix] = await task
+            written = self.write_answers(csv_writer, pending, answers, written)
+        return written
+
+    async def query_test_output(self, test_df, csv_writer, output_folder, answer_col, fold, concurrency):
+        # Prompts are built in row order, so that with sampling='global' the examples match the sequential run.
+        pending = self.get_pending_prompts(test_df, output_folder, answer_col, fold)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        async with get_backend().async_session(concurrency):
+            await self.query_fold(semaphore, pending, csv_writer)
+
+    async def query_fold(self, semaphore, pending, csv_writer):
+        # The semaphore may be shared with other folds and configurations (see run_grid.py). Rows are written in
+        # pending order, as in get_test_output.
+        answers, written = [None] * len(pending), 0
+        for attempt in range(self.retry_passes + 1):
+            todo = answers.count(None)
+            if attempt > 0 and todo:
+                self.logger.info(f"Retry pass {attempt}: {todo} PMIDs.")
+            written = await self.query_pending(semaphore, pending, answers, csv_writer, written)
+        self.write_errors(csv_writer, pending, answers, written)
 
-            csv_writer.writerow([row['PMID'], row['Review_Paper'], row['Review'], answer, row['Combined']])
-            time.sleep(2 if ix % 5 == 0 and ix != 0 else 1)
+    def get_test_output_async(self, test_df, csv_writer, output_folder, answer_col, fold, concurrency=8):
+        asyncio.run(self.query_test_output(test_df, csv_writer, output_folder, answer_col, fold, concurrency))
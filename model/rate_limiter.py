@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os, time
+import asyncio
+import sqlite3
+import threading
+
+
+class RateLimiter:
+    # Two token buckets, one for requests per minute and one for tokens per minute, both refilled
+    # continuously. When state_path is given the buckets live in a SQLite file and every update runs
+    # inside BEGIN IMMEDIATE, so all processes pointing at the same file share one budget. burst caps how
+    # many requests can go out back to back after an idle period (rpm by default).
+    def __init__(self,
+                 rpm: float,
+                 tpm: float = None,
+                 state_path: str = None,
+                 name: str = 'default',
+                 burst: float = None) -> None:
+
+        if rpm is None or rpm <= 0:
+            raise ValueError("rpm must be positive.")
+        if tpm is not None and tpm <= 0:
+            raise ValueError("tpm must be positive.")
+        if burst is not None and burst < 1:
+            raise ValueError("burst must be at least 1.")
+
+        self.rpm = float(rpm)
+        self.tpm = float(tpm) if tpm is not None else None
+        self.name = name
+        self.burst = float(burst) if burst is not None else self.rpm
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.state = (self.burst, self.tpm or 0.0, time.time())
+
+        if self.state_path is not None:
+            state_dir = os.path.dirname(self.state_path)
+            if state_dir:
+                os.makedirs(state_dir, exist_ok=True)
+            self.conn = sqlite3.connect(self.state_path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                              "(name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)")
+
+    def refill(self, requests, tokens, updated, now):
+        elapsed = max(0.0, now - updated)
+        requests = min(self.burst, requests + elapsed * self.rpm / 60)
+        if self.tpm is not None:
+            tokens = min(self.tpm, tokens + elapsed * self.tpm / 60)
+        return requests, tokens
+
+    def take(self, requests, tokens, cost):
+        # A single request larger than the whole TPM budget is let through once the bucket is full.
+        if self.tpm is not None:
+            cost = min(cost, self.tpm)
+        wait = 0.0
+        if requests < 1:
+            wait = (1 - requests) * 60 / self.rpm
+        if self.tpm is not None and tokens < cost:
+            wait = max(wait, (cost - tokens) * 60 / self.tpm)
+        if wait > 0:
+            return requests, tokens, wait
+        return requests - 1, tokens - cost, 0.0
+
+    def reserve(self, cost: int = 0) -> float:
+        now = time.time()
+        with self.lock:
+            if self.state_path is None:
+                requests, tokens = self.refill(*self.state, now)
+                requests, tokens, wait = self.take(requests, tokens, cost)
+                self.state = (requests, tokens, now)
+                return wait
+
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT requests, tokens, updated FROM buckets WHERE name = ?",
+                                        (self.name,)).fetchone()
+                if row is None:
+                    row = (self.burst, self.tpm or 0.0, now)
+                requests, tokens = self.refill(*row, now)
+                requests, tokens, wait = self.take(requests, tokens, cost)
+                self.conn.execute("INSERT OR REPLACE INTO buckets (name, requests, tokens, updated) VALUES (?, ?, ?, ?)",
+                                  (self.name, requests, tokens, now))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return wait
+
+    def acquire(self, cost: int = 0) -> None:
+        while True:
+            wait = self.reserve(cost)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, cost: int = 0) -> None:
+        # A shared bucket can wait up to 60 s on the SQLite lock, so it is reserved in a worker thread rather
+        # than on the event loop.
+        while True:
+            if self.state_path is None:
+                wait = self.reserve(cost)
+            else:
+                wait = await asyncio.to_thread(self.reserve, cost)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
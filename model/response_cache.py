@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os, time, json
+import atexit
+import asyncio
+import hashlib
+import sqlite3
+import threading
+
+
+class ResponseCache:
+    # Completed answers are stored in SQLite under a sha256 of the request parameters. Identical
+    # requests issued while the first one is still in flight wait for its answer instead of
+    # reaching the API a second time. A hit only reads: the access times used for eviction are
+    # kept in memory and written in one transaction every flush_every hits, on put and on close.
+    def __init__(self,
+                 cache_path: str,
+                 max_bytes: int = 1024 ** 3,
+                 cache_all_temperatures: bool = False,
+                 flush_every: int = 256) -> None:
+
+        if not isinstance(cache_path, str):
+            raise TypeError("cache_path must be string.")
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive.")
+
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.cache_all_temperatures = cache_all_temperatures
+        self.lock = threading.Lock()
+        self.flush_every = flush_every
+        self.accessed = {}
+        self.pending = {}
+        self.async_pending = {}
+
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(self.cache_path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                          "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        atexit.register(self.close)
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, top_p) -> str:
+        payload = json.dumps([model, messages, temperature, max_tokens, top_p], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def accepts(self, temperature) -> bool:
+        # Sampled answers (temperature > 0) feed the ensemble runs and must stay independent draws.
+        return self.cache_all_temperatures or temperature == 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= self.flush_every:
+                self.flush()
+            return row[0]
+
+    def flush(self) -> None:
+        # Writes the pending access times; the caller holds the lock.
+        if self.accessed:
+            self.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?",
+                                  [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed = {}
+        self.conn.commit()
+
+    def put(self, key, response) -> None:
+        size = len(key) + len(response.encode('utf-8'))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+                              (key, response, size, time.time()))
+            self.accessed.pop(key, None)
+            self.flush()
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        # Least recently used entries go first, down to 90% of the limit so eviction does not run on every put.
+        # They are read from the accessed index page_size at a time, oldest first, never the whole table.
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        page_size = 1000
+        while self.total_bytes > target:
+            expired = []
+            for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC LIMIT ?",
+                                               (page_size,)):
+                if self.total_bytes <= target:
+                    break
+                expired.append((key,))
+                self.total_bytes -= size
+            if not expired:
+                break
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", expired)
+        self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.conn is None:
+                return
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def get_or_compute(self, key, compute):
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        with self.lock:
+            waiter = self.pending.get(key)
+            if waiter is None:
+                self.pending[key] = threading.Event()
+
+        if waiter is not None:
+            waiter.wait()
+            response = self.get(key)
+            if response is not None:
+                return response
+            return self.get_or_compute(key, compute)
+
+        try:
+            response = compute()
+            self.put(key, response)
+            return response
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    async def aget_or_compute(self, key, compute):
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        waiter = self.async_pending.get(key)
+        if waiter is not None:
+            return await asyncio.shield(waiter)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.async_pending[key] = waiter
+        try:
+            response = await compute()
+            self.put(key, response)
+            waiter.set_result(response)
+            return response
+        except Exception as e:
+            waiter.set_exception(e)
+            # Retrieve the exception so an unobserved future does not log "exception was never retrieved".
+            waiter.exception()
+            raise
+        except BaseException:
+            waiter.cancel()
+            raise
+        finally:
+            self.async_pending.pop(key, None)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os
+import copy
+import numpy as np
+import pandas as pd
+from typing import Tuple
+from funs import load_embedding_file, match_pmids, get_file_identity, get_embedding_file_identity
+from quantization import QuantizedMatrix
+from ann_index import IVFIndex
+from sparse_retriever import SparseRetriever
+
+
+def parse_corpora(spec: str) -> dict:
+    # "Nipah=./path/to/general,COVID=./other/general" -> {'Nipah': './path/to/general', 'COVID': './other/general'}
+    return dict(item.split('=', 1) for item in spec.split(',') if item)
+
+
+def parse_filter(spec: str) -> dict:
+    # "corpus=COVID|Nipah,label=1,min_year=2020" -> {'corpus': ['COVID', 'Nipah'], 'label': 1, 'min_year': 2020}
+    retrieval_filter = {}
+    for item in spec.split(','):
+        if not item:
+            continue
+        key, value = item.split('=', 1)
+        retrieval_filter[key] = value.split('|') if key == 'corpus' else int(value)
+    return retrieval_filter
+
+
+class RetrievalIndex:
+    # Training papers of several corpora in one normalized matrix, with a metadata frame (corpus, Label, every
+    # *_TF column, Year) aligned to its rows. Base filters are precomputed as packed bitmasks; a query filter is
+    # their bitwise AND, unpacked once and cached, and it is applied by masking similarities, so no DataFrame is
+    # built per query. Without embeddings only the sparse retrievers can search it.
+    def __init__(self, frames, embeddings=None, embedding_dtype: str = 'float32') -> None:
+        self.frame = pd.concat(frames, ignore_index=True)
+        self.frame['Label'] = self.frame['Review'].apply(lambda x: 1 if 'YES' in x.upper() else 0)
+        self.matrix = None
+        if embeddings is not None:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            self.matrix = QuantizedMatrix(embeddings / np.where(norms == 0, 1, norms), embedding_dtype)
+
+        self.bitmasks = {('corpus', corpus): np.packbits(self.frame['corpus'].values == corpus)
+                         for corpus in self.frame['corpus'].unique()}
+        for label in [0, 1]:
+            self.bitmasks[('label', label)] = np.packbits(self.frame['Label'].values == label)
+        for column in [c for c in self.frame.columns if c.endswith('_TF')]:
+            self.bitmasks[('correct', column[:-len('_TF')])] = np.packbits(self.frame[column].values == self.frame['Label'].values)
+        year = self.frame['Year'] if 'Year' in self.frame else pd.Series(np.nan, index=self.frame.index)
+        self.year = pd.to_numeric(year, errors='coerce').values
+        self.masks = {}
+        self.ann_index = None
+        self.sparse_retrievers = {}
+        # Files the index was built from, as paths and as get_file_identity versions (see SimilarShot.search_table).
+        self.source_paths = None
+        self.sources = None
+
+    @classmethod
+    def from_folds(cls, corpora: dict, fold: int, embedding_dtype: str = 'float32', load_embeddings: bool = True):
+        # corpora: corpus name -> cross-validation directory holding train_{fold}.csv and embed_train_{fold}.npz.
+        frames, embeddings, source_paths, sources = [], [], [], []
+        for corpus, data_dir in corpora.items():
+            train_file = os.path.join(data_dir, f'train_{fold}.csv')
+            source_paths.append((corpus, train_file))
+            sources.append(get_file_identity(train_file))
+            train_df = pd.read_csv(train_file)
+            if not load_embeddings:
+                frames.append(train_df.assign(corpus=corpus))
+                continue
+            embedding_file = os.path.join(data_dir, f'embed_train_{fold}.npz')
+            source_paths.append((corpus, embedding_file))
+            sources.append(get_embedding_file_identity(embedding_file))
+            corpus_embeddings, ids = load_embedding_file(embedding_file)
+            # Rows follow train_df; papers without an embedding are left out.
+            train_rows, rows = match_pmids(train_df['PMID'].values, ids)
+            frames.append(train_df.iloc[train_rows].assign(corpus=corpus))
+            embeddings.append(np.asarray(corpus_embeddings[rows]))
+        index = cls(frames, np.concatenate(embeddings) if embeddings else None, embedding_dtype)
+        index.source_paths, index.sources = tuple(source_paths), tuple(sources)
+        return index
+
+    def __len__(self):
+        return len(self.frame)
+
+    def get_mask(self, corpus=None, label: int = None, correct: str = None,
+                 min_year: int = None, max_year: int = None) -> np.ndarray:
+        # correct=<explanation column> keeps papers whose <column>_TF flag agrees with the label, as the CoT
+        # filter of SimilarShot does. Papers without a year are dropped by a year bound.
+        key = (tuple(corpus) if isinstance(corpus, (list, tuple)) else corpus, label, correct, min_year, max_year)
+        if key not in self.masks:
+            bits = np.packbits(np.ones(len(self), dtype=bool))
+            if corpus is not None:
+                corpora = corpus if isinstance(corpus, (list, tuple)) else [corpus]
+                any_corpus = np.zeros_like(bits)
+                for name in corpora:
+                    any_corpus |= self.bitmasks.get(('corpus', name), np.zeros_like(bits))
+                bits &= any_corpus
+            if label is not None:
+                bits &= self.bitmasks[('label', label)]
+            if correct is not None:
+                if ('correct', correct) not in self.bitmasks:
+                    raise KeyError(f"The retrieval index has no {correct}_TF column.")
+                bits &= self.bitmasks[('correct', correct)]
+            if min_year is not None:
+                bits &= np.packbits(self.year >= min_year)
+            if max_year is not None:
+                bits &= np.packbits(self.year <= max_year)
+            self.masks[key] = np.unpackbits(bits, count=len(self)).astype(bool)
+        return self.masks[key]
+
+    def get_ann_index(self, nprobe: int = 8) -> IVFIndex:
+        # IVF index over every row, ids being frame positions. It is built once and shared; each caller gets a
+        # copy with its own nprobe. Positions only hold for this frame, so the index is not saved.
+        if self.ann_index is None:
+            self.ann_index = IVFIndex()
+            self.ann_index.add(self.matrix[np.arange(len(self))], np.arange(len(self)))
+        ann_index = copy.copy(self.ann_index)
+        ann_index.nprobe = nprobe
+        return ann_index
+
+    def get_sparse_retriever(self, method: str = 'bm25') -> SparseRetriever:
+        # Fitted on the Combined text of every row, so document positions are frame positions.
+        if method not in self.sparse_retrievers:
+            self.sparse_retrievers[method] = SparseRetriever(method).fit(self.frame['Combined'].values)
+        return self.sparse_retrievers[method]
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray,
+               chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns frame positions of the k most similar papers that pass mask, best first, and their similarities;
+        # fewer than k columns when fewer papers pass mask.
+        k = min(k, int(np.count_nonzero(mask)))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        positions = np.empty((len(queries), k), dtype=int)
+        scores = np.empty((len(queries), k))
+        for start in range(0, len(queries) if k > 0 else 0, chunk_size):
+            similarities = self.matrix.dot(queries[start:start + chunk_size])
+            similarities[:, ~mask] = -np.inf
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            positions[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+            scores[start:start + chunk_size] = np.take_along_axis(top_scores, order, axis=1)
+        return positions, scores
@@ -5,9 +5,14 @@ import pandas as pd
 import numpy as np
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-from funs import read_file, setup_logger
+from funs import read_file, setup_logger, set_rate_limiter, set_response_cache, set_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from token_budget import TokenBudget
+from response_cache import ResponseCache
 from few_shot import FewShot
 from query_output_gpt import GPTModel, load_train_test_data
+from batch_query import BatchClient, LocalBatchClient, run_batch
 import openai
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
@@ -26,6 +31,8 @@ def parse_args():
     parser.add_argument("--cot_path", type=str, default='./model/input/cot_prompt.txt')
     parser.add_argument("--noncot_path", type=str, default='./model/input/noncot_prompt.txt')
     parser.add_argument("--sub_path", type=str, default='./model/input/subquestion_prompt.txt')
+    parser.add_argument("--sampling", type=str, default='pmid', choices=['pmid', 'global'])
+    parser.add_argument("--sample_seed", type=int, default=RANDOM_STATE)
     parser.add_argument("--num_fold", type=int, default=5)
     parser.add_argument("--definition_path", type=str, default='./model/input/definitions.txt')
     parser.add_argument("--save_dir", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets/general')
@@ -37,13 +44,39 @@ def parse_args():
     parser.add_argument("--positive_first", type=int, default=0)
     parser.add_argument("--answer_col", type=str, default='Nipah_Q2_FewCoT')
     parser.add_argument("--log_path", type=str, default='./model/output/Nipah/cross_validation_output/few_shot.log')
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rpm", type=float, default=3500)
+    parser.add_argument("--tpm", type=float, default=90000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_path", type=str, default='./model/output/response_cache.sqlite')
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--resume", type=int, default=0)
+    parser.add_argument("--retry_passes", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--batch_local", type=int, default=0)
+    parser.add_argument("--batch_poll", type=int, default=60)
+    parser.add_argument("--batch_max_wait", type=float, default=25 * 3600, help="seconds to poll a batch before giving up")
+    parser.add_argument("--max_prompt_tokens", type=int, default=0)
+    parser.add_argument("--overflow", type=str, default='route', choices=['route', 'trim'])
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
     args = parser.parse_args()
     return args
 
 def main():
     args = parse_args()
     logger = setup_logger(args.log_path)
-
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout,
+                             pool_size=max(args.pool_size, args.concurrency)))
+    if bool(args.use_cache):
+        set_response_cache(ResponseCache(args.cache_path, max_bytes=args.cache_size_mb * 1024 ** 2))
+
+    token_budget = TokenBudget(args.gpt_model, max_prompt_tokens=args.max_prompt_tokens or None, overflow=args.overflow)
+    jobs = []
     for fold in range(args.num_fold):
         train_df, test_df = load_train_test_data(args.save_dir, fold)
 
@@ -61,23 +94,43 @@ def main():
                           positive_first=bool(args.positive_first),
                           explanation_column=args.explanation_col,
                           SUB=bool(args.sub),
-                          COT=bool(args.cot))
+                          COT=bool(args.cot),
+                          token_budget=token_budget,
+                          sampling=args.sampling,
+                          seed=args.sample_seed,
+                          fold=fold)
 
         gpt_model = GPTModel(model=fewshot,
                              model_type=args.gpt_model,
                              temperature=args.temperature,
                              logger=logger,
-                             file_path=args.save_dir)
+                             file_path=args.save_dir,
+                             retry_passes=args.retry_passes)
+
+        if bool(args.batch):
+            jobs.append((fold, gpt_model, test_df))
+            continue
 
-        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold)
+        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold,
+                                                                  resume=bool(args.resume))
 
         logger.info(f"\nFew Shot:  {args.answer_col} \nFold: {fold}\n")
         logger.info(f"{args.explanation_col}")
         logger.info(f"\nOutput Directory: {args.output_folder}")
 
 
-        gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
+        if args.concurrency > 1:
+            gpt_model.get_test_output_async(test_df, csv_writer, args.output_folder, args.answer_col, fold,
+                                            concurrency=args.concurrency)
+        else:
+            gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
         csv_file.close()
+
+    if bool(args.batch):
+        client = LocalBatchClient() if bool(args.batch_local) else \
+            BatchClient(api_base=args.api_base, poll_interval=args.batch_poll, max_wait=args.batch_max_wait)
+        run_batch(jobs, client, args.output_folder, args.answer_col, logger, resume=bool(args.resume))
+
 if __name__ == '__main__':
     main()
 
@@ -2,13 +2,18 @@
 ### author: Jingmei Yang: jmyang@bu.edu
 
 import os, argparse
-import pandas as pd
 import numpy as np
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-from funs import read_file, setup_logger
+from funs import read_file, setup_logger, set_rate_limiter, set_response_cache, set_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from token_budget import TokenBudget
+from response_cache import ResponseCache
 from few_shot_similarity import SimilarShot
+from retrieval_index import RetrievalIndex, parse_corpora, parse_filter
 from query_output_gpt import GPTModel, load_train_test_data
+from batch_query import BatchClient, LocalBatchClient, run_batch
 import openai
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
@@ -20,6 +25,8 @@ def parse_args():
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--sars", type=int, default=0)
     parser.add_argument("--covid_path", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets/general')
+    parser.add_argument("--corpora", type=str, default='', help="name=cross_validation_dir,... retrieved from as one index")
+    parser.add_argument("--retrieval_filter", type=str, default='', help="e.g. corpus=COVID,label=1,min_year=2020")
     parser.add_argument("--question_path", type=str, default='./model/input/Q2.txt')
     parser.add_argument("--temperature", type=float, default=0)
     parser.add_argument("--gpt_model", type=str, default="gpt-3.5-turbo")
@@ -37,6 +44,30 @@ def parse_args():
     parser.add_argument("--answer_col", type=str, default='Nipah_Q2_SimilarCoT')
     parser.add_argument("--log_path", type=str, default='./model/output/Nipah/cross_validation_output/similar_shot.log')
     parser.add_argument("--top_n_similar", type=int, default=2)
+    parser.add_argument("--neighbour_cache", type=int, default=1)
+    parser.add_argument("--ann_index", type=str, default='none', choices=['none', 'ivf'])
+    parser.add_argument("--ann_nprobe", type=int, default=8)
+    parser.add_argument("--retriever", type=str, default='dense', choices=['dense', 'bm25', 'tfidf'])
+    parser.add_argument("--embedding_dtype", type=str, default='float32', choices=['float64', 'float32', 'float16', 'int8'])
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rpm", type=float, default=3500)
+    parser.add_argument("--tpm", type=float, default=90000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_path", type=str, default='./model/output/response_cache.sqlite')
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--resume", type=int, default=0)
+    parser.add_argument("--retry_passes", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--batch_local", type=int, default=0)
+    parser.add_argument("--batch_poll", type=int, default=60)
+    parser.add_argument("--batch_max_wait", type=float, default=25 * 3600, help="seconds to poll a batch before giving up")
+    parser.add_argument("--max_prompt_tokens", type=int, default=0)
+    parser.add_argument("--overflow", type=str, default='route', choices=['route', 'trim'])
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
     args = parser.parse_args()
     return args
 
@@ -45,14 +76,28 @@ def parse_args():
 def main():
     args = parse_args()
     logger = setup_logger(args.log_path)
-
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout,
+                             pool_size=max(args.pool_size, args.concurrency)))
+    if bool(args.use_cache):
+        set_response_cache(ResponseCache(args.cache_path, max_bytes=args.cache_size_mb * 1024 ** 2))
+
+    token_budget = TokenBudget(args.gpt_model, max_prompt_tokens=args.max_prompt_tokens or None, overflow=args.overflow)
+    jobs = []
     for fold in range(args.num_fold):
         train_df, test_df = load_train_test_data(args.save_dir, fold)
+        train_file = os.path.join(args.save_dir, f'train_{fold}.csv')
         embedd_train_file = os.path.join(args.save_dir, f'embed_train_{fold}.npz')
 
-        if bool(args.sars):
-            train_df = pd.read_csv(f'{args.covid_path}/train_{fold}.csv')
-            embedd_train_file = os.path.join(args.covid_path, f'embed_train_{fold}.npz')
+        # --sars is the one-corpus case of --corpora: examples come from the COVID training fold.
+        corpora = parse_corpora(args.corpora) or ({'COVID': args.covid_path} if bool(args.sars) else {})
+        retrieval_index = None
+        if corpora:
+            retrieval_index = RetrievalIndex.from_folds(corpora, fold, args.embedding_dtype,
+                                                        load_embeddings=args.retriever == 'dense')
+        ann_index_path = None
+        if args.ann_index == 'ivf':
+            ann_index_path = os.path.join(os.path.dirname(embedd_train_file), f'ivf_train_{fold}.npz')
 
         similar_shot = SimilarShot(train_df=train_df,
                                    embedd_train_file=embedd_train_file,
@@ -66,22 +111,47 @@ def main():
                                    explanation_column=args.explanation_col,
                                    top_n_similar=args.top_n_similar,
                                    SUB=bool(args.sub),
-                                   COT=bool(args.cot))
+                                   COT=bool(args.cot),
+                                   token_budget=token_budget,
+                                   ann_index_path=ann_index_path,
+                                   ann_nprobe=args.ann_nprobe,
+                                   embedding_dtype=args.embedding_dtype,
+                                   retrieval_index=retrieval_index,
+                                   retrieval_filter=parse_filter(args.retrieval_filter),
+                                   retriever=args.retriever,
+                                   train_file=train_file)
 
         gpt_model = GPTModel(model=similar_shot,
                              model_type=args.gpt_model,
                              temperature=args.temperature,
                              logger=logger,
-                             file_path=args.save_dir)
+                             file_path=args.save_dir,
+                             retry_passes=args.retry_passes,
+                             neighbour_cache=bool(args.neighbour_cache))
+
+        if bool(args.batch):
+            jobs.append((fold, gpt_model, test_df))
+            continue
 
-        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold)
+        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold,
+                                                                  resume=bool(args.resume))
 
         logger.info(f"\nSimilar Shot:  {args.answer_col} \nFold: {fold}\n")
         logger.info(f"{args.explanation_col}")
         logger.info(f"\nOutput Directory: {args.output_folder}")
-        gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
+        if args.concurrency > 1:
+            gpt_model.get_test_output_async(test_df, csv_writer, args.output_folder, args.answer_col, fold,
+                                            concurrency=args.concurrency)
+        else:
+            gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
 
         csv_file.close()
+
+    if bool(args.batch):
+        client = LocalBatchClient() if bool(args.batch_local) else \
+            BatchClient(api_base=args.api_base, poll_interval=args.batch_poll, max_wait=args.batch_max_wait)
+        run_batch(jobs, client, args.output_folder, args.answer_col, logger, resume=bool(args.resume))
+
 if __name__ == '__main__':
     main()
 
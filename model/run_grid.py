@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import os, json, argparse
+import asyncio
+import itertools
+from functools import lru_cache
+import pandas as pd
+import numpy as np
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+from funs import read_file, setup_logger, set_rate_limiter, set_response_cache, set_backend, get_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from token_budget import TokenBudget
+from response_cache import ResponseCache
+from zero_shot import ZeroShot
+from few_shot import FewShot
+from few_shot_similarity import SimilarShot
+from retrieval_index import RetrievalIndex, parse_corpora, parse_filter
+from query_output_gpt import GPTModel
+import openai
+openai.api_key = "Your Key"
+RANDOM_STATE = 123
+np.random.seed(RANDOM_STATE)
+
+METHODS = ['zero', 'few', 'similar']
+
+# Same defaults as the flags of run_zero.py, run_few_random.py and run_few_similar.py.
+DEFAULTS = {'method': 'zero',
+            'gpt_model': 'gpt-3.5-turbo',
+            'temperature': 0,
+            'system_path': './model/input/system.txt',
+            'question_path': './model/input/Q2.txt',
+            'definition_path': './model/input/definitions.txt',
+            'cot_path': './model/input/cot_prompt.txt',
+            'noncot_path': './model/input/noncot_prompt.txt',
+            'sub_path': './model/input/subquestion_prompt.txt',
+            'num_fold': 5,
+            'save_dir': './data_preparation/output/datasets/Nipah/cross_validation_datasets/general',
+            'output_folder': './model/output/Nipah/cross_validation_output',
+            'cot': 1,
+            'sub': 0,
+            'explanation_col': 'Generated_zero_cot',
+            'positive_first': 0,
+            'sampling': 'pmid',
+            'sample_seed': RANDOM_STATE,
+            'top_n_similar': 2,
+            'neighbour_cache': 1,
+            'ann_index': 'none',
+            'ann_nprobe': 8,
+            'retriever': 'dense',
+            'embedding_dtype': 'float32',
+            'sars': 0,
+            'covid_path': './data_preparation/output/datasets/Nipah/cross_validation_datasets/general',
+            'corpora': '',
+            'retrieval_filter': '',
+            'max_prompt_tokens': 0,
+            'overflow': 'route'}
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Running an experiment grid",
+                                   prog = "Grid",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--config", type=str, default='./model/grid_config.yaml')
+    parser.add_argument("--log_path", type=str, default='./model/output/Nipah/cross_validation_output/grid.log')
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rpm", type=float, default=3500)
+    parser.add_argument("--tpm", type=float, default=90000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_path", type=str, default='./model/output/response_cache.sqlite')
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--resume", type=int, default=0)
+    parser.add_argument("--retry_passes", type=int, default=1)
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
+    args = parser.parse_args()
+    return args
+
+
+def expand_experiment(experiment):
+    # An optional `grid` entry maps keys to lists of values; one experiment is produced per combination and
+    # answer_col is formatted with its values, e.g. "Nipah_Q2_{method}_cot{cot}".
+    grid = experiment.pop('grid', None) or {}
+    keys = list(grid)
+    for values in itertools.product(*[grid[key] for key in keys]):
+        expanded = {**experiment, **dict(zip(keys, values))}
+        expanded['answer_col'] = expanded['answer_col'].format(**expanded)
+        yield expanded
+
+
+def load_config(config_path):
+    with open(config_path, 'r') as f:
+        if config_path.endswith(('.yaml', '.yml')):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    defaults = {**DEFAULTS, **(config.get('defaults') or {})}
+    experiments = []
+    for experiment in config['experiments']:
+        if 'answer_col' not in experiment:
+            raise ValueError(f"Experiment without answer_col: {experiment}")
+        experiments += list(expand_experiment({**defaults, **experiment}))
+
+    outputs = set()
+    for experiment in experiments:
+        if experiment['method'] not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}, got {experiment['method']}.")
+        output = (os.path.abspath(experiment['output_folder']), experiment['answer_col'])
+        if output in outputs:
+            raise ValueError(f"Two experiments write to {experiment['answer_col']} in {experiment['output_folder']}.")
+        outputs.add(output)
+    return experiments
+
+
+@lru_cache(maxsize=None)
+def read_split(data_dir, split, fold):
+    # Each fold is read once however many configurations use it; callers copy the frame before changing it.
+    return pd.read_csv(f'{data_dir}/{split}_{fold}.csv')
+
+
+@lru_cache(maxsize=None)
+def get_retrieval_index(corpora, fold, embedding_dtype, load_embeddings):
+    # Shared by every similar-shot configuration of the fold that retrieves from the same corpora.
+    return RetrievalIndex.from_folds(dict(corpora), fold, embedding_dtype, load_embeddings)
+
+
+def make_prompt_builder(experiment, fold, token_budget):
+    prompts = dict(model_type=experiment['gpt_model'],
+                   system=read_file(experiment['system_path']),
+                   definition=read_file(experiment['definition_path']),
+                   question=read_file(experiment['question_path']),
+                   cot_prompt=read_file(experiment['cot_path']),
+                   noncot_prompt=read_file(experiment['noncot_path']),
+                   subquestion_prompt=read_file(experiment['sub_path']),
+                   COT=bool(experiment['cot']),
+                   SUB=bool(experiment['sub']),
+                   token_budget=token_budget)
+    if experiment['method'] == 'zero':
+        return ZeroShot(**prompts)
+
+    train_dir = experiment['covid_path'] if bool(experiment['sars']) else experiment['save_dir']
+    train_df = read_split(train_dir, 'train', fold).copy()
+    if experiment['method'] == 'few':
+        return FewShot(train_df=train_df,
+                       positive_first=bool(experiment['positive_first']),
+                       sampling=experiment['sampling'],
+                       seed=experiment['sample_seed'],
+                       fold=fold,
+                       explanation_column=experiment['explanation_col'],
+                       **prompts)
+    ann_index_path = os.path.join(train_dir, f'ivf_train_{fold}.npz') if experiment['ann_index'] == 'ivf' else None
+    corpora = parse_corpora(experiment['corpora']) or ({'COVID': train_dir} if bool(experiment['sars']) else {})
+    retrieval_index = None
+    if corpora:
+        retrieval_index = get_retrieval_index(tuple(corpora.items()), fold, experiment['embedding_dtype'],
+                                              experiment['retriever'] == 'dense')
+    return SimilarShot(train_df=train_df,
+                       embedd_train_file=os.path.join(train_dir, f'embed_train_{fold}.npz'),
+                       explanation_column=experiment['explanation_col'],
+                       top_n_similar=experiment['top_n_similar'],
+                       ann_index_path=ann_index_path,
+                       ann_nprobe=experiment['ann_nprobe'],
+                       embedding_dtype=experiment['embedding_dtype'],
+                       retrieval_index=retrieval_index,
+                       retrieval_filter=parse_filter(experiment['retrieval_filter']),
+                       retriever=experiment['retriever'],
+                       train_file=f'{train_dir}/train_{fold}.csv',
+                       **prompts)
+
+
+async def query_unit(semaphore, unit, logger):
+    answer_col, fold, gpt_model, csv_writer, csv_file, pending = unit
+    await gpt_model.query_fold(semaphore, pending, csv_writer)
+    csv_file.close()
+    logger.info(f"Finished {answer_col} fold {fold}.")
+
+
+async def run_grid(units, concurrency, logger):
+    # Every (configuration, fold, PMID) request goes through one semaphore and one connection pool, so the
+    # rate limit is shared by the whole grid instead of being split between separate processes.
+    semaphore = asyncio.Semaphore(concurrency)
+    async with get_backend().async_session(concurrency):
+        await asyncio.gather(*[query_unit(semaphore, unit, logger) for unit in units])
+
+
+def main():
+    args = parse_args()
+    logger = setup_logger(args.log_path)
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout,
+                             pool_size=max(args.pool_size, args.concurrency)))
+    if bool(args.use_cache):
+        set_response_cache(ResponseCache(args.cache_path, max_bytes=args.cache_size_mb * 1024 ** 2))
+
+    experiments = load_config(args.config)
+    units = []
+    for experiment in experiments:
+        # Reseeded per configuration so sampling='global' few-shot samples match a separate run_few_random.py
+        # invocation.
+        np.random.seed(RANDOM_STATE)
+        token_budget = TokenBudget(experiment['gpt_model'], max_prompt_tokens=experiment['max_prompt_tokens'] or None,
+                                   overflow=experiment['overflow'])
+        answer_col, output_folder = experiment['answer_col'], experiment['output_folder']
+        for fold in range(experiment['num_fold']):
+            gpt_model = GPTModel(model=make_prompt_builder(experiment, fold, token_budget),
+                                 model_type=experiment['gpt_model'],
+                                 temperature=experiment['temperature'],
+                                 logger=logger,
+                                 file_path=experiment['save_dir'],
+                                 retry_passes=args.retry_passes,
+                                 neighbour_cache=bool(experiment['neighbour_cache']))
+            csv_writer, csv_file = gpt_model.setup_output_directory(output_folder, answer_col, fold,
+                                                                      resume=bool(args.resume))
+            pending = gpt_model.get_pending_prompts(read_split(experiment['save_dir'], 'test', fold),
+                                                    output_folder, answer_col, fold)
+            units.append((answer_col, fold, gpt_model, csv_writer, csv_file, pending))
+
+    logger.info(f"\nGrid: {len(experiments)} configurations, {len(units)} folds, "
+                f"{sum(len(unit[-1]) for unit in units)} queries.")
+    asyncio.run(run_grid(units, args.concurrency, logger))
+
+if __name__ == '__main__':
+    main()
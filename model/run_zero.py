@@ -7,8 +7,13 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 import argparse
 import openai
 from zero_shot import ZeroShot
-from funs import read_file, setup_logger
+from funs import read_file, setup_logger, set_rate_limiter, set_response_cache, set_backend
+from rate_limiter import RateLimiter
+from llm_backend import make_backend
+from token_budget import TokenBudget
+from response_cache import ResponseCache
 from query_output_gpt import GPTModel, load_train_test_data
+from batch_query import BatchClient, LocalBatchClient, run_batch
 openai.api_key = "Your Key"
 RANDOM_STATE = 123
 np.random.seed(RANDOM_STATE)
@@ -32,13 +37,39 @@ def parse_args():
     parser.add_argument("--sub", type=int, default=0)
     parser.add_argument("--answer_col", type=str, default='Nipah_Q2_ZeroCoT')
     parser.add_argument("--log_path", type=str, default='./model/output/Nipah/cross_validation_output/zero_shot.log')
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rpm", type=float, default=3500)
+    parser.add_argument("--tpm", type=float, default=90000)
+    parser.add_argument("--limiter_path", type=str, default='./model/output/rate_limiter.sqlite')
+    parser.add_argument("--use_cache", type=int, default=1)
+    parser.add_argument("--cache_path", type=str, default='./model/output/response_cache.sqlite')
+    parser.add_argument("--cache_size_mb", type=int, default=1024)
+    parser.add_argument("--resume", type=int, default=0)
+    parser.add_argument("--retry_passes", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--batch_local", type=int, default=0)
+    parser.add_argument("--batch_poll", type=int, default=60)
+    parser.add_argument("--batch_max_wait", type=float, default=25 * 3600, help="seconds to poll a batch before giving up")
+    parser.add_argument("--max_prompt_tokens", type=int, default=0)
+    parser.add_argument("--overflow", type=str, default='route', choices=['route', 'trim'])
+    parser.add_argument("--backend", type=str, default='openai', choices=['openai', 'http'])
+    parser.add_argument("--api_base", type=str, default=None)
+    parser.add_argument("--request_timeout", type=float, default=120)
+    parser.add_argument("--pool_size", type=int, default=16)
     args = parser.parse_args()
     return args
 
 def main():
     args = parse_args()
     logger = setup_logger(args.log_path)
-
+    set_rate_limiter(RateLimiter(rpm=args.rpm, tpm=args.tpm, state_path=args.limiter_path))
+    set_backend(make_backend(args.backend, api_base=args.api_base, timeout=args.request_timeout,
+                             pool_size=max(args.pool_size, args.concurrency)))
+    if bool(args.use_cache):
+        set_response_cache(ResponseCache(args.cache_path, max_bytes=args.cache_size_mb * 1024 ** 2))
+
+    token_budget = TokenBudget(args.gpt_model, max_prompt_tokens=args.max_prompt_tokens or None, overflow=args.overflow)
+    jobs = []
     for fold in range(args.num_fold):
         train_df, test_df = load_train_test_data(args.save_dir, fold)
 
@@ -50,21 +81,37 @@ def main():
                             noncot_prompt = read_file(args.noncot_path),
                             subquestion_prompt = read_file(args.sub_path),
                             COT = bool(args.cot),
-                            SUB = bool(args.sub))
+                            SUB = bool(args.sub),
+                            token_budget = token_budget)
 
         gpt_model = GPTModel(model = zeroshot,
                              model_type = args.gpt_model,
                              temperature = args.temperature,
                              logger = logger,
-                             file_path = args.save_dir)
-        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold)
+                             file_path = args.save_dir,
+                             retry_passes = args.retry_passes)
+        if bool(args.batch):
+            jobs.append((fold, gpt_model, test_df))
+            continue
+
+        csv_writer, csv_file = gpt_model.setup_output_directory(args.output_folder, args.answer_col, fold,
+                                                                  resume=bool(args.resume))
 
         logger.info(f"\nZero Shot:  {args.answer_col} Fold: {fold}.")
         logger.info(f"\nOutput Directory: {args.output_folder}")
 
-        gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
+        if args.concurrency > 1:
+            gpt_model.get_test_output_async(test_df, csv_writer, args.output_folder, args.answer_col, fold,
+                                            concurrency=args.concurrency)
+        else:
+            gpt_model.get_test_output(test_df, csv_writer, args.output_folder, args.answer_col, fold)
         csv_file.close()
 
+    if bool(args.batch):
+        client = LocalBatchClient() if bool(args.batch_local) else \
+            BatchClient(api_base=args.api_base, poll_interval=args.batch_poll, max_wait=args.batch_max_wait)
+        run_batch(jobs, client, args.output_folder, args.answer_col, logger, resume=bool(args.resume))
+
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from typing import Tuple
+from funs import load_embedding_file, match_pmids
+
+METHODS = ['bm25', 'tfidf']
+
+
+class SparseRetriever:
+    # Lexical retrieval over the Combined text of training papers, so similar-shot prompts need no embedding
+    # calls. Documents are kept as a terms x documents CSR matrix of BM25 or TF-IDF weights, and a batch of
+    # queries is scored with one sparse matrix product.
+    def __init__(self, method: str = 'bm25', k1: float = 1.2, b: float = 0.75) -> None:
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}.")
+
+        self.method = method
+        self.k1 = k1
+        self.b = b
+        self.vectorizer = CountVectorizer(stop_words='english', dtype=np.float32)
+        self.idf = None
+        self.term_docs = None
+
+    @property
+    def params(self):
+        return (self.method, self.k1, self.b)
+
+    def __len__(self):
+        return self.term_docs.shape[1]
+
+    def fit(self, texts):
+        counts = self.vectorizer.fit_transform(texts).tocsr()
+        n_docs = counts.shape[0]
+        doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+        if self.method == 'bm25':
+            self.idf = np.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+            lengths = np.asarray(counts.sum(axis=1)).ravel()
+            norms = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1))
+            norms = np.repeat(norms, np.diff(counts.indptr))
+            counts.data = counts.data * (self.k1 + 1) / (counts.data + norms) * self.idf[counts.indices]
+        else:
+            self.idf = (np.log((1 + n_docs) / (1 + doc_freq)) + 1).astype(np.float32)
+            counts.data = counts.data * self.idf[counts.indices]
+            counts = self.normalize(counts)
+        self.term_docs = counts.T.tocsr().astype(np.float32)
+        return self
+
+    def normalize(self, matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        return sparse.diags(1 / np.where(norms == 0, 1, norms)) @ matrix
+
+    def transform(self, texts) -> sparse.csr_matrix:
+        counts = self.vectorizer.transform(texts).tocsr()
+        if self.method == 'bm25':
+            # Each query term counts once; its weight is in the document matrix.
+            counts.data[:] = 1
+            return counts
+        counts.data = counts.data * self.idf[counts.indices]
+        return self.normalize(counts)
+
+    def search(self, queries, k: int, mask: np.ndarray = None,
+               chunk_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the document positions of the k best scoring documents for every query text, best first, and
+        # their scores. Documents outside mask are never returned: with fewer than k in mask there are fewer
+        # than k columns.
+        if mask is not None:
+            k = min(k, int(np.count_nonzero(mask)))
+        queries = self.transform(queries)
+        positions = np.empty((queries.shape[0], k), dtype=int)
+        scores = np.empty((queries.shape[0], k))
+        for start in range(0, queries.shape[0] if k > 0 else 0, chunk_size):
+            similarities = (queries[start:start + chunk_size] @ self.term_docs).toarray()
+            if mask is not None:
+                similarities[:, ~mask] = -np.inf
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            positions[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+            scores[start:start + chunk_size] = np.take_along_axis(top_scores, order, axis=1)
+        return positions, scores
+
+
+def dense_search(train_embeddings: np.ndarray, test_embeddings: np.ndarray, k: int) -> np.ndarray:
+    train_embeddings = train_embeddings / np.linalg.norm(train_embeddings, axis=1, keepdims=True)
+    similarities = test_embeddings @ train_embeddings.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sparse and dense similar-example retrieval",
+                                     prog="Sparse Retriever",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--data_dir", type=str, default='./data_preparation/output/datasets/Nipah/cross_validation_datasets/general')
+    parser.add_argument("--fold", type=int, default=0)
+    parser.add_argument("--k", type=int, default=2)
+    args = parser.parse_args()
+
+    train_df = pd.read_csv(f'{args.data_dir}/train_{args.fold}.csv')
+    test_df = pd.read_csv(f'{args.data_dir}/test_{args.fold}.csv')
+    train_labels = train_df['Review'].str.upper().str.contains('YES').values
+    test_labels = test_df['Review'].str.upper().str.contains('YES').values
+
+    # Label agreement is the share of retrieved examples with the test paper's answer; overlap is the share
+    # of the dense neighbours that are also retrieved.
+    results = {}
+    train_embeddings, train_ids = load_embedding_file(f'{args.data_dir}/embed_train_{args.fold}.npz')
+    test_embeddings, test_ids = load_embedding_file(f'{args.data_dir}/embed_test_{args.fold}.npz')
+    train_matched, train_rows = match_pmids(train_df['PMID'].values, train_ids)
+    test_matched, test_rows = match_pmids(test_df['PMID'].values, test_ids)
+    if len(train_matched) != len(train_df) or len(test_matched) != len(test_df):
+        raise ValueError("Every train and test PMID needs exactly one embedding.")
+    start = time.perf_counter()
+    results['dense'] = (dense_search(train_embeddings[train_rows], test_embeddings[test_rows], args.k),
+                        time.perf_counter() - start)
+    for method in METHODS:
+        start = time.perf_counter()
+        retriever = SparseRetriever(method).fit(train_df['Combined'].values)
+        positions, _ = retriever.search(test_df['Combined'].values, args.k)
+        results[method] = (positions, time.perf_counter() - start)
+
+    print(f"{'retriever':<10} {'seconds':>8} {'label agreement':>16} {'dense overlap':>14}")
+    for name, (positions, seconds) in results.items():
+        agreement = np.mean(train_labels[positions] == test_labels[:, None])
+        overlap = np.mean([len(set(p) & set(d)) / args.k for p, d in zip(positions, results['dense'][0])])
+        print(f"{name:<10} {seconds:>8.3f} {agreement:>16.3f} {overlap:>14.3f}")
+
+if __name__ == '__main__':
+    main()
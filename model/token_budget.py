@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+### author: Jingmei Yang: jmyang@bu.edu
+
+from collections import namedtuple
+from funs import count_tokens, get_encoding, MAX_TOKENS
+
+CONTEXT_WINDOWS = {'text-davinci-003': 4097,
+                   'gpt-3.5-turbo': 4096,
+                   'gpt-3.5-turbo-0301': 4096,
+                   'gpt-3.5-turbo-16k': 16384,
+                   'gpt-4': 8192,
+                   'gpt-4-32k': 32768}
+
+LONG_CONTEXT_MODELS = {'gpt-3.5-turbo': 'gpt-3.5-turbo-16k',
+                       'gpt-3.5-turbo-0301': 'gpt-3.5-turbo-16k',
+                       'gpt-4': 'gpt-4-32k'}
+
+CompiledPrompt = namedtuple('CompiledPrompt', ['prompt', 'model_type', 'n_tokens'])
+
+
+def truncate_text(text: str, n_tokens: int, model_type: str) -> str:
+    encoding = get_encoding(model_type)
+    return encoding.decode(encoding.encode(text)[:max(0, n_tokens)])
+
+
+class TokenBudget:
+    # overflow='route' sends a prompt that does not fit to the long-context variant of the model (trimming only if
+    # it does not fit there either); overflow='trim' keeps the model and drops examples, then shortens papers.
+    def __init__(self,
+                 model_type: str,
+                 max_prompt_tokens: int = None,
+                 completion_tokens: int = MAX_TOKENS,
+                 overflow: str = 'route',
+                 min_examples: int = 1) -> None:
+
+        if overflow not in ['route', 'trim']:
+            raise ValueError("overflow must be 'route' or 'trim'.")
+
+        self.model_type = model_type
+        self.completion_tokens = completion_tokens
+        self.overflow = overflow
+        self.min_examples = min_examples
+        self.limit = max_prompt_tokens or self.get_limit(model_type)
+        self.long_model = LONG_CONTEXT_MODELS.get(model_type) if overflow == 'route' else None
+
+    def get_limit(self, model_type):
+        return CONTEXT_WINDOWS.get(model_type, 4096) - self.completion_tokens
+
+    def compile(self, build, examples, context) -> CompiledPrompt:
+        # build(examples, context) returns the prompt for a list of (paper, answer) pairs and the test paper.
+        model_type, limit = self.model_type, self.limit
+        prompt = build(examples, context)
+        n_tokens = count_tokens(prompt, model_type)
+        if n_tokens <= limit:
+            return CompiledPrompt(prompt, model_type, n_tokens)
+
+        if self.long_model is not None:
+            model_type, limit = self.long_model, self.get_limit(self.long_model)
+            if n_tokens <= limit:
+                return CompiledPrompt(prompt, model_type, n_tokens)
+
+        # Least relevant examples are last in the list (second sample, lowest similarity), so they go first.
+        examples = list(examples)
+        while n_tokens > limit and len(examples) > self.min_examples:
+            examples.pop()
+            prompt = build(examples, context)
+            n_tokens = count_tokens(prompt, model_type)
+
+        # Then the longest example paper is shortened, and the test paper itself only once the examples are empty.
+        while n_tokens > limit:
+            lengths = [count_tokens(paper, model_type) for paper, answer in examples]
+            longest = max(range(len(examples)), key=lambda i: lengths[i]) if examples else None
+            if longest is not None and lengths[longest] > 0:
+                paper = truncate_text(examples[longest][0], lengths[longest] - (n_tokens - limit) - 1, model_type)
+                examples[longest] = (paper, examples[longest][1])
+            else:
+                context_tokens = count_tokens(context, model_type)
+                if context_tokens == 0:
+                    break
+                context = truncate_text(context, context_tokens - (n_tokens - limit) - 1, model_type)
+            prompt = build(examples, context)
+            shortened_tokens = count_tokens(prompt, model_type)
+            if shortened_tokens >= n_tokens:
+                break
+            n_tokens = shortened_tokens
+
+        return CompiledPrompt(prompt, model_type, n_tokens)
+
+
+def compile_prompt(token_budget, build, examples, context, model_type) -> CompiledPrompt:
+    if token_budget is None:
+        prompt = build(examples, context)
+        return CompiledPrompt(prompt, model_type, count_tokens(prompt, model_type))
+    return token_budget.compile(build, examples, context)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 ### author: Jingmei Yang: jmyang@bu.edu
+from token_budget import TokenBudget, CompiledPrompt, compile_prompt
 
 class ZeroShot:
     def __init__(self,
@@ -11,7 +12,8 @@ class ZeroShot:
                  noncot_prompt: str,
                  subquestion_prompt: str,
                  COT: bool = False,
-                 SUB: bool = False) -> None:
+                 SUB: bool = False,
+                 token_budget: TokenBudget = None) -> None:
 
         if not all(isinstance(i, str) for i in [system, definition, question, cot_prompt, noncot_prompt, subquestion_prompt]):
             raise TypeError("system, definition, question, cot_prompt, noncot_prompt, and subquestion_prompt  must be string.")
@@ -25,6 +27,7 @@ class ZeroShot:
         self.definition = definition
         self.cot = COT
         self.sub = SUB
+        self.token_budget = token_budget
         if self.sub:
             self.question_prompt = f"Primary question: {question}\n{subquestion_prompt}"
         elif self.cot:
@@ -32,7 +35,7 @@ class ZeroShot:
         else:
             self.question_prompt = f"Question: {question}\n{noncot_prompt}"
 
-    def get_prompt(self, context: str):
+    def build(self, examples, context: str):
 
         if self.model_type == 'text-davinci-003':
             return f"{self.definition}\n{context}\n{self.question_prompt}"
@@ -41,3 +44,14 @@ class ZeroShot:
                 {"role": "system", "content": f"{self.system}"},
                 {"role": "user", "content": f"{self.definition}\n\n{context}\n{self.question_prompt}"}]
 
+    def compile_prompt(self, context: str) -> CompiledPrompt:
+        return compile_prompt(self.token_budget, self.build, [], context, self.model_type)
+
+    def get_prompt(self, context: str):
+        return self.compile_prompt(context).prompt
+
+    def get_prompts(self, test_df):
+        # Yields (PMID, CompiledPrompt) for every paper of a fold, in row order.
+        for pmid, context in zip(test_df['PMID'].values, test_df['Combined'].values):
+            yield pmid, self.compile_prompt(context)
+